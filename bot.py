@@ -9,7 +9,13 @@ load_dotenv()
 import re
 import sys
 from datetime import datetime
-from utils.receipt_generator import generate_order_card
+from utils import receipt_generator
+from utils.dev_reload import watch_modules
+from utils.render_pool import RenderPool, current as current_render_pool, install as install_render_pool
+from utils.router import RoutedTeleBot, Router
+from utils.scheduler import install as install_chat_scheduler, track_tasks
+from utils.outbound import install as install_outbound_limiter, outbound_priority, PRIORITY_CRITICAL, PRIORITY_BULK
+from utils.callbacks import encode as encode_callback, is_encoded, decode_call, callback_action
 import base64
 # Reverting to direct DB functions defined in bot.py
 # from db_manager import get_seller_by_telegram, get_products, get_categories, get_product_by_id, get_category_by_id
@@ -44,7 +50,69 @@ else:
 #    if "TOKEN" in key or "TELEGRAM" in key:
 #        print(f"   🔑 Found Key: '{key}' -> Value starts with: '{value[:5]}...'")
 # print("---------------------------------------\n")
-bot = telebot.TeleBot(TOKEN)
+# عدد خيوط المعالجة في TeleBot، ويُحدد حجم مجمع اتصالات قاعدة البيانات بناءً عليه
+BOT_NUM_THREADS = int(os.environ.get('BOT_NUM_THREADS', '4'))
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', str(BOT_NUM_THREADS + 1)))
+
+# رسم بطاقات المنتجات والطلبات في عمليات منفصلة (RENDER_WORKERS=0 يرسمها في خيط المعالج نفسه)
+# RENDER_WORKERS هو العدد الكلي، يُقسَّم على عمليات المعالجة عند BOT_WORKERS > 1
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', str(os.cpu_count() or 1)))
+# الحد الأقصى للبطاقات قيد الرسم أو بالانتظار في كل عملية (افتراضياً 4 لكل عملية رسم)
+RENDER_MAX_INFLIGHT = int(os.environ.get('RENDER_MAX_INFLIGHT', '0'))
+# بطاقة لم تُرسم خلال هذه المدة تُستبدل بالنص
+RENDER_DEADLINE = float(os.environ.get('RENDER_DEADLINE_SECONDS', '5'))
+
+def start_render_pool():
+    """
+    يُستدعى عند التشغيل فقط (__main__ أو _start_worker)، لا عند الاستيراد، حتى لا تنشئ السكربتات
+    التي تستورد bot عمليات رسم. العمليات تُنسخ بـ fork، لذا يُستدعى قبل إنشاء أي خيط
+    """
+    if RENDER_WORKERS <= 0 or not RenderPool.available():
+        return
+    workers = max(RENDER_WORKERS // max(BOT_WORKERS, 1), 1)
+    install_render_pool(RenderPool(workers, RENDER_MAX_INFLIGHT or workers * 4, RENDER_DEADLINE))
+
+# الموجّه يفهرس معالجات الرسائل والأزرار حتى لا تُختبر كل الفلاتر لكل تحديث
+def _current_step(telegram_id):
+    state = user_states.get(telegram_id)
+    return state.get("step") if isinstance(state, dict) else None
+
+# threaded=False حتى لا ينشئ TeleBot خيوطه عند الاستيراد؛ start_update_runtime() يركّب المجمع عند التشغيل
+bot = RoutedTeleBot(TOKEN, threaded=False, num_threads=BOT_NUM_THREADS, use_class_middlewares=True,
+                    router=Router(step_of=_current_step))
+
+# كل الرسائل الصادرة تمر عبر محدد المعدل: ~30 رسالة/ث إجمالاً، رسالة/ث لكل محادثة، 20/دقيقة لكل مجموعة
+# الحد الإجمالي وحد المجموعات للبوت كله، يُقسَّمان على عمليات المعالجة عند BOT_WORKERS > 1
+OUTBOUND_LIMITS = dict(
+    global_rate=float(os.environ.get('OUTBOUND_GLOBAL_RATE', '30')),
+    chat_rate=float(os.environ.get('OUTBOUND_CHAT_RATE', '1')),
+    chat_burst=int(os.environ.get('OUTBOUND_CHAT_BURST', '3')),
+    group_per_minute=float(os.environ.get('OUTBOUND_GROUP_PER_MINUTE', '20')),
+    result_timeout=float(os.environ.get('OUTBOUND_RESULT_TIMEOUT', '600')),
+)
+outbound = None
+# وقت انتهاء إيقاف 429 العام، مشترك بين عمليات المعالجة المنسوخة (يُنشأ قبل fork)
+outbound_pause = None
+
+def outbound_limits():
+    """حدود هذه العملية: كل عملية معالجة تملك محدداً خاصاً بها، فتأخذ حصتها من حدود البوت"""
+    workers = max(BOT_WORKERS, 1)
+    limits = dict(OUTBOUND_LIMITS)
+    limits['global_rate'] = OUTBOUND_LIMITS['global_rate'] / workers
+    limits['group_per_minute'] = OUTBOUND_LIMITS['group_per_minute'] / workers
+    limits['shared_pause'] = outbound_pause
+    return limits
+
+def start_update_runtime():
+    """
+    خيوط معالجة التحديثات ومحدد الإرسال تُنشأ عند التشغيل لا عند الاستيراد: في وضع العمليات المتعددة
+    تُنسخ العمليات بـ fork، والقفل الذي يمسكه خيط لحظة النسخ يبقى مقفلاً في العملية الجديدة للأبد
+    """
+    global outbound
+    # تحديثات المحادثة الواحدة تُنفَّذ بالترتيب، والمحادثات المختلفة بالتوازي
+    install_chat_scheduler(bot, BOT_NUM_THREADS)
+    outbound = install_outbound_limiter(telebot.apihelper, **outbound_limits())
+
 IS_POSTGRES = (os.environ.get('DATABASE_URL') is not None) and (psycopg2 is not None)
 
 # إضافة معرف صاحب البوت (أدمن) - للتحكم التقني فقط
@@ -87,114 +155,102 @@ IMAGES_FOLDER = os.path.join(DATA_DIR, "Images")
 os.makedirs(IMAGES_FOLDER, exist_ok=True)
 
 # ----------------- استعادة البيانات عند إضافة Volume جديد -----------------
+import multiprocessing
 import shutil
+import threading
+import time
 import urllib.parse
 from contextlib import contextmanager
+from utils.db import DBWrapper, CursorWrapper, PostgresPool, SQLitePool, current_session, commit_session
+from utils.middlewares import DBSessionMiddleware, UpdateContextMiddleware, StateFlushMiddleware
+from utils.workers import PartitionedDispatcher, poll_into
+from utils.webhook import WebhookServer, UpdateOffsets
+from utils.jobs import JobQueue, PermanentJobError
+from utils.media import MediaCache
+from utils.state import StateStore, StateHandlerBackend, SQLStateBackend, MemoryStateBackend
+from utils.context import cached, invalidate_context
+from utils.migrator import migrate
+from utils.ledger import (read_balance, read_ledger_balance, delete_balances,
+                          post_entry, CreditLimitExceeded)
+from utils.stock import reserve_stock, release_stock
+from utils.orders import insert_order, insert_order_items, find_buyer_credit_customer
+
+# ===================== Database Connections =====================
+# DBWrapper / CursorWrapper and the connection pools live in utils/db.py
+_db_pool = None
+_db_pool_pid = None
+_db_pool_lock = threading.Lock()
+
+def _get_db_pool():
+    """Creates the process-wide connection pool on first use (again in every forked worker)."""
+    global _db_pool, _db_pool_pid
+    if _db_pool is not None and _db_pool_pid == os.getpid():
+        return _db_pool
+    with _db_pool_lock:
+        if _db_pool is not None and _db_pool_pid == os.getpid():
+            return _db_pool
+        # بعد fork: اتصالات العملية الأم تبقى لها، لا نستخدمها ولا نغلقها هنا
+        _db_pool = None
+        _db_pool_pid = os.getpid()
+        database_url = os.environ.get('DATABASE_URL')
+        if database_url:
+            try:
+                # NUCLEAR OPTION: If we are supposed to use Postgres, KILL the local DB to prevent confusion
+                if os.path.exists(DB_FILE):
+                    print("⚠️ FOUND LOCAL DB IN CLOUD MODE - DELETING IT TO FORCE POSTGRES ⚠️")
+                    try:
+                        os.remove(DB_FILE)
+                    except:
+                        pass
+
+                _db_pool = PostgresPool(database_url, size=DB_POOL_SIZE, max_overflow=DB_POOL_SIZE)
+                print("\n" + "="*50)
+                print(f"✅ BOT CONNECTED TO POSTGRES (Cloud)")
+                print(f"   Host: {_db_pool.host}")
+                print(f"   Pool size: {DB_POOL_SIZE}")
+                print("="*50 + "\n")
+            except Exception as e:
+                print(f"❌ CRITICAL ERROR connecting to Postgres: {e}")
+                raise e
+        else:
+            # Local development mode (no DATABASE_URL)
+            _db_pool = SQLitePool(DB_FILE)
+            print("\n" + "="*50)
+            print(f"⚠️ BOT CONNECTED TO LOCAL SQLITE (No DATABASE_URL)")
+            print(f"   File: {DB_FILE}")
+            print("="*50 + "\n")
+    return _db_pool
 
-# ===================== Database Wrapper =====================
-class DBWrapper:
-    def __init__(self, conn, is_postgres=False):
-        self.conn = conn
-        self.is_postgres = is_postgres
-
-    def cursor(self):
-        return CursorWrapper(self.conn.cursor(), self.is_postgres)
-
-    def commit(self):
-        self.conn.commit()
-
-    def close(self):
-        self.conn.close()
-
-class CursorWrapper:
-    def __init__(self, cursor, is_postgres=False):
-        self.cursor = cursor
-        self.is_postgres = is_postgres
-        self.lastrowid = None # Placeholder
-
-    @property
-    def rowcount(self):
-        return self.cursor.rowcount
-
-    def execute(self, query, params=None):
-        if self.is_postgres:
-            # Replace ? with %s
-            query = query.replace('?', '%s')
-            # Handle AUTOINCREMENT replacement for Postgres compatibility
-            query = query.replace('INTEGER PRIMARY KEY AUTOINCREMENT', 'SERIAL PRIMARY KEY')
-            query = query.replace('DATETIME DEFAULT CURRENT_TIMESTAMP', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP')
-            query = query.replace('DATETIME', 'TIMESTAMP')
-        
-        try:
-            if params is None:
-                self.cursor.execute(query)
-            else:
-                self.cursor.execute(query, params)
-                
-            # Try to capture lastrowid if supported
-            if not self.is_postgres:
-                self.lastrowid = self.cursor.lastrowid
-            else:
-                # Psycopg2: lastrowid is often OID, not PK. 
-                # If RETURNING was used, we need to fetchone to get it.
-                if query.strip().upper().startswith("INSERT") and "RETURNING" in query.upper():
-                    res = self.cursor.fetchone()
-                    if res:
-                        self.lastrowid = res[0]
-        except Exception as e:
-            raise e
-            
-        return self
-
-    def fetchone(self):
-        return self.cursor.fetchone()
-
-    def fetchall(self):
-        return self.cursor.fetchall()
-        
-    def close(self):
-        self.cursor.close()
+def _new_pooled_connection():
+    return _get_db_pool().connection()
 
 def get_db_connection():
-    database_url = os.environ.get('DATABASE_URL')
-    if database_url:
-        try:
-            # NUCLEAR OPTION: If we are supposed to use Postgres, KILL the local DB to prevent confusion
-            if os.path.exists(DB_FILE):
-                print("⚠️ FOUND LOCAL DB IN CLOUD MODE - DELETING IT TO FORCE POSTGRES ⚠️")
-                try:
-                    os.remove(DB_FILE)
-                except:
-                    pass
-
-            result = urllib.parse.urlparse(database_url)
-            username = result.username
-            password = result.password
-            database = result.path[1:]
-            hostname = result.hostname
-            port = result.port
-            conn = psycopg2.connect(
-                database=database,
-                user=username,
-                password=password,
-                host=hostname,
-                port=port
-            )
-            print("\n" + "="*50)
-            print(f"✅ BOT CONNECTED TO POSTGRES (Cloud)")
-            print(f"   Host: {hostname}")
-            print("="*50 + "\n")
-            return DBWrapper(conn, is_postgres=True)
-        except Exception as e:
-            print(f"❌ CRITICAL ERROR connecting to Postgres: {e}")
-            raise e
-    else:
-        # Local development mode (no DATABASE_URL)
-        print("\n" + "="*50)
-        print(f"⚠️ BOT CONNECTED TO LOCAL SQLITE (No DATABASE_URL)")
-        print(f"   File: {DB_FILE}")
-        print("="*50 + "\n")
-        return DBWrapper(sqlite3.connect(DB_FILE), is_postgres=False)
+    """
+    Returns a pooled connection; conn.close() hands it back to the pool.
+    While an update is being handled, every helper gets the update's shared session
+    connection instead, and commit() is deferred until the handler finishes.
+    """
+    session = current_session()
+    if session is not None:
+        return session.borrow()
+    return _new_pooled_connection()
+
+# مهام الخلفية (إشعارات الطلبات، بطاقات الطلبات، رفع الصور، تنظيف الصور) تُحفظ في جدول Jobs
+# وتُنفَّذ في خيوط منفصلة مع إعادة المحاولة. داخل المعالج تُضاف المهمة لنفس معاملة التحديث،
+# فلا تُنفَّذ إلا بعد حفظ البيانات التي تخصها
+JOBS_WORKERS = int(os.environ.get('JOBS_WORKERS', '2'))
+jobs = JobQueue(get_db_connection, poll_interval=float(os.environ.get('JOBS_POLL_INTERVAL', '1')),
+                lease_seconds=int(os.environ.get('JOBS_LEASE_SECONDS', '300')))
+
+# file_id لكل صورة أو بطاقة رُفعت لتليجرام مرة، فتُرسل بعدها بالمعرّف بدل إعادة الرفع
+media = MediaCache(get_db_connection)
+
+# جلسة قاعدة بيانات واحدة لكل تحديث (رسالة أو زر)
+bot.setup_middleware(DBSessionMiddleware(_new_pooled_connection))
+# هوية المرسل (المستخدم، المتجر، الدور) تُقرأ مرة واحدة لكل تحديث
+bot.setup_middleware(UpdateContextMiddleware())
+# حفظ حالات المحادثة التي تغيّرت بعد انتهاء المعالج
+bot.setup_middleware(StateFlushMiddleware())
 
 # Remove the restore logic entirely or guard it carefully
 if not os.path.exists(DB_FILE) and os.path.exists(os.path.join(SEED_DIR, "store.db")) and not os.environ.get('DATABASE_URL'):
@@ -209,349 +265,12 @@ if not os.path.exists(DB_FILE) and os.path.exists(os.path.join(SEED_DIR, "store.
 # ===================== قاعدة البيانات =====================
 # ===================== قاعدة البيانات =====================
 def init_db():
+    """Brings the schema up to date by applying pending migrations (see migrations/)."""
     conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # 1. Users (Main table, no dependencies)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS Users(
-            UserID INTEGER PRIMARY KEY AUTOINCREMENT,
-            TelegramID INTEGER UNIQUE,
-            UserName TEXT,
-            UserType TEXT,
-            PhoneNumber TEXT,
-            FullName TEXT,
-            CreatedAt DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-
-    # 2. Sellers (Depends on Users for SuspendedBy)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS Sellers(
-            SellerID INTEGER PRIMARY KEY AUTOINCREMENT,
-            TelegramID INTEGER UNIQUE,
-            UserName TEXT,
-            StoreName TEXT,
-            CreatedAt DATETIME DEFAULT CURRENT_TIMESTAMP,
-            Status TEXT DEFAULT 'active',
-            SuspensionReason TEXT,
-            SuspendedBy INTEGER,
-            SuspendedAt DATETIME,
-            RequireCustomerRegistration INTEGER DEFAULT 0,
-            FOREIGN KEY (SuspendedBy) REFERENCES Users(TelegramID)
-        )
-    """)
-    
-    # Migration: Add RequireCustomerRegistration column if it doesn't exist
-    try:
-        if IS_POSTGRES:
-            cursor.execute("""
-                SELECT column_name 
-                FROM information_schema.columns 
-                WHERE table_name='sellers' AND column_name='requirecustomerregistration'
-            """)
-            if not cursor.fetchone():
-                print("🔄 Adding RequireCustomerRegistration column to Sellers table...")
-                cursor.execute("ALTER TABLE Sellers ADD COLUMN RequireCustomerRegistration INTEGER DEFAULT 0")
-                conn.commit()
-                print("✅ RequireCustomerRegistration column added successfully")
-            # تأكد من أن جميع المتاجر لديها القيمة 0 (مفتوحة) افتراضياً
-            cursor.execute("UPDATE Sellers SET RequireCustomerRegistration = 0 WHERE RequireCustomerRegistration IS NULL")
-            conn.commit()
-        else:
-            try:
-                cursor.execute("SELECT RequireCustomerRegistration FROM Sellers LIMIT 1")
-                # تأكد من أن جميع المتاجر لديها القيمة 0 (مفتوحة) افتراضياً
-                cursor.execute("UPDATE Sellers SET RequireCustomerRegistration = 0 WHERE RequireCustomerRegistration IS NULL")
-                conn.commit()
-            except:
-                print("🔄 Adding RequireCustomerRegistration column to Sellers table (SQLite)...")
-                cursor.execute("ALTER TABLE Sellers ADD COLUMN RequireCustomerRegistration INTEGER DEFAULT 0")
-                cursor.execute("UPDATE Sellers SET RequireCustomerRegistration = 0 WHERE RequireCustomerRegistration IS NULL")
-                conn.commit()
-                print("✅ RequireCustomerRegistration column added successfully (SQLite)")
-    except Exception as e:
-        print(f"⚠️ Migration warning (non-critical): {e}")
-        try:
-            conn.rollback()
-        except:
-            pass
-
-    # 3. CreditCustomers (Depends on Sellers)
-    # Create table with nullable PhoneNumber first (for compatibility with existing data)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS CreditCustomers(
-            CustomerID INTEGER PRIMARY KEY AUTOINCREMENT,
-            SellerID INTEGER,
-            FullName TEXT NOT NULL,
-            PhoneNumber TEXT,
-            CustomerType TEXT DEFAULT 'CreditCustomer',
-            CreatedAt DATETIME DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(SellerID, PhoneNumber),
-            FOREIGN KEY (SellerID) REFERENCES Sellers(SellerID)
-        )
-    """)
-    
-    # Migration: Add CustomerType column if it doesn't exist
     try:
-        if IS_POSTGRES:
-            # Check if CustomerType column exists in PostgreSQL
-            cursor.execute("""
-                SELECT column_name 
-                FROM information_schema.columns 
-                WHERE table_name='creditcustomers' AND column_name='customertype'
-            """)
-            result = cursor.fetchone()
-            if not result:
-                # Column doesn't exist, add it
-                print("🔄 Adding CustomerType column to CreditCustomers table...")
-                cursor.execute("ALTER TABLE CreditCustomers ADD COLUMN CustomerType TEXT DEFAULT 'CreditCustomer'")
-                # Update existing records
-                cursor.execute("UPDATE CreditCustomers SET CustomerType = 'CreditCustomer' WHERE CustomerType IS NULL")
-                conn.commit()
-                print("✅ CustomerType column added successfully")
-            else:
-                print("✅ CustomerType column already exists")
-        else:
-            # SQLite - Check if column exists by trying to select it
-            try:
-                cursor.execute("SELECT CustomerType FROM CreditCustomers LIMIT 1")
-                print("✅ CustomerType column already exists (SQLite)")
-            except:
-                # Column doesn't exist, add it
-                print("🔄 Adding CustomerType column to CreditCustomers table (SQLite)...")
-                cursor.execute("ALTER TABLE CreditCustomers ADD COLUMN CustomerType TEXT DEFAULT 'CreditCustomer'")
-                cursor.execute("UPDATE CreditCustomers SET CustomerType = 'CreditCustomer' WHERE CustomerType IS NULL")
-                conn.commit()
-                print("✅ CustomerType column added successfully (SQLite)")
-    except Exception as e:
-        print(f"⚠️ Migration warning (non-critical): {e}")
-        try:
-            conn.rollback()
-        except:
-            pass
-        # Don't fail the entire init if migration fails
-
-    # 4. CreditLimits (Depends on CreditCustomers, Sellers)
-    # Using DEFAULT TRUE for Postgres compatibility
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS CreditLimits (
-            LimitID INTEGER PRIMARY KEY AUTOINCREMENT,
-            CustomerID INTEGER,
-            SellerID INTEGER,
-            MaxCreditAmount REAL DEFAULT 1000000,
-            WarningThreshold REAL DEFAULT 0.8,
-            CurrentUsedAmount REAL DEFAULT 0,
-            IsActive BOOLEAN DEFAULT TRUE,
-            CreatedAt DATETIME DEFAULT CURRENT_TIMESTAMP,
-            UpdatedAt DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (CustomerID) REFERENCES CreditCustomers(CustomerID),
-            FOREIGN KEY (SellerID) REFERENCES Sellers(SellerID),
-            UNIQUE(CustomerID, SellerID)
-        )
-    """)
-
-    # 5. Categories (Depends on Sellers)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS Categories(
-            CategoryID INTEGER PRIMARY KEY AUTOINCREMENT,
-            SellerID INTEGER,
-            Name TEXT,
-            OrderIndex INTEGER DEFAULT 0,
-            FOREIGN KEY (SellerID) REFERENCES Sellers(SellerID)
-        )
-    """)
-
-    # 6. Products (Depends on Sellers, Categories)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS Products(
-            ProductID INTEGER PRIMARY KEY AUTOINCREMENT,
-            SellerID INTEGER,
-            CategoryID INTEGER,
-            Name TEXT,
-            Description TEXT,
-            Price REAL,
-            WholesalePrice REAL,
-            Quantity INTEGER,
-            ImagePath TEXT,
-            Status TEXT DEFAULT 'active',
-            CreatedAt DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (SellerID) REFERENCES Sellers(SellerID),
-            FOREIGN KEY (CategoryID) REFERENCES Categories(CategoryID)
-        )
-    """)
-    
-    # 6.1. ProductImages (Depends on Products) - صور متعددة لكل منتج
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS ProductImages(
-            ImageID INTEGER PRIMARY KEY AUTOINCREMENT,
-            ProductID INTEGER,
-            ImagePath TEXT NOT NULL,
-            ImageOrder INTEGER DEFAULT 0,
-            CreatedAt DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (ProductID) REFERENCES Products(ProductID) ON DELETE CASCADE
-        )
-    """)
-
-    # 7. Carts (Depends on Users, Products)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS Carts(
-            CartID INTEGER PRIMARY KEY AUTOINCREMENT,
-            UserID INTEGER,
-            ProductID INTEGER,
-            Quantity INTEGER,
-            Price REAL,
-            AddedAt DATETIME DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(UserID, ProductID),
-            FOREIGN KEY (UserID) REFERENCES Users(TelegramID),
-            FOREIGN KEY (ProductID) REFERENCES Products(ProductID)
-        )
-    """)
-
-    # 8. Orders (Depends on Users, Sellers)
-    # Using DEFAULT FALSE for Postgres compatibility
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS Orders(
-            OrderID INTEGER PRIMARY KEY AUTOINCREMENT,
-            BuyerID INTEGER,
-            SellerID INTEGER,
-            Total REAL,
-            Status TEXT DEFAULT 'Pending',
-            CreatedAt DATETIME DEFAULT CURRENT_TIMESTAMP,
-            DeliveryAddress TEXT,
-            Notes TEXT,
-            PaymentMethod TEXT DEFAULT 'cash',
-            FullyPaid BOOLEAN DEFAULT FALSE,
-            FOREIGN KEY (BuyerID) REFERENCES Users(TelegramID),
-            FOREIGN KEY (SellerID) REFERENCES Sellers(SellerID)
-        )
-    """)
-
-    # 9. OrderItems (Depends on Orders, Products)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS OrderItems(
-            OrderItemID INTEGER PRIMARY KEY AUTOINCREMENT,
-            OrderID INTEGER,
-            ProductID INTEGER,
-            Quantity INTEGER,
-            Price REAL,
-            ReturnedQuantity INTEGER DEFAULT 0,
-            ReturnReason TEXT,
-            ReturnDate DATETIME,
-            FOREIGN KEY (OrderID) REFERENCES Orders(OrderID),
-            FOREIGN KEY (ProductID) REFERENCES Products(ProductID)
-        )
-    """)
-
-    # 10. Returns (Depends on Orders, Products, Users)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS Returns(
-            ReturnID INTEGER PRIMARY KEY AUTOINCREMENT,
-            OrderID INTEGER,
-            ProductID INTEGER,
-            Quantity INTEGER,
-            Reason TEXT,
-            Status TEXT DEFAULT 'Pending',
-            CreatedAt DATETIME DEFAULT CURRENT_TIMESTAMP,
-            ProcessedBy INTEGER,
-            ProcessedAt DATETIME,
-            FOREIGN KEY (OrderID) REFERENCES Orders(OrderID),
-            FOREIGN KEY (ProductID) REFERENCES Products(ProductID),
-            FOREIGN KEY (ProcessedBy) REFERENCES Users(TelegramID)
-        )
-    """)
-
-    # 11. Messages (Depends on Orders, Sellers)
-    # Using DEFAULT FALSE for Postgres compatibility
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS Messages(
-            MessageID INTEGER PRIMARY KEY AUTOINCREMENT,
-            OrderID INTEGER,
-            SellerID INTEGER,
-            MessageType TEXT,
-            MessageText TEXT,
-            IsRead BOOLEAN DEFAULT FALSE,
-            CreatedAt DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (OrderID) REFERENCES Orders(OrderID),
-            FOREIGN KEY (SellerID) REFERENCES Sellers(SellerID)
-        )
-    """)
-
-    # 12. CustomerCredit (Transaction History) - Depends on CreditCustomers, Sellers
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS CustomerCredit(
-            CreditID INTEGER PRIMARY KEY AUTOINCREMENT,
-            CustomerID INTEGER,
-            SellerID INTEGER,
-            TransactionType TEXT,
-            Amount REAL,
-            Description TEXT,
-            BalanceBefore REAL,
-            BalanceAfter REAL,
-            TransactionDate DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (CustomerID) REFERENCES CreditCustomers(CustomerID),
-            FOREIGN KEY (SellerID) REFERENCES Sellers(SellerID)
-        )
-    """)
-
-    # 13. CustomerCredit (Depends on CreditCustomers, Sellers)
-    # Using DEFAULT FALSE for Postgres compatibility (though boolean not used here heavily)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS CustomerCredit (
-            CreditID INTEGER PRIMARY KEY AUTOINCREMENT,
-            CustomerID INTEGER,
-            SellerID INTEGER,
-            TransactionType TEXT,
-            Amount REAL,
-            Description TEXT,
-            BalanceBefore REAL,
-            BalanceAfter REAL,
-            TransactionDate DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (CustomerID) REFERENCES CreditCustomers(CustomerID),
-            FOREIGN KEY (SellerID) REFERENCES Sellers(SellerID)
-        )
-    """)
-
-    # 14. Image Storage (For Syncing Images from Desktop App)
-    if IS_POSTGRES:
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS ImageStorage(
-                FileName TEXT PRIMARY KEY,
-                FileData BYTEA,
-                UploadedAt TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-    else:
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS ImageStorage(
-                FileName TEXT PRIMARY KEY,
-                FileData BLOB,
-                UploadedAt DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-    
-    # ----------------- MIGRATIONS -----------------
-    def ensure_column(table, column, definition):
-        try:
-            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
-            conn.commit()
-            print(f"[OK] Migrated: Added {column} to {table}")
-        except Exception as e:
-            # Most likely column already exists
-            pass
-            
-    # Explicitly ensure ImagePath exists for Sync
-    ensure_column('Sellers', 'ImagePath', 'TEXT')
-    ensure_column('Categories', 'ImagePath', 'TEXT')
-    ensure_column('Products', 'ImagePath', 'TEXT')
-    
-    # Ensure Suspension columns exist
-    ensure_column('Sellers', 'SuspensionReason', 'TEXT')
-    ensure_column('Sellers', 'SuspendedBy', 'INTEGER')
-    ensure_column('Sellers', 'SuspendedAt', 'DATETIME')
-    
-    conn.commit()
-    conn.close()
+        migrate(conn)
+    finally:
+        conn.close()
 
 # Note: init_db() is called in if __name__ == "__main__" block, not here
 
@@ -631,7 +350,7 @@ def check_credit_limit(customer_id, seller_id, new_amount):
     if new_total > max_limit:
         remaining = max_limit - current_used
         conn.close()
-        return False, f"❌ تجاوز الحد الائتماني! الحد الأقصى: {max_limit:,.0f} دينار، المستخدم: {current_used:,.0f} دينار، المتبقي: {remaining:,.0f} دينار", max_limit, current_used, remaining
+        return False, credit_limit_exceeded_message(max_limit, current_used), max_limit, current_used, remaining
     
     # التحقق من عتبة التحذير
     warning_percentage = current_used / max_limit if max_limit > 0 else 0
@@ -643,52 +362,9 @@ def check_credit_limit(customer_id, seller_id, new_amount):
     conn.close()
     return True, f"✅ الحد الائتماني مناسب. المتبقي: {max_limit - current_used:,.0f} دينار", max_limit, current_used, max_limit - current_used
 
-def update_credit_usage(customer_id, seller_id, amount, transaction_type):
-    """تحديث المبلغ المستخدم من الحد الائتماني"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # الحصول على الحد الحالي أو إنشاء واحد جديد
-    cursor.execute("""
-        SELECT CurrentUsedAmount FROM CreditLimits 
-        WHERE CustomerID=? AND SellerID=? AND IsActive IS TRUE
-    """, (customer_id, seller_id))
-    
-    result = cursor.fetchone()
-    
-    if result:
-        current_used = result[0]
-        
-        if transaction_type == 'purchase':
-            new_used = current_used + amount
-        elif transaction_type == 'payment':
-            new_used = current_used - amount
-            if new_used < 0:
-                new_used = 0
-        else:
-            new_used = current_used
-        
-        cursor.execute("""
-            UPDATE CreditLimits 
-            SET CurrentUsedAmount=?, UpdatedAt=CURRENT_TIMESTAMP
-            WHERE CustomerID=? AND SellerID=? AND IsActive IS TRUE
-        """, (new_used, customer_id, seller_id))
-    else:
-        # إنشاء سجل جديد
-        if transaction_type == 'purchase':
-            current_used = amount
-        else:
-            current_used = 0
-        
-        cursor.execute("""
-            INSERT INTO CreditLimits 
-            (CustomerID, SellerID, MaxCreditAmount, CurrentUsedAmount, IsActive)
-            VALUES (?, ?, 1000000, ?, TRUE)
-        """, (customer_id, seller_id, current_used))
-    
-    conn.commit()
-    conn.close()
-    return True
+def credit_limit_exceeded_message(max_limit, current_used):
+    remaining = max_limit - current_used
+    return f"❌ تجاوز الحد الائتماني! الحد الأقصى: {max_limit:,.0f} دينار، المستخدم: {current_used:,.0f} دينار، المتبقي: {remaining:,.0f} دينار"
 
 def set_credit_limit(customer_id, seller_id, max_amount, warning_percentage=0.8):
     """تعيين حد ائتماني للزبون"""
@@ -807,6 +483,7 @@ def suspend_seller(seller_id, suspended_by, reason=None):
     """, (reason, suspended_by, seller_id))
     
     conn.commit()
+    invalidate_context()
     conn.close()
     
     # إرسال إشعار للبائع
@@ -839,6 +516,7 @@ def activate_seller(seller_id, activated_by):
     """, (seller_id,))
     
     conn.commit()
+    invalidate_context()
     conn.close()
     
     # إرسال إشعار للبائع
@@ -1092,66 +770,34 @@ def is_credit_customer(seller_id, phone_number, full_name):
 
 # ===================== نظام كشف حساب الزبائن الآجل =====================
 def add_credit_transaction(customer_id, seller_id, transaction_type, amount, description=""):
-    """إضافة معاملة ائتمانية للزبون"""
+    """إضافة معاملة ائتمانية للزبون (الرصيد والحد الائتماني يُحدَّثان في نفس المعاملة)"""
     conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # الحصول على الرصيد الحالي
-    cursor.execute("""
-        SELECT BalanceAfter 
-        FROM CustomerCredit 
-        WHERE CustomerID=? AND SellerID=?
-        ORDER BY TransactionDate DESC LIMIT 1
-    """, (customer_id, seller_id))
-    
-    result = cursor.fetchone()
-    balance_before = result[0] if result else 0
-    
-    if transaction_type == 'purchase':
-        balance_after = balance_before + amount
-    elif transaction_type == 'payment':
-        balance_after = balance_before - amount
-    elif transaction_type == 'adjustment':
-        balance_after = amount
-    else:
-        balance_after = balance_before
-    
-    # إضافة المعاملة
-    query = """
-        INSERT INTO CustomerCredit 
-        (CustomerID, SellerID, TransactionType, Amount, Description, BalanceBefore, BalanceAfter)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    """
-    if IS_POSTGRES:
-        query += " RETURNING CreditID"
-    
-    cursor.execute(query, (customer_id, seller_id, transaction_type, amount, description, balance_before, balance_after))
-    
-    # تحديث الحد الائتماني
-    if transaction_type in ['purchase', 'payment']:
-        update_credit_usage(customer_id, seller_id, amount, transaction_type)
-    
-    conn.commit()
-    conn.close()
-    
-    return True
+    try:
+        post_entry(conn, customer_id, seller_id, transaction_type, amount, description)
+        conn.commit()
+        return True
+    except Exception as e:
+        print(f"Error adding credit transaction: {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def _current_balance(cursor, customer_id, seller_id):
+    """الرصيد من CustomerBalances، ومن آخر قيد في السجل إذا لم يُحسب بعد (قيود مزامنة التطبيق)"""
+    balance = read_balance(cursor, customer_id, seller_id)
+    if balance is None:
+        balance = read_ledger_balance(cursor, customer_id, seller_id)
+    return balance or 0
 
 def get_customer_balance(customer_id, seller_id):
     """الحصول على رصيد الزبون لدى بائع معين"""
     conn = get_db_connection()
     cursor = conn.cursor()
-    
-    cursor.execute("""
-        SELECT BalanceAfter 
-        FROM CustomerCredit 
-        WHERE CustomerID=? AND SellerID=?
-        ORDER BY TransactionDate DESC LIMIT 1
-    """, (customer_id, seller_id))
-    
-    result = cursor.fetchone()
+    balance = _current_balance(cursor, customer_id, seller_id)
     conn.close()
     
-    return result[0] if result else 0
+    return balance
 
 def get_customer_statement(customer_id, seller_id, limit=10):
     """الحصول على كشف حساب الزبون"""
@@ -1188,16 +834,12 @@ def get_all_customers_with_balance(seller_id):
             cc.FullName,
             cc.PhoneNumber,
             cc.CreatedAt,
-            COALESCE((
-                SELECT BalanceAfter 
-                FROM CustomerCredit 
-                WHERE CustomerID = cc.CustomerID AND SellerID = cc.SellerID
-                ORDER BY TransactionDate DESC LIMIT 1
-            ), 0) as Balance,
+            COALESCE(cb.Balance, 0) as Balance,
             COALESCE(cl.MaxCreditAmount, 1000000) as MaxCredit,
             COALESCE(cl.CurrentUsedAmount, 0) as CurrentUsed,
             COALESCE(cl.IsActive, TRUE) as LimitActive
         FROM CreditCustomers cc
+        LEFT JOIN CustomerBalances cb ON cc.CustomerID = cb.CustomerID AND cc.SellerID = cb.SellerID
         LEFT JOIN CreditLimits cl ON cc.CustomerID = cl.CustomerID AND cc.SellerID = cl.SellerID
         WHERE cc.SellerID = ?
         ORDER BY Balance DESC
@@ -1231,9 +873,13 @@ def add_user(telegram_id, username, usertype, phone_number=None, full_name=None)
             VALUES (?, ?, ?, ?, ?)
         """, (telegram_id, username, usertype, phone_number, full_name))
     conn.commit()
+    invalidate_context()
     conn.close()
 
 def get_user(telegram_id):
+    return cached('user', telegram_id, _load_user)
+
+def _load_user(telegram_id):
     conn = get_db_connection()
     cursor = conn.cursor()
     if IS_POSTGRES:
@@ -1265,6 +911,7 @@ def update_user_info(telegram_id, phone_number=None, full_name=None):
         cursor.execute(query, params)
     
     conn.commit()
+    invalidate_context()
     conn.close()
 
 def is_bot_admin(telegram_id):
@@ -1285,12 +932,21 @@ def add_seller(telegram_id, username, store_name):
             VALUES (?, ?, ?)
         """, (telegram_id, username, store_name))
     
+    cursor.execute("SELECT SellerID, StoreName FROM Sellers WHERE TelegramID=?", (telegram_id,))
+    seller_id, old_store_name = cursor.fetchone()
     cursor.execute("""
         UPDATE Sellers SET StoreName=?, UserName=?
         WHERE TelegramID=?
     """, (store_name, username, telegram_id))
+    renamed_products = []
+    if old_store_name != store_name:
+        # اسم المتجر مرسوم على بطاقات منتجاته
+        cursor.execute("SELECT ProductID FROM Products WHERE SellerID=?", (seller_id,))
+        renamed_products = [row[0] for row in cursor.fetchall()]
     conn.commit()
+    invalidate_context()
     conn.close()
+    invalidate_product_cards(renamed_products)
 
 def get_seller_by_telegram(telegram_id):
     conn = get_db_connection()
@@ -1342,12 +998,8 @@ def is_seller(telegram_id):
     return seller is not None
 
 def get_user_type(telegram_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT UserType FROM Users WHERE TelegramID=?", (telegram_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result else None
+    user = get_user(telegram_id)
+    return user[3] if user else None
 
 def add_category(seller_id, name):
     conn = get_db_connection()
@@ -1432,6 +1084,17 @@ def update_product(product_id, name=None, description=None, price=None, wholesal
     
     conn.commit()
     conn.close()
+    # الكمية والقسم لا يظهران على بطاقة المنتج
+    if any(v is not None for v in (name, description, price, wholesale_price, image_path)):
+        invalidate_product_cards([product_id])
+
+def invalidate_product_cards(product_ids):
+    """يحذف بطاقات المنتجات المرسومة مسبقاً بعد تعديلها (المفتاح يتغير على أي حال، هذا لتحرير المساحة)"""
+    cache = receipt_generator.product_card_cache
+    if cache is None:
+        return
+    for product_id in product_ids:
+        cache.invalidate(f"p{product_id}")
 
 def get_products(seller_id=None, category_id=None):
     conn = get_db_connection()
@@ -1496,36 +1159,6 @@ def get_customer_by_phone_for_seller(phone_number, seller_id):
     conn.close()
     return customer
 
-def add_credit_transaction(customer_id, seller_id, amount, description):
-    """إضافة معاملة ائتمانية للزبون"""
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # الحصول على الرصيد الحالي
-        current_balance = get_customer_balance(customer_id, seller_id)
-        new_balance = current_balance + amount
-        
-        if IS_POSTGRES:
-            cursor.execute("""
-                INSERT INTO CustomerCredit (CustomerID, SellerID, TransactionType, Amount, Description, BalanceBefore, BalanceAfter)
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-            """, (customer_id, seller_id, 'Purchase', amount, description, current_balance, new_balance))
-        else:
-            cursor.execute("""
-                INSERT INTO CustomerCredit (CustomerID, SellerID, TransactionType, Amount, Description, BalanceBefore, BalanceAfter)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (customer_id, seller_id, 'Purchase', amount, description, current_balance, new_balance))
-        
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        print(f"Error adding credit transaction: {e}")
-        if 'conn' in locals():
-            conn.close()
-        return False
-
 def get_product_by_id(pid):
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -1621,7 +1254,18 @@ def get_cart_items_db(user_id):
     conn.close()
     return items
 
+def stock_shortage_message(shortages):
+    lines = []
+    for shortage in shortages:
+        name = shortage.name or f"#{shortage.product_id}"
+        lines.append(f"• {name}: المطلوب {shortage.requested}، المتوفر {max(shortage.available or 0, 0)}")
+    return "الكمية غير متوفرة:\n" + "\n".join(lines)
+
 def create_order(buyer_id, seller_id, cart_items, delivery_address=None, notes=None, payment_method='cash', fully_paid=False):
+    """
+    إنشاء طلب بعدد ثابت من العبارات مهما كان حجم السلة:
+    حجز المخزون، صف الطلب، كل عناصر الطلب دفعة واحدة، ثم تسجيل الآجل عند الحاجة.
+    """
     conn = get_db_connection()
     cursor = conn.cursor()
     total = 0
@@ -1629,85 +1273,43 @@ def create_order(buyer_id, seller_id, cart_items, delivery_address=None, notes=N
     for pid, qty, price in cart_items:
         total += price * qty
 
-    query = """
-        INSERT INTO Orders (BuyerID, SellerID, Total, DeliveryAddress, Notes, PaymentMethod, FullyPaid) 
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    """
-    if IS_POSTGRES:
-        query += " RETURNING OrderID"
-    
-    cursor.execute(query, (buyer_id, seller_id, total, delivery_address, notes, payment_method, fully_paid))
-    order_id = cursor.lastrowid
-    
-    # 🛡️ Safe Fallback for Postgres: If CursorWrapper didn't capture ID, try manually
-    if IS_POSTGRES and not order_id:
-        try:
-            res = cursor.fetchone()
-            if res:
-                order_id = res[0]
-                print(f"DEBUG: Retrieved OrderID via fallback fetchone for User {buyer_id}")
-        except Exception as e:
-            print(f"DEBUG: Error in fallback fetchone: {e}")
-
-    # Optimize: Fetch product data using valid transaction cursor to avoid locking/visibility issues
-    # Pre-fetch check or inline check
-    for pid, qty, price in cart_items:
-        # Inline lookup using SAME cursor
-        cursor.execute("SELECT Quantity FROM Products WHERE ProductID = ?", (pid,))
-        res = cursor.fetchone()
-        
-        if not res:
-            print(f"⚠️ Warning: Product {pid} not found during Order {order_id} creation. Skipping Item.")
-            continue
-            
-        current_qty_in_db = res[0]
-        
-        cursor.execute("INSERT INTO OrderItems (OrderID, ProductID, Quantity, Price) VALUES (?, ?, ?, ?)",
-                       (order_id, pid, qty, price))
-                       
-        new_qty = current_qty_in_db - qty
-        if new_qty < 0:
-            new_qty = 0
-        cursor.execute("UPDATE Products SET Quantity=? WHERE ProductID=?", (new_qty, pid))
-    
-    # تسجيل المعاملة في كشف الحساب حسب نوع الزبون وطريقة الدفع
-    buyer_info = get_user(buyer_id)
-    if buyer_info:
-        phone = buyer_info[4]
-        full_name = buyer_info[5]
-        customer = get_credit_customer(seller_id, phone, full_name)
-        if customer:
-            customer_type = customer[4] if len(customer) > 4 else 'CreditCustomer'
-            
-            # تحديد متى نسجل المعاملة:
-            # - زبون آجل: دائماً نسجل إذا كان الدفع آجل
-            # - نقطة بيع: نسجل فقط إذا كان الدفع آجل (لا نسجل إذا كان نقدي)
-            should_record = False
-            if customer_type == 'CreditCustomer':
-                # زبون آجل: نسجل إذا كان الدفع آجل
-                should_record = (payment_method == 'credit' and not fully_paid)
-            elif customer_type == 'PointOfSale':
-                # نقطة بيع: نسجل فقط إذا كان الدفع آجل
-                should_record = (payment_method == 'credit' and not fully_paid)
-            
-            if should_record:
-                # التحقق من الحد الائتماني قبل إتمام الشراء
-                can_purchase, message, max_limit, current_used, remaining = check_credit_limit(customer[0], seller_id, total)
-                if not can_purchase:
-                    # إرجاع الطلب
-                    conn.rollback()
-                    conn.close()
-                    return None, message
-                
-                add_credit_transaction(customer[0], seller_id, 'purchase', total, f"شراء طلب #{order_id}")
-
+    # حجز المخزون لكل المنتجات بعبارة واحدة مشروطة، فلا يمكن أن يُباع أكثر من المتوفر
+    shortages = reserve_stock(conn, [(pid, qty) for pid, qty, price in cart_items])
+    if shortages:
+        conn.rollback()
+        conn.close()
+        return None, stock_shortage_message(shortages)
+
+    order_id = insert_order(cursor, IS_POSTGRES, buyer_id, seller_id, total, delivery_address, notes,
+                            payment_method, fully_paid)
+    insert_order_items(cursor, order_id, cart_items)
+    
+    # تسجيل المعاملة في كشف الحساب: للزبون الآجل ونقطة البيع نسجل فقط إذا كان الدفع آجل
+    if payment_method == 'credit' and not fully_paid:
+        customer = find_buyer_credit_customer(cursor, buyer_id, seller_id)
+        customer_type = (customer[1] or 'CreditCustomer') if customer else None
+        if customer_type in ('CreditCustomer', 'PointOfSale'):
+            # التحقق من الحد الائتماني وتسجيل الشراء في نفس معاملة الطلب
+            try:
+                post_entry(conn, customer[0], seller_id, 'purchase', total, f"شراء طلب #{order_id}",
+                           enforce_limit=True)
+            except CreditLimitExceeded as e:
+                # إرجاع الطلب
+                conn.rollback()
+                conn.close()
+                return None, credit_limit_exceeded_message(e.max_limit, e.current_used)
+
+    # إشعار البائع يُرسل في الخلفية، فيصل المشتري تأكيد الطلب مباشرة
+    jobs.enqueue('notify_seller', {'order_id': order_id, 'buyer_id': buyer_id, 'seller_id': seller_id},
+                 cursor=cursor, idempotency_key=f"notify_seller:{order_id}")
     conn.commit()
     conn.close()
-    
-    notify_seller_of_order(order_id, buyer_id, seller_id)
     return order_id, total
 
 def get_seller_by_telegram(telegram_id):
+    return cached('seller', telegram_id, _load_seller_by_telegram)
+
+def _load_seller_by_telegram(telegram_id):
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM Sellers WHERE TelegramID = ?", (telegram_id,))
@@ -2012,8 +1614,9 @@ def send_privacy_instructions(message, user_id):
         except:
             pass
 
-def notify_seller_of_order(order_id, buyer_id, seller_id):
-    """إرسال إشعار للبائع عن الطلب الجديد"""
+@outbound_priority(PRIORITY_CRITICAL)
+def notify_seller_of_order(order_id, buyer_id, seller_id, record=True):
+    """إرسال إشعار للبائع عن الطلب الجديد (record=False عند إعادة المحاولة حتى لا تتكرر الرسالة في السجل)"""
     order_details, items = get_order_details(order_id)
     
     if not order_details:
@@ -2069,23 +1672,20 @@ def notify_seller_of_order(order_id, buyer_id, seller_id):
     markup.add(types.InlineKeyboardButton("الرئيسية 🏠", callback_data="seller_main_menu"))
     
     # Save full details to Messages table (for history)
-    create_message(order_id, seller_id, 'new_order', full_notification)
+    if record:
+        create_message(order_id, seller_id, 'new_order', full_notification)
     
     try:
         # 🎨 Try to generate Receipt Image
         try:
-            # Force Reload to ensure latest changes (Development Mode)
-            import importlib
-            import utils.receipt_generator
-            importlib.reload(utils.receipt_generator)
-            from utils.receipt_generator import generate_order_card
-            
-            receipt_img = generate_order_card(order_details, items, buyer_name, buyer_phone, store_name)
+            # يُرسم مرة لكل نسخة من الطلب (انظر receipt_generator.order_card_key)
+            receipt_img = receipt_generator.generate_order_card(order_details, items, buyer_name, buyer_phone, store_name)
             
             if receipt_img:
                 receipt_img.name = f"receipt_{order_id}.png"
                 # Use Short Caption with Image AND Buttons
-                bot.send_photo(seller_telegram_id, receipt_img, caption=short_caption, reply_markup=markup, parse_mode='Markdown')
+                media.send_photo(bot, seller_telegram_id, receipt_img, variant='order_card',
+                                 caption=short_caption, reply_markup=markup, parse_mode='Markdown')
                 print(f"✅ Sent Visual Receipt for Order #{order_id}")
                 return # Stop here if image sent successfully
         except ImportError:
@@ -2097,10 +1697,49 @@ def notify_seller_of_order(order_id, buyer_id, seller_id):
         bot.send_message(seller_telegram_id, full_notification, reply_markup=markup, parse_mode='Markdown')
     except Exception as e:
         print(f"⚠️ تعذر إرسال إشعار للبائع {seller_telegram_id}: {e}")
+        raise
+
+def _raise_permanent(e):
+    """البائع/المشتري حظر البوت أو المحادثة غير موجودة: لا فائدة من إعادة المحاولة"""
+    if isinstance(e, telebot.apihelper.ApiTelegramException) and e.error_code in (400, 403):
+        raise PermanentJobError(str(e)) from e
+    raise e
+
+@jobs.handler('notify_seller')
+def notify_seller_job(job):
+    try:
+        notify_seller_of_order(job.payload['order_id'], job.payload['buyer_id'], job.payload['seller_id'],
+                               record=job.attempts == 1)
+    except Exception as e:
+        _raise_permanent(e)
+
+@jobs.handler('notify_buyer_status')
+def notify_buyer_status_job(job):
+    order_id = job.payload['order_id']
+    order_info, _ = get_order_details(order_id)
+    if not order_info:
+        return
+    try:
+        with outbound_priority(PRIORITY_CRITICAL):
+            bot.send_message(order_info[1], f"🔔 تحديث حالة الطلب #{order_id}:\n{job.payload['text']}")
+    except Exception as e:
+        _raise_permanent(e)
 
         
 # ===================== بوت التليجرام ====================
-user_states = {}
+# حالات المحادثة: ذاكرة محدودة الحجم مع انتهاء صلاحية، وتُحفظ في قاعدة البيانات حتى تبقى بعد إعادة التشغيل
+# STATE_BACKEND=memory لإبقائها في الذاكرة فقط
+STATE_TTL_SECONDS = int(os.environ.get('STATE_TTL_SECONDS', str(24 * 3600)))
+STATE_MAX_ENTRIES = int(os.environ.get('STATE_MAX_ENTRIES', '10000'))
+if os.environ.get('STATE_BACKEND', 'db') == 'memory':
+    _state_backend = MemoryStateBackend()
+else:
+    _state_backend = SQLStateBackend(_new_pooled_connection)
+
+user_states = StateStore('user_states', _state_backend, ttl=STATE_TTL_SECONDS, max_entries=STATE_MAX_ENTRIES)
+# خطوات register_next_step_handler المعلّقة تُحفظ بنفس الطريقة
+bot.next_step_backend = StateHandlerBackend(
+    StateStore('next_step', _state_backend, ttl=STATE_TTL_SECONDS, max_entries=STATE_MAX_ENTRIES))
 carts = {}
 
 def save_photo_from_message(message):
@@ -2119,38 +1758,11 @@ def save_photo_from_message(message):
         with open(path, "wb") as f:
             f.write(downloaded)
             
-        # 🟢 SYNC SUPPORT: Save to Postgres Blob Storage
+        # 🟢 SYNC SUPPORT: Save to Postgres Blob Storage (في الخلفية، لا ينتظرها المستخدم)
         if IS_POSTGRES:
-            try:
-                # bot.send_message(message.chat.id, "🔍 Debug: Attempting Cloud Upload...")
-                import psycopg2 
-                conn_pg = get_db_connection()
-                # Unwrap DBWrapper
-                raw_conn = conn_pg.conn 
-                cur_pg = raw_conn.cursor()
-                
-                # Verify table exists
-                cur_pg.execute("CREATE TABLE IF NOT EXISTS ImageStorage (FileName TEXT PRIMARY KEY, FileData BYTEA, UpdatedAt TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
-                
-                cur_pg.execute(
-                    "INSERT INTO ImageStorage (FileName, FileData) VALUES (%s, %s) ON CONFLICT (FileName) DO NOTHING",
-                    (filename, psycopg2.Binary(downloaded))
-                )
-                raw_conn.commit()
-                raw_conn.close()
-                print(f"✅ [Sync] Saved image {filename} to Cloud DB")
-                # bot.send_message(message.chat.id, "✅ Debug: Cloud Upload Success!")
-            except Exception as pg_e:
-                error_msg = f"⚠️ [Sync] Cloud Upload Failed: {pg_e}"
-                print(error_msg)
-                try:
-                    bot.send_message(message.chat.id, error_msg)
-                except: pass
+            jobs.enqueue('upload_image', {'filename': filename}, idempotency_key=f"upload_image:{filename}")
         else:
              print("⚠️ [Sync] IS_POSTGRES is False. Skipping Cloud Upload.")
-             # try:
-             #    bot.send_message(message.chat.id, "⚠️ Debug: IS_POSTGRES is False. Database URL ignored?")
-             # except: pass
         
         return path
     except Exception as e:
@@ -2158,6 +1770,34 @@ def save_photo_from_message(message):
         traceback.print_exc()
         return None
 
+@jobs.handler('upload_image')
+def upload_image_job(job):
+    """نسخة احتياطية من الصورة في جدول ImageStorage (Postgres) حتى تبقى بعد إعادة النشر"""
+    filename = job.payload['filename']
+    path = os.path.join(IMAGES_FOLDER, filename)
+    if not os.path.exists(path):
+        raise PermanentJobError(f"{path} no longer exists")
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    import psycopg2
+    conn_pg = get_db_connection()
+    try:
+        # Unwrap DBWrapper
+        raw_conn = conn_pg.conn
+        cur_pg = raw_conn.cursor()
+        # Verify table exists
+        cur_pg.execute("CREATE TABLE IF NOT EXISTS ImageStorage (FileName TEXT PRIMARY KEY, FileData BYTEA, UpdatedAt TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
+        cur_pg.execute(
+            "INSERT INTO ImageStorage (FileName, FileData) VALUES (%s, %s) ON CONFLICT (FileName) DO NOTHING",
+            (filename, psycopg2.Binary(data))
+        )
+        raw_conn.commit()
+    finally:
+        # Return the connection to the pool instead of closing it
+        conn_pg.close()
+    print(f"✅ [Sync] Saved image {filename} to Cloud DB")
+
 def get_bot_info():
     """الحصول على معلومات البوت"""
     try:
@@ -2204,8 +1844,7 @@ def send_product_with_image(chat_id, product, markup=None, seller_name=""):
         
         # 1. Try to Generate Product Card
         try:
-            from utils.receipt_generator import generate_product_card
-            card_img = generate_product_card(product, seller_name)
+            card_img = receipt_generator.generate_product_card(product, seller_name)
             
             if card_img:
                 card_img.name = f"product_{pid}.png"
@@ -2213,7 +1852,8 @@ def send_product_with_image(chat_id, product, markup=None, seller_name=""):
                 # We still show Quantity as it might not be on card, and maybe a brief text copy
                 caption = f"📦 **{name}**\n📦 المتوفر: {qty}"
                 
-                bot.send_photo(chat_id, card_img, caption=caption, reply_markup=markup, parse_mode='Markdown')
+                media.send_photo(bot, chat_id, card_img, variant='product_card',
+                                 caption=caption, reply_markup=markup, parse_mode='Markdown')
                 return
         except Exception as e:
             print(f"⚠️ Product Card Generation Failed: {e}")
@@ -2235,8 +1875,7 @@ def send_product_with_image(chat_id, product, markup=None, seller_name=""):
             # 1. Check direct path
             if os.path.exists(img_path):
                 try:
-                    with open(img_path, 'rb') as photo:
-                        bot.send_photo(chat_id, photo, caption=caption, reply_markup=markup, parse_mode='Markdown')
+                    media.send_photo(bot, chat_id, img_path, caption=caption, reply_markup=markup, parse_mode='Markdown')
                     return
                 except Exception as e:
                     print(f"⚠️ Error sending image from direct path {img_path}: {e}")
@@ -2251,8 +1890,7 @@ def send_product_with_image(chat_id, product, markup=None, seller_name=""):
             
             if os.path.exists(alt_path):
                 try:
-                    with open(alt_path, 'rb') as photo:
-                        bot.send_photo(chat_id, photo, caption=caption, reply_markup=markup, parse_mode='Markdown')
+                    media.send_photo(bot, chat_id, alt_path, caption=caption, reply_markup=markup, parse_mode='Markdown')
                     return
                 except Exception as e:
                     print(f"⚠️ Error sending image from alt path {alt_path}: {e}")
@@ -2274,23 +1912,38 @@ def create_product_markup_with_qty(product_id, current_qty=1, is_admin_store=Fal
     
     # Quantity Control Row
     markup.row(
-        types.InlineKeyboardButton("➖", callback_data=f"qty_dec_{product_id}_{current_qty}"),
+        types.InlineKeyboardButton("➖", callback_data=encode_callback('qty_dec', product_id, current_qty)),
         types.InlineKeyboardButton(f"{current_qty}", callback_data="noop"),
-        types.InlineKeyboardButton("➕", callback_data=f"qty_inc_{product_id}_{current_qty}")
+        types.InlineKeyboardButton("➕", callback_data=encode_callback('qty_inc', product_id, current_qty))
     )
     # Add to Cart Button with Quantity
-    markup.add(types.InlineKeyboardButton(f"🛒 أضف {current_qty} للسلة", callback_data=f"addtocart_{product_id}_{current_qty}"))
+    markup.add(types.InlineKeyboardButton(f"🛒 أضف {current_qty} للسلة", callback_data=encode_callback('add_to_cart', product_id, current_qty)))
     print(f"DEBUG: Created Markup for PID {product_id}, Qty {current_qty}. Encoded: {markup.to_json()}")
     return markup
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("qty_"))
 def handle_qty_update(call):
+    # أزرار قديمة بالصيغة النصية qty_{inc|dec}_{pid}_{qty}
     try:
         parts = call.data.split("_")
         action = parts[1] # inc or dec
         product_id = int(parts[2])
         current_qty = int(parts[3])
-        
+    except (IndexError, ValueError):
+        bot.answer_callback_query(call.id, "حدث خطأ")
+        return
+    update_product_qty(call, action, product_id, current_qty)
+
+@callback_action(bot, 'qty_inc')
+def handle_qty_inc(call, product_id, current_qty):
+    update_product_qty(call, "inc", product_id, current_qty)
+
+@callback_action(bot, 'qty_dec')
+def handle_qty_dec(call, product_id, current_qty):
+    update_product_qty(call, "dec", product_id, current_qty)
+
+def update_product_qty(call, action, product_id, current_qty):
+    try:
         new_qty = current_qty
         if action == "inc":
             new_qty += 1
@@ -2309,7 +1962,7 @@ def handle_qty_update(call):
         
         bot.answer_callback_query(call.id)
     except Exception as e:
-        print(f"Error in handle_qty_update: {e}")
+        print(f"Error in update_product_qty: {e}")
         bot.answer_callback_query(call.id, "حدث خطأ")
 
 # ====== دالة لعرض عناصر السلة مع الصور ======
@@ -2325,11 +1978,10 @@ def send_cart_item_with_image(chat_id, cart_item, markup=None):
         
         if img_path and os.path.exists(img_path):
             try:
-                with open(img_path, 'rb') as photo:
-                    if markup:
-                        bot.send_photo(chat_id, photo, caption=caption, reply_markup=markup, parse_mode='Markdown')
-                    else:
-                        bot.send_photo(chat_id, photo, caption=caption, parse_mode='Markdown')
+                if markup:
+                    media.send_photo(bot, chat_id, img_path, caption=caption, reply_markup=markup, parse_mode='Markdown')
+                else:
+                    media.send_photo(bot, chat_id, img_path, caption=caption, parse_mode='Markdown')
             except Exception as e:
                 print(f"⚠️ خطأ في إرسال صورة السلة: {e}")
                 if markup:
@@ -2831,12 +2483,6 @@ def handle_seller_orders_menu(message):
             
             # 🎨 Generate Visual Card using the new REV 11 logic
             try:
-                # Force Reload for Dev
-                import importlib
-                import utils.receipt_generator
-                importlib.reload(utils.receipt_generator)
-                from utils.receipt_generator import generate_order_card
-
                 # Generator expects: (order_details, items, buyer_name, buyer_phone, store_name)
                 # handle_seller_orders_menu has: oid, total, status, date, buyer, phone, pay_method, address
                 # store_name comes from 'seller' tuple index 3
@@ -2875,12 +2521,12 @@ def handle_seller_orders_menu(message):
                     gen_items.append(tuple(mock_item))
                 
                 # Generate
-                card_img = generate_order_card(mock_order_details, gen_items, buyer, phone, seller[3])
+                card_img = receipt_generator.generate_order_card(mock_order_details, gen_items, buyer, phone, seller[3])
                 
                 if card_img:
                     card_img.name = f"card_{oid}.png"
                     # Send Image Card
-                    bot.send_photo(message.chat.id, card_img, reply_markup=markup)
+                    media.send_photo(bot, message.chat.id, card_img, variant='order_card', reply_markup=markup)
                 else:
                     # Fallback to text if generation fails
                     raise Exception("Image generation returned None")
@@ -3044,6 +2690,7 @@ def process_user_store_name(message):
     else:
         cursor.execute("UPDATE Users SET UserType = 'seller' WHERE TelegramID = ?", (user_id,))
     conn.commit()
+    invalidate_context()
     conn.close()
     
     bot.send_message(message.chat.id,
@@ -3138,7 +2785,7 @@ def system_stats(message):
     total_sales = cursor.fetchone()[0] or 0
     
     # إحصائيات الائتمان
-    cursor.execute("SELECT SUM(BalanceAfter) FROM CustomerCredit")
+    cursor.execute("SELECT SUM(Balance) FROM CustomerBalances")
     total_credit = cursor.fetchone()[0] or 0
     
     # إحصائيات الزبائن الآجلين
@@ -3858,6 +3505,7 @@ def handle_do_delete_store(call):
         cursor.execute("DELETE FROM CreditCustomers WHERE SellerID = ?", (store_id,))
         cursor.execute("DELETE FROM Sellers WHERE SellerID = ?", (store_id,))
         conn.commit()
+        invalidate_context()
         bot.answer_callback_query(call.id, "✅ تم حذف المتجر بنجاح")
         bot.delete_message(call.message.chat.id, call.message.message_id)
         bot.send_message(call.message.chat.id, "✅ **تم حذف المتجر وجميع بياناته بنجاح.**")
@@ -4850,7 +4498,7 @@ def view_my_products(message):
                 pid = product[0]
                 name = product[1]
                 price = product[3]
-                markup.add(types.InlineKeyboardButton(f"📦 {name} - {price}", callback_data=f"view_prod_{pid}"))
+                markup.add(types.InlineKeyboardButton(f"📦 {name} - {price}", callback_data=encode_callback('view_product', pid)))
     
     # Add Control Buttons (Always Visible)
     markup.row(
@@ -4869,8 +4517,17 @@ def view_my_products(message):
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("view_prod_"))
 def handle_view_product_detail(call):
+    # أزرار قديمة بالصيغة النصية view_prod_{pid}
     try:
         product_id = int(call.data.split("_")[2])
+    except (IndexError, ValueError):
+        bot.answer_callback_query(call.id, "حدث خطأ أثناء عرض المنتج")
+        return
+    view_product(call, product_id)
+
+@callback_action(bot, 'view_product')
+def view_product(call, product_id):
+    try:
         # Direct DB Call (Tuple)
         product = get_product_by_id(product_id)
         
@@ -4924,11 +4581,11 @@ def handle_view_product_detail(call):
             # Always allow buying, even from Admin store
             # Reuse logic from create_product_markup_with_qty
             markup.row(
-                types.InlineKeyboardButton("➖", callback_data=f"qty_dec_{pid}_1"),
+                types.InlineKeyboardButton("➖", callback_data=encode_callback('qty_dec', pid, 1)),
                 types.InlineKeyboardButton("1", callback_data="noop"),
-                types.InlineKeyboardButton("➕", callback_data=f"qty_inc_{pid}_1")
+                types.InlineKeyboardButton("➕", callback_data=encode_callback('qty_inc', pid, 1))
             )
-            markup.add(types.InlineKeyboardButton(f"🛒 أضف 1 للسلة", callback_data=f"addtocart_{pid}_1"))
+            markup.add(types.InlineKeyboardButton(f"🛒 أضف 1 للسلة", callback_data=encode_callback('add_to_cart', pid, 1)))
 
         markup.add(types.InlineKeyboardButton("🔙 رجوع للقائمة", callback_data="back_to_prod_list"))
 
@@ -4958,8 +4615,8 @@ def handle_view_product_detail(call):
 
         if final_img_path:
             try:
-                with open(final_img_path, 'rb') as photo:
-                    bot.send_photo(call.message.chat.id, photo, caption=text, parse_mode='Markdown', reply_markup=markup)
+                media.send_photo(bot, call.message.chat.id, final_img_path, caption=text, parse_mode='Markdown',
+                                 reply_markup=markup)
             except Exception as img_error:
                 print(f"⚠️ Error sending photo for product {pid}: {img_error}")
                 bot.send_message(call.message.chat.id, text, parse_mode='Markdown', reply_markup=markup)
@@ -4986,7 +4643,7 @@ def handle_delete_product_direct(call):
         markup = types.InlineKeyboardMarkup()
         markup.add(
             types.InlineKeyboardButton("✅ نعم، احذف", callback_data=f"confirm_delete_prod_{product_id}"),
-            types.InlineKeyboardButton("❌ إلغاء", callback_data=f"view_prod_{product_id}")
+            types.InlineKeyboardButton("❌ إلغاء", callback_data=encode_callback('view_product', product_id))
         )
         # Handle different message types (Photo vs Text)
         if call.message.content_type == 'photo':
@@ -5862,6 +5519,7 @@ def handle_confirm_delete_credit_customer(call):
         
         # حذف البيانات المرتبطة بالزبون
         cursor.execute("DELETE FROM CustomerCredit WHERE CustomerID=?", (customer_id,))
+        delete_balances(cursor, customer_id)
         cursor.execute("DELETE FROM CreditLimits WHERE CustomerID=?", (customer_id,))
         cursor.execute("DELETE FROM CreditCustomers WHERE CustomerID=? AND SellerID=?", (customer_id, seller[0]))
         conn.commit()
@@ -6084,10 +5742,11 @@ def handle_view_customer_statement(call):
         trans_type_arabic = {
             'purchase': 'شراء',
             'payment': 'دفعة',
+            'refund': 'استرجاع',
             'adjustment': 'تعديل'
         }.get(trans_type, trans_type)
         
-        emoji = "🛒" if trans_type == 'purchase' else "💰" if trans_type == 'payment' else "📝"
+        emoji = "🛒" if trans_type == 'purchase' else "💰" if trans_type in ('payment', 'refund') else "📝"
         
         text += f"{emoji} **{trans_type_arabic}**\n"
         text += f"📅 {trans_date}\n"
@@ -6303,10 +5962,11 @@ def handle_view_my_statement(call):
         trans_type_arabic = {
             'purchase': 'شراء',
             'payment': 'دفعة',
+            'refund': 'استرجاع',
             'adjustment': 'تعديل'
         }.get(trans_type, trans_type)
         
-        emoji = "🛒" if trans_type == 'purchase' else "💰" if trans_type == 'payment' else "📝"
+        emoji = "🛒" if trans_type == 'purchase' else "💰" if trans_type in ('payment', 'refund') else "📝"
         
         text += f"{emoji} **{trans_type_arabic}**\n"
         text += f"📅 {trans_date}\n"
@@ -6402,7 +6062,12 @@ def handle_delete_order(call):
         print(f"Error deleting order: {e}")
         bot.answer_callback_query(call.id, f"خطأ: {str(e)[:50]}", show_alert=True)
 
-@bot.callback_query_handler(func=lambda call: True)
+# أزرار الصيغة المضغوطة (utils/callbacks) لها معالجاتها الخاصة حسب رمز الإجراء
+@bot.callback_query_handler(func=lambda call: is_encoded(call.data) and decode_call(call) is None)
+def stale_callback_handler(call):
+    bot.answer_callback_query(call.id, "⚠️ هذا الزر قديم، يرجى فتح القائمة من جديد")
+
+@bot.callback_query_handler(func=lambda call: not is_encoded(call.data))
 def callback_handler(call):
     try:
         # تخطي معالجات الزبائن الآجلين لأنها موجودة كمعالجات منفصلة
@@ -6791,7 +6456,7 @@ def send_store_catalog_by_telegram_id(chat_id, seller_telegram_id, customer_tele
     else:
         markup = types.InlineKeyboardMarkup(row_width=2)
         for cat_id, cat_name in categories:
-            markup.add(types.InlineKeyboardButton(cat_name, callback_data=f"viewcat_{cat_id}_{seller_id}"))
+            markup.add(types.InlineKeyboardButton(cat_name, callback_data=encode_callback('view_category', cat_id, seller_id)))
         
         seller_display = format_seller_mention(username, seller_id)
         bot.send_message(chat_id, 
@@ -6838,7 +6503,7 @@ def browse_stores(message):
                 label = f"🏪 {store_name} - {format_seller_mention(username, telegram_id)}"
                 markup.add(types.InlineKeyboardButton(
                     label, 
-                    callback_data=f"viewstore_{telegram_id}"
+                    callback_data=encode_callback('view_store', telegram_id)
                 ))
             except Exception as e:
                 print(f"Skipping bad store: {e}")
@@ -6872,14 +6537,23 @@ def browse_stores(message):
             label = f"🏪 {store_name} - {format_seller_mention(username, telegram_id)}"
             markup.add(types.InlineKeyboardButton(
                 label, 
-                callback_data=f"viewstore_{telegram_id}"
+                callback_data=encode_callback('view_store', telegram_id)
             ))
         
         bot.send_message(message.chat.id, "🛍️ **المتاجر المتاحة:**", reply_markup=markup)
 
 def handle_view_store(call):
+    # أزرار قديمة بالصيغة النصية viewstore_{telegram_id}
     try:
         telegram_id = int(call.data.split("_")[1])
+    except (IndexError, ValueError):
+        bot.answer_callback_query(call.id, "خطأ في عرض المتجر")
+        return
+    view_store(call, telegram_id)
+
+@callback_action(bot, 'view_store')
+def view_store(call, telegram_id):
+    try:
         customer_telegram_id = call.from_user.id
         send_store_catalog_by_telegram_id(call.message.chat.id, telegram_id, customer_telegram_id)
         bot.answer_callback_query(call.id)
@@ -6964,6 +6638,7 @@ def handle_toggle_store_registration(call):
             """, (new_value, seller_id))
         
         conn.commit()
+        invalidate_context()
         
         # الحصول على اسم المتجر
         if IS_POSTGRES:
@@ -7007,11 +6682,19 @@ def handle_back_to_stores_list(call):
         bot.answer_callback_query(call.id)
 
 def handle_view_category(call):
+    # أزرار قديمة بالصيغة النصية viewcat_{cat_id}_{seller_id}
     try:
         parts = call.data.split("_")
         category_id = int(parts[1])
         seller_id = int(parts[2])
-        
+    except (IndexError, ValueError):
+        bot.answer_callback_query(call.id, "حدث خطأ")
+        return
+    view_category(call, category_id, seller_id)
+
+@callback_action(bot, 'view_category')
+def view_category(call, category_id, seller_id):
+    try:
         category = get_category_by_id(category_id)
         if not category:
             bot.answer_callback_query(call.id, "القسم غير موجود")
@@ -7058,7 +6741,7 @@ def handle_view_category(call):
         
         bot.answer_callback_query(call.id)
     except Exception as e:
-        print(f"Error in handle_view_category: {e}")
+        print(f"Error in view_category: {e}")
         bot.answer_callback_query(call.id, "حدث خطأ")
 
 def handle_select_images(call):
@@ -7189,6 +6872,29 @@ def handle_buy_images(call):
         # حساب المبلغ الإجمالي
         total_amount = price * quantity
         
+        # حجز الكمية وتسجيل المبلغ في معاملة واحدة تُحفظ قبل الإرسال، حتى لا تبقى أقفال المخزون
+        # والرصيد مفتوحة أثناء رفع الصور؛ إذا فشل إرسال كل الصور تُلغى بمعاملة عكسية
+        conn = get_db_connection()
+        shortages = reserve_stock(conn, [(product_id, quantity)])
+        if shortages:
+            conn.rollback()
+            conn.close()
+            bot.answer_callback_query(call.id, f"⚠️ الكمية المتاحة فقط {max(shortages[0].available or 0, 0)} صورة")
+            return
+        
+        description = f"شراء {quantity} صورة من منتج: {product_name}"
+        try:
+            post_entry(conn, customer_id, seller_id, 'purchase', total_amount, description)
+        except Exception as e:
+            print(f"Error adding credit transaction: {e}")
+            conn.rollback()
+            conn.close()
+            bot.answer_callback_query(call.id, "❌ فشل إضافة المبلغ للحساب")
+            return
+        conn.commit()
+        conn.close()
+        commit_session()
+        
         # إرسال الصور للمستخدم
         sent_images = []
         for i in range(quantity):
@@ -7197,67 +6903,62 @@ def handle_buy_images(call):
             # محاولة إرسال الصورة
             try:
                 if os.path.exists(image_path):
-                    with open(image_path, 'rb') as photo:
-                        bot.send_photo(telegram_id, photo)
-                        sent_images.append(image_path)
+                    media.send_photo(bot, telegram_id, image_path)
+                    sent_images.append(image_path)
                 elif IS_POSTGRES:
                     # محاولة تحميل من السحابة
                     base_name = os.path.basename(image_path)
                     if download_image_from_cloud(base_name):
                         alt_path = os.path.join(IMAGES_FOLDER, base_name)
                         if os.path.exists(alt_path):
-                            with open(alt_path, 'rb') as photo:
-                                bot.send_photo(telegram_id, photo)
-                                sent_images.append(base_name)
+                            media.send_photo(bot, telegram_id, alt_path)
+                            sent_images.append(base_name)
             except Exception as e:
                 print(f"Error sending image {i+1}: {e}")
         
         if not sent_images:
+            # لم تصل أي صورة: إرجاع الكمية وقيد استرجاع بنفس المبلغ
+            conn = get_db_connection()
+            try:
+                release_stock(conn, [(product_id, quantity)])
+                post_entry(conn, customer_id, seller_id, 'refund', total_amount, f"إلغاء {description}: فشل إرسال الصور")
+                conn.commit()
+            except Exception as e:
+                print(f"Error undoing image purchase: {e}")
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
             bot.answer_callback_query(call.id, "❌ فشل إرسال الصور")
             return
         
-        # إضافة المبلغ لحساب الزبون
-        description = f"شراء {quantity} صورة من منتج: {product_name}"
-        if add_credit_transaction(customer_id, seller_id, total_amount, description):
-            # تحديث كمية المنتج
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            if IS_POSTGRES:
-                cursor.execute("UPDATE Products SET Quantity = Quantity - %s WHERE ProductID = %s", (quantity, product_id))
-            else:
-                cursor.execute("UPDATE Products SET Quantity = Quantity - ? WHERE ProductID = ?", (quantity, product_id))
-            conn.commit()
-            conn.close()
+        # إرسال رسالة للمستخدم
+        bot.send_message(telegram_id,
+            f"✅ **تم الشراء بنجاح!**\n\n"
+            f"📦 المنتج: {product_name}\n"
+            f"📸 عدد الصور: {quantity}\n"
+            f"💰 المبلغ: {total_amount:,.0f} د.ع\n\n"
+            f"تم إضافة المبلغ إلى حسابك الآجل.",
+            parse_mode='Markdown')
+        
+        # إرسال إشعار للبائع
+        seller = get_seller_by_id(seller_id)
+        if seller:
+            seller_telegram_id = seller[1]
+            images_list = "\n".join([f"• {os.path.basename(img)}" for img in sent_images])
             
-            # إرسال رسالة للمستخدم
-            bot.send_message(telegram_id,
-                f"✅ **تم الشراء بنجاح!**\n\n"
+            bot.send_message(seller_telegram_id,
+                f"🛒 **طلب شراء صور**\n\n"
+                f"👤 الزبون: {customer_name}\n"
+                f"📱 الهاتف: {customer_phone}\n\n"
                 f"📦 المنتج: {product_name}\n"
                 f"📸 عدد الصور: {quantity}\n"
                 f"💰 المبلغ: {total_amount:,.0f} د.ع\n\n"
-                f"تم إضافة المبلغ إلى حسابك الآجل.",
+                f"📸 الصور المشتراة:\n{images_list}\n\n"
+                f"✅ تم إضافة المبلغ {total_amount:,.0f} د.ع إلى حساب الزبون.",
                 parse_mode='Markdown')
-            
-            # إرسال إشعار للبائع
-            seller = get_seller_by_id(seller_id)
-            if seller:
-                seller_telegram_id = seller[1]
-                images_list = "\n".join([f"• {os.path.basename(img)}" for img in sent_images])
-                
-                bot.send_message(seller_telegram_id,
-                    f"🛒 **طلب شراء صور**\n\n"
-                    f"👤 الزبون: {customer_name}\n"
-                    f"📱 الهاتف: {customer_phone}\n\n"
-                    f"📦 المنتج: {product_name}\n"
-                    f"📸 عدد الصور: {quantity}\n"
-                    f"💰 المبلغ: {total_amount:,.0f} د.ع\n\n"
-                    f"📸 الصور المشتراة:\n{images_list}\n\n"
-                    f"✅ تم إضافة المبلغ {total_amount:,.0f} د.ع إلى حساب الزبون.",
-                    parse_mode='Markdown')
-            
-            bot.answer_callback_query(call.id, f"✅ تم إرسال {len(sent_images)} صورة")
-        else:
-            bot.answer_callback_query(call.id, "❌ فشل إضافة المبلغ للحساب")
+        
+        bot.answer_callback_query(call.id, f"✅ تم إرسال {len(sent_images)} صورة")
     except Exception as e:
         print(f"Error in handle_buy_images: {e}")
         import traceback
@@ -7293,6 +6994,7 @@ def add_product_image_db(product_id, image_path, image_order=0):
         conn.commit()
         image_id = cursor.lastrowid
         conn.close()
+        invalidate_product_cards([product_id])
         return image_id
     except Exception as e:
         print(f"Error adding product image: {e}")
@@ -7535,18 +7237,26 @@ def handle_delete_product_image(call):
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("addtocart_"))
 def handle_add_to_cart(call):
+    # أزرار قديمة بالصيغة النصية addtocart_{pid}_{qty}
     try:
         parts = call.data.split("_")
         product_id = int(parts[1])
-        
-        # New: Parse quantity if present, default to 1
-        quantity = 1
-        if len(parts) > 2:
-            try:
-                quantity = int(parts[2])
-            except:
-                pass
-        
+    except (IndexError, ValueError):
+        bot.answer_callback_query(call.id, "حدث خطأ")
+        return
+
+    # New: Parse quantity if present, default to 1
+    quantity = 1
+    if len(parts) > 2:
+        try:
+            quantity = int(parts[2])
+        except:
+            pass
+    add_product_to_cart(call, product_id, quantity)
+
+@callback_action(bot, 'add_to_cart')
+def add_product_to_cart(call, product_id, quantity):
+    try:
         user_id = call.from_user.id
         
         # ====== التعديل: إزالة شرط التحقق من نوع المستخدم ======
@@ -7585,7 +7295,7 @@ def handle_add_to_cart(call):
         bot.answer_callback_query(call.id, f"✅ تم إضافة {quantity}x {product_name} إلى السلة")
         
     except Exception as e:
-        print(f"Error in handle_add_to_cart: {e}")
+        print(f"Error in add_product_to_cart: {e}")
         bot.answer_callback_query(call.id, f"خطأ: {str(e)[:50]}")
 
 # ====== إدارة السلة ======
@@ -7637,10 +7347,10 @@ def view_cart(message, user_id=None):
             # Control Row for this item
             # [ ➖ ] [ Qty ] [ ➕ ] [ 🗑️ ]
             markup.row(
-                types.InlineKeyboardButton("➖", callback_data=f"decrease_cart_{product_id}"),
+                types.InlineKeyboardButton("➖", callback_data=encode_callback('cart_dec', product_id)),
                 types.InlineKeyboardButton(f"{quantity}", callback_data="noop"),
-                types.InlineKeyboardButton("➕", callback_data=f"increase_cart_{product_id}"),
-                types.InlineKeyboardButton("🗑️", callback_data=f"remove_cart_{product_id}")
+                types.InlineKeyboardButton("➕", callback_data=encode_callback('cart_inc', product_id)),
+                types.InlineKeyboardButton("🗑️", callback_data=encode_callback('cart_remove', product_id))
             )
             idx += 1
             
@@ -7686,10 +7396,10 @@ def update_cart_view(chat_id, message_id, user_id):
             cart_text += "   ------------------------\n"
             
             markup.row(
-                types.InlineKeyboardButton("➖", callback_data=f"decrease_cart_{product_id}"),
+                types.InlineKeyboardButton("➖", callback_data=encode_callback('cart_dec', product_id)),
                 types.InlineKeyboardButton(f"{quantity}", callback_data="noop"),
-                types.InlineKeyboardButton("➕", callback_data=f"increase_cart_{product_id}"),
-                types.InlineKeyboardButton("🗑️", callback_data=f"remove_cart_{product_id}")
+                types.InlineKeyboardButton("➕", callback_data=encode_callback('cart_inc', product_id)),
+                types.InlineKeyboardButton("🗑️", callback_data=encode_callback('cart_remove', product_id))
             )
             idx += 1
             
@@ -8240,33 +7950,7 @@ def process_delivery_address(message):
                 browse_without_registration(message)
             return
     else:
-        # للمستخدمين المسجلين (الكود القديم)
-        # التحقق من الحد الائتماني إذا كان الشراء على الحساب
-        if payment_method == 'credit' and not fully_paid:
-            user_info = get_user(telegram_id)
-            if user_info:
-                customer = get_credit_customer(seller_id, user_info[4], user_info[5])
-                if customer:
-                    subtotal = seller_data['subtotal']
-                    can_purchase, message_text, max_limit, current_used, remaining = check_credit_limit(customer[0], seller_id, subtotal)
-                    
-                    if not can_purchase:
-                        bot.send_message(message.chat.id, f"❌ **تعذر إنشاء الطلب:** {message_text}")
-                        # حذف البائع من القائمة ومتابعة مع البائع التالي
-                        del state["items_by_seller"][seller_id]
-                        
-                        if state["items_by_seller"]:
-                            seller_ids = list(state["items_by_seller"].keys())
-                            next_seller_id = seller_ids[0]
-                            next_seller_data = state["items_by_seller"][next_seller_id]
-                            
-                            start_checkout_for_seller(message, telegram_id, next_seller_id, next_seller_data)
-                        else:
-                            del user_states[telegram_id]
-                            show_buyer_main_menu(message)
-                        return
-        
-        # إنشاء الطلب
+        # للمستخدمين المسجلين: create_order يتحقق من الحد الائتماني والمخزون ضمن معاملة الطلب نفسها
         order_id, total = create_order(
             telegram_id, 
             seller_id, 
@@ -8278,7 +7962,7 @@ def process_delivery_address(message):
         )
         
         if order_id is None:
-            # فشل إنشاء الطلب بسبب الحد الائتماني
+            # فشل إنشاء الطلب بسبب الحد الائتماني أو نفاد المخزون
             bot.send_message(message.chat.id, f"❌ **تعذر إنشاء الطلب:** {total}")
             # حذف البائع من القائمة ومتابعة مع البائع التالي
             del state["items_by_seller"][seller_id]
@@ -8295,10 +7979,13 @@ def process_delivery_address(message):
             return
     
     # حذف عناصر هذا البائع من السلة
-    for product_id, quantity, price in seller_data['items']:
+    product_ids = [product_id for product_id, quantity, price in seller_data['items']]
+    if product_ids:
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM Carts WHERE UserID=? AND ProductID=?", (telegram_id, product_id))
+        placeholders = ", ".join(["?"] * len(product_ids))
+        cursor.execute(f"DELETE FROM Carts WHERE UserID=? AND ProductID IN ({placeholders})",
+                       [telegram_id] + product_ids)
         conn.commit()
         conn.close()
     
@@ -8343,57 +8030,25 @@ def create_order_for_guest(buyer_id, seller_id, cart_items, delivery_address=Non
     for pid, qty, price in cart_items:
         total += price * qty
 
+    # حجز المخزون لكل المنتجات بعبارة واحدة مشروطة، فلا يمكن أن يُباع أكثر من المتوفر
+    shortages = reserve_stock(conn, [(pid, qty) for pid, qty, price in cart_items])
+    if shortages:
+        conn.rollback()
+        conn.close()
+        return None, stock_shortage_message(shortages)
+
     # إضافة مستخدم مؤقت للزائر
     temp_user_id = f"guest_{buyer_id}_{int(time.time())}"
     
     # إدراج طلب مع معلومات الزائر
-    query = """
-        INSERT INTO Orders (BuyerID, SellerID, Total, DeliveryAddress, Notes, PaymentMethod, FullyPaid) 
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    """
-    params = (temp_user_id, seller_id, total, delivery_address, f"زائر: {guest_name} - {guest_phone}", payment_method, fully_paid)
-    
-    if IS_POSTGRES:
-        query += " RETURNING OrderID"
-    
-    cursor.execute(query, params)
-    order_id = cursor.lastrowid
-    
-    # 🛡️ Safe Fallback for Postgres
-    if IS_POSTGRES and not order_id:
-        try:
-            res = cursor.fetchone()
-            if res:
-                order_id = res[0]
-                print(f"DEBUG: Retrieved Guest OrderID via fallback fetchone")
-        except Exception as e:
-            print(f"DEBUG: Error in guest fallback fetchone: {e}")
-
-    # Optimize: Fetch product data using valid transaction cursor to avoid locking/visibility issues
-    # Pre-fetch check or inline check
-    for pid, qty, price in cart_items:
-        # Inline lookup using SAME cursor
-        cursor.execute("SELECT Quantity FROM Products WHERE ProductID = ?", (pid,))
-        res = cursor.fetchone()
-        
-        if not res:
-            print(f"⚠️ Warning: Product {pid} not found during Guest Order {order_id} creation. Skipping Item.")
-            continue
-            
-        current_qty_in_db = res[0]
-        
-        cursor.execute("INSERT INTO OrderItems (OrderID, ProductID, Quantity, Price) VALUES (?, ?, ?, ?)",
-                       (order_id, pid, qty, price))
-                       
-        new_qty = current_qty_in_db - qty
-        if new_qty < 0:
-            new_qty = 0
-        cursor.execute("UPDATE Products SET Quantity=? WHERE ProductID=?", (new_qty, pid))
+    order_id = insert_order(cursor, IS_POSTGRES, temp_user_id, seller_id, total, delivery_address,
+                            f"زائر: {guest_name} - {guest_phone}", payment_method, fully_paid)
+    insert_order_items(cursor, order_id, cart_items)
     
+    jobs.enqueue('notify_seller', {'order_id': order_id, 'buyer_id': temp_user_id, 'seller_id': seller_id},
+                 cursor=cursor, idempotency_key=f"notify_seller:{order_id}")
     conn.commit()
     conn.close()
-    
-    notify_seller_of_order(order_id, temp_user_id, seller_id)
     return order_id, total
 
 @bot.callback_query_handler(func=lambda call: call.data == "clear_cart")
@@ -8432,18 +8087,18 @@ def handle_edit_cart_quantities(call):
             
             markup = types.InlineKeyboardMarkup(row_width=3)
             markup.add(
-                types.InlineKeyboardButton("➕", callback_data=f"increase_cart_{product_id}"),
+                types.InlineKeyboardButton("➕", callback_data=encode_callback('cart_inc', product_id)),
                 types.InlineKeyboardButton(f"الكمية: {quantity}", callback_data=f"set_quantity_{product_id}"),
-                types.InlineKeyboardButton("➖", callback_data=f"decrease_cart_{product_id}"),
-                types.InlineKeyboardButton("🗑️ حذف", callback_data=f"remove_cart_{product_id}")
+                types.InlineKeyboardButton("➖", callback_data=encode_callback('cart_dec', product_id)),
+                types.InlineKeyboardButton("🗑️ حذف", callback_data=encode_callback('cart_remove', product_id))
             )
             
             caption = f"🛒 **{name}**\n💰 السعر: {price} IQD\n📦 الكمية: {quantity}\n💰 المجموع: {price * quantity} IQD\n🏪 {seller_name}"
             
             if img_path and os.path.exists(img_path):
                 try:
-                    with open(img_path, 'rb') as photo:
-                        bot.send_photo(call.message.chat.id, photo, caption=caption, reply_markup=markup, parse_mode='Markdown')
+                    media.send_photo(bot, call.message.chat.id, img_path, caption=caption, reply_markup=markup,
+                                     parse_mode='Markdown')
                 except:
                     bot.send_message(call.message.chat.id, caption, reply_markup=markup, parse_mode='Markdown')
             else:
@@ -8456,7 +8111,11 @@ def handle_edit_cart_quantities(call):
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("increase_cart_"))
 def handle_increase_cart(call):
-    product_id = int(call.data.split("_")[2])
+    # أزرار قديمة بالصيغة النصية increase_cart_{pid}
+    increase_cart_item(call, int(call.data.split("_")[2]))
+
+@callback_action(bot, 'cart_inc')
+def increase_cart_item(call, product_id):
     telegram_id = call.from_user.id
     
     cart_items = get_cart_items_db(telegram_id)
@@ -8486,7 +8145,11 @@ def handle_increase_cart(call):
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("decrease_cart_"))
 def handle_decrease_cart(call):
-    product_id = int(call.data.split("_")[2])
+    # أزرار قديمة بالصيغة النصية decrease_cart_{pid}
+    decrease_cart_item(call, int(call.data.split("_")[2]))
+
+@callback_action(bot, 'cart_dec')
+def decrease_cart_item(call, product_id):
     telegram_id = call.from_user.id
     
     cart_items = get_cart_items_db(telegram_id)
@@ -8505,8 +8168,17 @@ def handle_decrease_cart(call):
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith("remove_cart_"))
 def handle_remove_cart(call):
+    # أزرار قديمة بالصيغة النصية remove_cart_{pid}
     try:
         product_id = int(call.data.split("_")[2])
+    except (IndexError, ValueError):
+        bot.answer_callback_query(call.id, "حدث خطأ")
+        return
+    remove_cart_item(call, product_id)
+
+@callback_action(bot, 'cart_remove')
+def remove_cart_item(call, product_id):
+    try:
         telegram_id = call.from_user.id
         
         conn = get_db_connection()
@@ -8585,7 +8257,6 @@ def seller_messages(message):
     print(f"📩 DEBUG: Message handler triggered for '{message.text}' by {message.from_user.id}")
     try:
         telegram_id = message.from_user.id
-        from utils.receipt_generator import generate_order_card # Late import to avoid circular issues
         
         # Double check it is a seller
         if not is_seller(telegram_id):
@@ -8632,114 +8303,12 @@ def seller_messages(message):
 
         bot.send_message(message.chat.id, "📩 **الطلبات والرسائل (Inbox)**")
 
-        for order in orders:
-            oid, total, status, date, buyer, phone, pay_method, address = order
-
-            # --- NEW CARD LOGIC ---
-            from utils.receipt_generator import generate_order_card
-            try:
-                # Use standard function (Safe with LEFT JOIN)
-                order_details_full, items_full = get_order_details(oid)
-
-                receipt_img = None
-                try:
-                    receipt_img = generate_order_card(order_details_full, items_full, buyer, phone, seller[3])
-                    if receipt_img:
-                        receipt_img.name = f"receipt_{oid}.png"
-                except Exception as e:
-                    print(f"Img Gen Error {oid}: {e}")
-
-                clean_date = str(date).split('.')[0]
-                caption = f"📦 طلب #{oid} | 💰 {total:,.0f} IQD\n📅 {clean_date}"
-
-                if receipt_img:
-                    try:
-                        bot.send_photo(message.chat.id, receipt_img, caption=caption, parse_mode='Markdown')
-                    except Exception as e:
-                        bot.send_message(message.chat.id, caption + "\n⚠️ (Img Send Error)", parse_mode='Markdown')
-                else:
-                    bot.send_message(message.chat.id, caption + "\n⚠️ (Img Gen Failed)", parse_mode='Markdown')
-
-            except Exception as e:
-                print(f"Error handling order {oid}: {e}")
-                # Fallback
-                clean_date = str(date).split('.')[0]
-                bot.send_message(message.chat.id, f"📦 طلب #{oid}\n💰 {total:,.0f}\n📅 {clean_date}", parse_mode='Markdown')
-            
-            # Avoid hitting Telegram rate limits (approx 30 msgs/sec, but good to be safe with photos)
-            time.sleep(0.3)
-            continue # Skip legacy text logic below
-            # --- END NEW LOGIC ---
-            
-            # جلب المنتجات للعرض (نستخدم LEFT JOIN لضمان ظهور العناصر حتى لو حذف المنتج الأصلي)
-            cursor.execute("""
-                SELECT p.Name, oi.Quantity, oi.Price, p.ImagePath 
-                FROM OrderItems oi 
-                LEFT JOIN Products p ON oi.ProductID = p.ProductID 
-                WHERE oi.OrderID = ?
-            """, (oid,))
-            items = cursor.fetchall()
-            
-            # تنسيق قائمة المنتجات
-            items_text = ""
-            first_image_path = None
-            
-            if not items:
-                items_text = "" # User requested to remove warning
-            else:
-                for i in items:
-                    p_name = i[0] if i[0] else "منتج محذوف"
-                    p_qty = i[1]
-                    p_price = i[2] if i[2] else 0
-                    p_image = i[3]
-                    
-                    # Capture first image found to use as card cover
-                    if not first_image_path and p_image and os.path.exists(p_image):
-                         first_image_path = p_image
-                    
-                    row_total = p_qty * p_price
-                    items_text += f"▫️ {p_name}\n   {p_qty}x | 💰 {p_price:,.0f} = {row_total:,.0f}\n"
-
-            status_icon = "⏳" if status == 'Pending' else "✅" if status == 'Confirmed' else "🚚" if status == 'Shipped' else "❌" if status == 'Rejected' else ""
-            status_text = "قيد الانتظار" if status == 'Pending' else "تم التأكيد" if status == 'Confirmed' else "تم الشحن" if status == 'Shipped' else "مرفوض" if status == 'Rejected' else status
-
-            # تنسيق البطاقة
-            card_text = f"{status_icon} طلب رقم #{oid}\n"
-            card_text += f"📅 {date}\n\n"
-            
-            # المنتجات
-            if items_text:
-                card_text += f"{items_text}\n"
-            
-            # الإجمالي
-            card_text += f"💰 **الإجمالي: {total:,.0f} IQD**\n"
-            
-            # معلومات العميل
-
-            
-            # معلومات العميل
-            card_text += f"👤 {buyer}\n📞 {phone}\n"
-            if address:
-                card_text += f"📍 {address}\n"
-            
-
-            # Buttons: Removed as per user request (Details only)
-            # markup = types.InlineKeyboardMarkup(row_width=3)
-            # ... buttons removed ...
-            
-            # إرسال الرسالة (صورة أو نص)
-            try:
-                # ملاحظة: في تيليجرام لا يمكن وضع صور صغيرة بجانب كل سطر، لذا سنضع صورة المنتج الأول كغلاف للطلب إذا وجدت
-                if first_image_path:
-                    with open(first_image_path, 'rb') as photo:
-                        bot.send_photo(message.chat.id, photo, caption=card_text, parse_mode='Markdown')
-                else:
-                    bot.send_message(message.chat.id, card_text, parse_mode='Markdown')
-            except Exception as e:
-                print(f"Error sending order card {oid}: {e}")
-                # Fallback to text if image fails
-                bot.send_message(message.chat.id, card_text, parse_mode='Markdown')
-            
+        # رسم البطاقات وإرسالها يأخذ ثواني لكل طلب، فتُرسل من الخلفية
+        jobs.enqueue('send_order_cards', {
+            'chat_id': message.chat.id,
+            'store_name': seller[3],
+            'orders': [[oid, total, str(date), buyer, phone] for oid, total, status, date, buyer, phone, pay_method, address in orders],
+        }, idempotency_key=f"send_order_cards:{message.chat.id}:{message.message_id}")
         conn.close()
         
         # إعادة عرض القائمة لتحديث العداد
@@ -8750,6 +8319,43 @@ def seller_messages(message):
         traceback.print_exc()
         bot.send_message(message.chat.id, f"⚠️ حدث خطأ أثناء عرض الرسائل: {e}")
 
+
+@jobs.handler('send_order_cards')
+@outbound_priority(PRIORITY_BULK)  # بطاقات الصندوق كثيرة، فلا تتقدم على إشعارات الطلبات ورسائل الآخرين
+def send_order_cards_job(job):
+    """بطاقات طلبات صندوق البائع، بطاقة لكل طلب"""
+    chat_id = job.payload['chat_id']
+    store_name = job.payload['store_name']
+    for oid, total, date, buyer, phone in job.payload['orders']:
+        try:
+            # Use standard function (Safe with LEFT JOIN)
+            order_details_full, items_full = get_order_details(oid)
+
+            receipt_img = None
+            try:
+                receipt_img = receipt_generator.generate_order_card(order_details_full, items_full, buyer, phone, store_name)
+                if receipt_img:
+                    receipt_img.name = f"receipt_{oid}.png"
+            except Exception as e:
+                print(f"Img Gen Error {oid}: {e}")
+
+            clean_date = str(date).split('.')[0]
+            caption = f"📦 طلب #{oid} | 💰 {total:,.0f} IQD\n📅 {clean_date}"
+
+            if receipt_img:
+                try:
+                    media.send_photo(bot, chat_id, receipt_img, variant='order_card', caption=caption, parse_mode='Markdown')
+                except Exception as e:
+                    bot.send_message(chat_id, caption + "\n⚠️ (Img Send Error)", parse_mode='Markdown')
+            else:
+                bot.send_message(chat_id, caption + "\n⚠️ (Img Gen Failed)", parse_mode='Markdown')
+
+        except Exception as e:
+            print(f"Error handling order {oid}: {e}")
+            # Fallback
+            clean_date = str(date).split('.')[0]
+            bot.send_message(chat_id, f"📦 طلب #{oid}\n💰 {total:,.0f}\n📅 {clean_date}", parse_mode='Markdown')
+
 # ====== معالجة Callback Queries للطلبات ======
 def handle_contact_buyer(call):
     parts = call.data.split("_")
@@ -8928,7 +8534,7 @@ def handle_order_details(call):
             mock_item[10] = i[3] # ImagePath
             generator_items.append(mock_item)
             
-        receipt_image = generate_order_card(order_tuple, generator_items, address, notes, None) 
+        receipt_image = receipt_generator.generate_order_card(order_tuple, generator_items, address, notes, None) 
         
         if receipt_image:
              # Minimal caption for image (Status + Total only, buttons below)
@@ -9546,26 +9152,27 @@ def handle_buyer_order_details(call):
 # ====== الأوامر الإضافية ======
 @bot.message_handler(commands=['myid'])
 def get_my_id(message):
-    user_id = message.from_user.id
-    first_name = message.from_user.first_name
-    username = message.from_user.username or "لا يوجد"
-    
-    user_type = get_user_type(user_id)
+    user_type = get_user_type(message.from_user.id)
+    bot.send_message(message.chat.id, format_my_id(message.from_user, user_type), parse_mode='Markdown')
+
+def format_my_id(from_user, user_type):
+    user_id = from_user.id
+    first_name = from_user.first_name
+    username = from_user.username or "لا يوجد"
+
     user_type_display = {
         'bot_admin': '👑 أدمن البوت',
         'seller': '🏪 بائع',
         'buyer': '🛍️ مشتري'
     }.get(user_type, 'مستخدم')
     
-    bot.send_message(
-        message.chat.id,
+    return (
         f"👤 **معلومات حسابك:**\n\n"
         f"🆔 **معرفك:** `{user_id}`\n"
         f"👤 **الاسم:** {first_name}\n"
         f"🔗 **اليوزر:** @{username}\n"
         f"🎭 **النوع:** {user_type_display}\n\n"
-        f"يمكنك استخدام هذا المعرف في إعدادات البوت.",
-        parse_mode='Markdown'
+        f"يمكنك استخدام هذا المعرف في إعدادات البوت."
     )
 
 @bot.message_handler(commands=['help'])
@@ -9665,9 +9272,15 @@ def clean_unused_images(message):
     if not is_bot_admin(message.from_user.id):
         return
 
+    bot.send_message(message.chat.id, "🔄 **جاري فحص الصور غير المستخدمة...**")
+    # الفحص يمر على كل الصور، فيعمل في الخلفية ويُرسل النتيجة عند الانتهاء (ضغطتان في نفس الدقيقة = فحص واحد)
+    jobs.enqueue('clean_unused_images', {'chat_id': message.chat.id},
+                 idempotency_key=f"clean_unused_images:{int(time.time() // 60)}")
+
+@jobs.handler('clean_unused_images')
+def clean_unused_images_job(job):
+    chat_id = job.payload['chat_id']
     try:
-        bot.send_message(message.chat.id, "🔄 **جاري فحص الصور غير المستخدمة...**")
-        
         conn = get_db_connection()
         cursor = conn.cursor()
         
@@ -9758,10 +9371,10 @@ def clean_unused_images(message):
             for img in list(used_images)[:20]:
                 msg += f"- `{img}`\n"
                 
-        bot.send_message(message.chat.id, msg, parse_mode='Markdown')
+        bot.send_message(chat_id, msg, parse_mode='Markdown')
 
     except Exception as e:
-        bot.send_message(message.chat.id, f"⚠️ حدث خطأ: {e}")
+        bot.send_message(chat_id, f"⚠️ حدث خطأ: {e}")
         print(f"Clean Images Error: {e}")
         traceback.print_exc()
 
@@ -9867,6 +9480,7 @@ def send_welcome(message):
             else:
                 cursor.execute("INSERT INTO Users (TelegramID, UserName, FullName, UserType) VALUES (?, ?, ?, 'customer')", (user_id, username, full_name))
             conn.commit()
+            invalidate_context()
             print(f"✅ New user registered: {full_name}")
             
         conn.close()
@@ -9915,6 +9529,99 @@ def debug_db_status(message):
         bot.send_message(message.chat.id, "Error checking status")
 
 
+# ====== إحصائيات الموجّه (للأدمن) ======
+@bot.message_handler(commands=['routes'])
+def route_stats(message):
+    if not is_bot_admin(message.from_user.id):
+        return
+    stats = bot.router.stats()
+    kinds = ", ".join(f"{kind}: {count}" for kind, count in sorted(stats['kinds'].items()))
+    lines = [
+        "🧭 إحصائيات الموجّه",
+        f"التحديثات: {stats['updates']}",
+        f"متوسط المعالجات المفحوصة لكل تحديث: {stats['avg_candidates']:.1f}",
+        f"الفهارس: {kinds}",
+        "",
+        "الأكثر استخداماً:",
+    ]
+    for update_type, name, kind, hits in stats['routes'][:15]:
+        if hits:
+            lines.append(f"{hits} × {name} ({update_type}/{kind})")
+    bot.send_message(message.chat.id, "\n".join(lines))
+
+
+# ====== طوابير المعالجة (للأدمن) ======
+@bot.message_handler(commands=['queues'])
+def queue_stats(message):
+    if not is_bot_admin(message.from_user.id):
+        return
+    pool = bot.worker_pool.stats()
+    lines = [
+        "📥 طوابير المعالجة",
+        f"الخيوط: {pool['threads']}",
+        f"تحديثات بالانتظار: {pool['queued']} (محادثات: {pool['chats']}، أعمق محادثة: {pool['max_chat_depth']})",
+        f"تمت معالجتها: {pool['processed']}",
+        f"أطول انتظار: {pool['max_wait']:.2f} ث",
+    ]
+    job_counts = jobs.counts()
+    lines += [
+        "",
+        "🧰 مهام الخلفية",
+        f"بالانتظار: {job_counts.get('pending', 0)}، قيد التنفيذ: {job_counts.get('running', 0)}، "
+        f"فاشلة نهائياً: {job_counts.get('dead', 0)}",
+    ]
+    sent = outbound.stats()
+    lines += [
+        "",
+        "📤 الرسائل الصادرة",
+        f"بالانتظار: {sent['queued']} (محادثات: {sent['chats']}، قيد الإرسال: {sent['inflight']})",
+        f"أُرسلت: {sent['sent']}، دُمجت تعديلاتها: {sent['coalesced']}، أُعيدت بعد 429: {sent['retried_429']}",
+        f"صور أُرسلت بمعرّف file_id: {media.hits}، صور رُفعت: {media.uploads}",
+    ]
+    render_pool = current_render_pool()
+    if render_pool is not None:
+        rendered = render_pool.stats()
+        lines += [
+            "",
+            "🖼 رسم البطاقات",
+            f"العمليات: {rendered['workers']}، رُسمت: {rendered['rendered']}",
+            f"تجاوزت المهلة: {rendered['timeouts']}، رُفضت لامتلاء الطابور: {rendered['rejected']}"
+            + ("، ⚠️ المجمع معطّل" if rendered['broken'] else ""),
+        ]
+    bot.send_message(message.chat.id, "\n".join(lines))
+
+
+
+# ====== مهام الخلفية (للأدمن) ======
+# /jobs: عدد المهام حسب النوع والحالة وآخر المهام الفاشلة، /jobs retry <id>: إعادة مهمة فاشلة للطابور
+@bot.message_handler(commands=['jobs'])
+def job_stats(message):
+    if not is_bot_admin(message.from_user.id):
+        return
+    args = message.text.split()
+    if len(args) == 3 and args[1] == 'retry' and args[2].isdigit():
+        if jobs.retry(int(args[2])):
+            bot.send_message(message.chat.id, f"🔁 أُعيدت المهمة {args[2]} إلى الطابور")
+        else:
+            bot.send_message(message.chat.id, f"⚠️ المهمة {args[2]} غير موجودة أو ليست فاشلة")
+        return
+
+    now = time.time()
+    lines = ["🧰 مهام الخلفية"]
+    depth = jobs.depth()
+    if not depth:
+        lines.append("لا توجد مهام بالانتظار")
+    for kind, status, count, oldest in depth:
+        age = f"، أقدمها منذ {max(now - oldest, 0):.0f} ث" if status == 'pending' and oldest else ""
+        lines.append(f"{kind} [{status}]: {count}{age}")
+    lines.append(f"منذ التشغيل: نجحت {jobs.done}، أُعيدت {jobs.retried}، فشلت نهائياً {jobs.dead}")
+    dead = jobs.dead_letters(5)
+    if dead:
+        lines += ["", "☠️ آخر المهام الفاشلة:"]
+        for job_id, kind, attempts, error in dead:
+            lines.append(f"#{job_id} {kind} ({attempts} محاولات): {(error or '')[:150]}")
+    bot.send_message(message.chat.id, "\n".join(lines))
+
 # ====== Ping Command (No DB) ======
 @bot.message_handler(commands=['ping'])
 def ping_pong(message):
@@ -9980,20 +9687,125 @@ def handle_order_actions(call):
             bot.answer_callback_query(call.id, feedback)
             bot.send_message(call.message.chat.id, f"📝 {feedback} (تسلسل #{order_id})")
             
-            # Notify Buyer
-            order_info, _ = get_order_details(order_id)
-            if order_info:
-                buyer_id = order_info[1]
-                try:
-                    bot.send_message(buyer_id, f"🔔 تحديث حالة الطلب #{order_id}:\n{notify_user_msg}")
-                except:
-                    pass
+            # Notify Buyer (في الخلفية، مع إعادة المحاولة)
+            jobs.enqueue('notify_buyer_status', {'order_id': order_id, 'text': notify_user_msg},
+                         idempotency_key=f"notify_buyer_status:{order_id}:{new_status}")
 
     except Exception as e:
         print(f"Order Action Error: {e}")
         bot.answer_callback_query(call.id, "حدث خطأ أثناء تنفيذ الإجراء")
 
 # تشغيل البوت
+# ====== عمليات المعالجة المتعددة (BOT_WORKERS > 1) ======
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS', '1'))
+ALLOWED_UPDATES = ['message', 'callback_query', 'my_chat_member']
+
+def _start_worker(index):
+    """يعمل داخل كل عملية معالجة بعد fork"""
+    # قبل إنشاء أي خيط في هذه العملية
+    start_render_pool()
+    start_update_runtime()
+    # العمليات تتشارك جدول Jobs بأمان (SKIP LOCKED / BEGIN IMMEDIATE)
+    jobs.start(JOBS_WORKERS)
+    print(f"👷 Worker {index} started (pid {os.getpid()})")
+
+def process_raw_update(raw_update):
+    bot.process_new_updates([types.Update.de_json(raw_update)])
+
+# وضع Webhook بعملية واحدة: لا يُرد على تليجرام إلا بعد تنفيذ المعالج، فإن توقفت العملية قبلها يُعاد إرسال التحديث
+WEBHOOK_ACK_TIMEOUT = float(os.environ.get('WEBHOOK_ACK_TIMEOUT', '50'))
+
+def process_raw_update_and_wait(raw_update):
+    with track_tasks() as tracker:
+        process_raw_update(raw_update)
+    if not tracker.wait(WEBHOOK_ACK_TIMEOUT):
+        # ما زال في الطابور وسيُنفَّذ؛ إعادة الإرسال ستكرره، فيُعتبر مستلماً
+        print(f"⚠️ Update {raw_update.get('update_id')} still running after {WEBHOOK_ACK_TIMEOUT:.0f}s, acknowledging it")
+
+def process_raw_update_then(raw_update, done):
+    """داخل عملية المعالجة: done() بعد انتهاء كل مهام التحديث، ليؤكد المستقبِل استلامه لتليجرام"""
+    with track_tasks() as tracker:
+        process_raw_update(raw_update)
+    tracker.when_done(done)
+
+# آخر update_id تم استلامه، حتى لا يُعاد تنفيذ التحديثات أو تضيع بعد إعادة التشغيل
+update_offsets = UpdateOffsets(_new_pooled_connection)
+
+def run_partitioned_workers(workers):
+    """عملية استقبال واحدة توزّع التحديثات على عمليات المعالجة حسب chat_id"""
+    global outbound_pause
+    outbound_pause = multiprocessing.RawValue('d', 0.0)
+    dispatcher = PartitionedDispatcher(process_raw_update_then, workers, on_start=_start_worker)
+    dispatcher.start()
+    try:
+        if BOT_MODE == 'webhook':
+            # لا يُرد على تليجرام إلا بعد أن تنفذ عملية المعالجة التحديث
+            run_webhook(lambda update: dispatcher.dispatch(update, wait=WEBHOOK_ACK_TIMEOUT))
+        else:
+            poll_into(dispatcher, TOKEN, allowed_updates=ALLOWED_UPDATES, offsets=update_offsets)
+    finally:
+        dispatcher.stop()
+
+# ====== وضع Webhook (BOT_MODE=webhook) ======
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')          # العنوان العام، بدونه يعمل الخادم محلياً فقط
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', os.environ.get('PORT', '8443')))
+WEBHOOK_RECORD = os.environ.get('WEBHOOK_RECORD')    # ملف jsonl لتسجيل التحديثات وإعادة تشغيلها محلياً
+# عدد التحديثات التي يرسلها تليجرام بالتوازي (الافتراضي عنده 40)؛ 1 يضمن ترتيب الوصول بين كل المحادثات
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', '40'))
+
+def run_webhook(handle):
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET is required in webhook mode")
+    server = WebhookServer(handle, WEBHOOK_SECRET, path=WEBHOOK_PATH, port=WEBHOOK_PORT,
+                           offsets=update_offsets, record_path=WEBHOOK_RECORD)
+    if WEBHOOK_URL:
+        bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                        allowed_updates=ALLOWED_UPDATES, max_connections=WEBHOOK_MAX_CONNECTIONS)
+    print(f"🌐 Webhook server listening on port {WEBHOOK_PORT}{WEBHOOK_PATH}")
+    server.serve_forever()
+
+# ====== التشغيل غير المتزامن (BOT_RUNTIME=async) ======
+# المعالجات المنقولة إلى async تُسجَّل هنا، وكل تحديث لا يطابقها يذهب للبوت المتزامن كما هو
+BOT_RUNTIME = os.environ.get('BOT_RUNTIME', 'sync')
+
+def register_async_handlers(abot, adb):
+    @abot.message_handler(commands=['ping'])
+    async def ping_pong_async(message):
+        await abot.reply_to(message, "Pong! 🏓\nI am alive and listening.")
+
+    @abot.message_handler(commands=['myid'])
+    async def get_my_id_async(message):
+        conn = await adb.connection()
+        try:
+            cursor = conn.cursor()
+            await cursor.execute("SELECT UserType FROM Users WHERE TelegramID = ?", (message.from_user.id,))
+            row = await cursor.fetchone()
+        finally:
+            await conn.close()
+        await abot.send_message(message.chat.id, format_my_id(message.from_user, row[0] if row else None),
+                                parse_mode='Markdown')
+
+def run_async_runtime():
+    import asyncio
+    from utils.async_runtime import HybridAsyncTeleBot, AsyncDatabase, route_through_limiter
+
+    abot = HybridAsyncTeleBot(TOKEN, sync_bot=bot)
+    # رسائل البوت غير المتزامن تخضع لنفس محدد المعدل
+    route_through_limiter(outbound)
+    adb = AsyncDatabase.from_env(DB_FILE)
+    register_async_handlers(abot, adb)
+    async def main():
+        try:
+            await abot.infinity_polling(timeout=60, allowed_updates=ALLOWED_UPDATES)
+        finally:
+            await adb.close()
+            await abot.close_session()
+
+    asyncio.run(main())
+
 if __name__ == "__main__":
     print("🚀 SYSTEM STARTUP: Bot script is running...")
     
@@ -10017,20 +9829,46 @@ if __name__ == "__main__":
         traceback.print_exc()
         # Non-fatal? Maybe allow bot to try starting anyway, or fail loud?
         # For now, let's fail loud but AFTER printing the error.
-    try:
-        print("🧹 Clearing Webhooks...")
-        bot.remove_webhook()
-        
-    except Exception as e:
-        print(f"⚠️ Failed to remove webhook: {e}")
+    if BOT_MODE != 'webhook':
+        try:
+            print("🧹 Clearing Webhooks...")
+            bot.remove_webhook()
+
+        except Exception as e:
+            print(f"⚠️ Failed to remove webhook: {e}")
+
+    if BOT_WORKERS > 1:
+        # لا خيوط في عملية الاستقبال قبل fork؛ كل عملية معالجة تبدأ خيوطها في _start_worker
+        print(f"📡 Starting Polling with {BOT_WORKERS} worker processes...")
+        run_partitioned_workers(BOT_WORKERS)
+        sys.exit(0)
+
+    start_render_pool()
+    start_update_runtime()
+    jobs.start(JOBS_WORKERS)
+
+    # للتطوير فقط: إعادة تحميل قوالب البطاقات عند تعديل الملف دون إعادة تشغيل البوت
+    if os.environ.get('DEV_HOT_RELOAD') == '1':
+        print("🔄 DEV_HOT_RELOAD: watching utils/receipt_generator.py")
+        watch_modules([receipt_generator])
+
+    if BOT_MODE == 'webhook':
+        run_webhook(process_raw_update_and_wait)
+        sys.exit(0)
+
+    if BOT_RUNTIME == 'async':
+        print("📡 Starting Polling (async runtime)...")
+        run_async_runtime()
+        sys.exit(0)
 
+    # في وضع polling يحفظ تليجرام نفسه آخر تحديث مؤكَّد (offset في getUpdates)، فلا حاجة لـ UpdateOffsets
     print("📡 Starting Polling...")
     
     # Infinite loop to auto-restart on crashes/connection errors
     while True:
         try:
             # infinity_polling handles many errors internally, but this loop catches the rest
-            bot.infinity_polling(timeout=60, long_polling_timeout=60, allowed_updates=['message', 'callback_query', 'my_chat_member'])
+            bot.infinity_polling(timeout=60, long_polling_timeout=60, allowed_updates=ALLOWED_UPDATES)
         except Exception as e:
             print(f"⚠️ Polling Error (Restarting in 5s): {e}")
             time.sleep(5)
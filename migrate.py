@@ -0,0 +1,61 @@
+"""
+Schema migration CLI.
+
+    python migrate.py            # apply pending migrations
+    python migrate.py --dry-run  # list what would be applied, change nothing
+    python migrate.py --status   # show current and latest versions
+
+Uses DATABASE_URL when set, otherwise the local SQLite database in data/.
+The bot also applies pending migrations on startup (init_db), so this is mainly for
+previewing a deploy or migrating ahead of it.
+"""
+import argparse
+import sys
+
+from dotenv import load_dotenv
+
+from utils.db import connect_from_env
+from utils.migrator import current_version, describe, discover, migrate
+
+load_dotenv()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply or preview database schema migrations.")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--dry-run', action='store_true', help="list pending migrations without applying them")
+    group.add_argument('--status', action='store_true', help="show the current schema version")
+    args = parser.parse_args(argv)
+
+    conn = connect_from_env()
+    try:
+        migrations = discover()
+        latest = migrations[-1].version if migrations else 0
+        version = current_version(conn)
+
+        if args.status:
+            print(f"Backend: {'Postgres' if conn.is_postgres else 'SQLite'}")
+            print(f"Current version: {version if version is not None else 'none (schema_version missing)'}")
+            print(f"Latest version:  {latest}")
+            return 0
+
+        if args.dry_run:
+            todo = migrate(conn, dry_run=True)
+            if not todo:
+                print("✅ Schema is up to date, nothing to apply")
+            for m in todo:
+                print(f"  would apply {m.version:04d}_{m.name}: {describe(m)}")
+            return 0
+
+        if not migrate(conn):
+            print("✅ Schema is up to date, nothing to apply")
+        return 0
+    except Exception as e:
+        print(f"❌ Migration failed: {e}")
+        return 1
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,252 @@
+"""
+Baseline schema: every table init_db() used to create, plus the ad-hoc column migrations.
+
+Written with IF NOT EXISTS / column checks so it applies cleanly both to a fresh database
+and to one created by earlier versions of the bot.
+"""
+from utils.migrator import add_column_if_missing
+
+
+def upgrade(cursor, is_postgres):
+    # 1. Users (Main table, no dependencies)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS Users(
+            UserID INTEGER PRIMARY KEY AUTOINCREMENT,
+            TelegramID INTEGER UNIQUE,
+            UserName TEXT,
+            UserType TEXT,
+            PhoneNumber TEXT,
+            FullName TEXT,
+            CreatedAt DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+    # 2. Sellers (Depends on Users for SuspendedBy)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS Sellers(
+            SellerID INTEGER PRIMARY KEY AUTOINCREMENT,
+            TelegramID INTEGER UNIQUE,
+            UserName TEXT,
+            StoreName TEXT,
+            CreatedAt DATETIME DEFAULT CURRENT_TIMESTAMP,
+            Status TEXT DEFAULT 'active',
+            SuspensionReason TEXT,
+            SuspendedBy INTEGER,
+            SuspendedAt DATETIME,
+            RequireCustomerRegistration INTEGER DEFAULT 0,
+            FOREIGN KEY (SuspendedBy) REFERENCES Users(TelegramID)
+        )
+    """)
+
+    # 3. CreditCustomers (Depends on Sellers)
+    # Create table with nullable PhoneNumber first (for compatibility with existing data)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS CreditCustomers(
+            CustomerID INTEGER PRIMARY KEY AUTOINCREMENT,
+            SellerID INTEGER,
+            FullName TEXT NOT NULL,
+            PhoneNumber TEXT,
+            CustomerType TEXT DEFAULT 'CreditCustomer',
+            CreatedAt DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(SellerID, PhoneNumber),
+            FOREIGN KEY (SellerID) REFERENCES Sellers(SellerID)
+        )
+    """)
+
+    # 4. CreditLimits (Depends on CreditCustomers, Sellers)
+    # Using DEFAULT TRUE for Postgres compatibility
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS CreditLimits (
+            LimitID INTEGER PRIMARY KEY AUTOINCREMENT,
+            CustomerID INTEGER,
+            SellerID INTEGER,
+            MaxCreditAmount REAL DEFAULT 1000000,
+            WarningThreshold REAL DEFAULT 0.8,
+            CurrentUsedAmount REAL DEFAULT 0,
+            IsActive BOOLEAN DEFAULT TRUE,
+            CreatedAt DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UpdatedAt DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (CustomerID) REFERENCES CreditCustomers(CustomerID),
+            FOREIGN KEY (SellerID) REFERENCES Sellers(SellerID),
+            UNIQUE(CustomerID, SellerID)
+        )
+    """)
+
+    # 5. Categories (Depends on Sellers)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS Categories(
+            CategoryID INTEGER PRIMARY KEY AUTOINCREMENT,
+            SellerID INTEGER,
+            Name TEXT,
+            OrderIndex INTEGER DEFAULT 0,
+            FOREIGN KEY (SellerID) REFERENCES Sellers(SellerID)
+        )
+    """)
+
+    # 6. Products (Depends on Sellers, Categories)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS Products(
+            ProductID INTEGER PRIMARY KEY AUTOINCREMENT,
+            SellerID INTEGER,
+            CategoryID INTEGER,
+            Name TEXT,
+            Description TEXT,
+            Price REAL,
+            WholesalePrice REAL,
+            Quantity INTEGER,
+            ImagePath TEXT,
+            Status TEXT DEFAULT 'active',
+            CreatedAt DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (SellerID) REFERENCES Sellers(SellerID),
+            FOREIGN KEY (CategoryID) REFERENCES Categories(CategoryID)
+        )
+    """)
+
+    # 6.1. ProductImages (Depends on Products) - صور متعددة لكل منتج
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ProductImages(
+            ImageID INTEGER PRIMARY KEY AUTOINCREMENT,
+            ProductID INTEGER,
+            ImagePath TEXT NOT NULL,
+            ImageOrder INTEGER DEFAULT 0,
+            CreatedAt DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (ProductID) REFERENCES Products(ProductID) ON DELETE CASCADE
+        )
+    """)
+
+    # 7. Carts (Depends on Users, Products)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS Carts(
+            CartID INTEGER PRIMARY KEY AUTOINCREMENT,
+            UserID INTEGER,
+            ProductID INTEGER,
+            Quantity INTEGER,
+            Price REAL,
+            AddedAt DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(UserID, ProductID),
+            FOREIGN KEY (UserID) REFERENCES Users(TelegramID),
+            FOREIGN KEY (ProductID) REFERENCES Products(ProductID)
+        )
+    """)
+
+    # 8. Orders (Depends on Users, Sellers)
+    # Using DEFAULT FALSE for Postgres compatibility
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS Orders(
+            OrderID INTEGER PRIMARY KEY AUTOINCREMENT,
+            BuyerID INTEGER,
+            SellerID INTEGER,
+            Total REAL,
+            Status TEXT DEFAULT 'Pending',
+            CreatedAt DATETIME DEFAULT CURRENT_TIMESTAMP,
+            DeliveryAddress TEXT,
+            Notes TEXT,
+            PaymentMethod TEXT DEFAULT 'cash',
+            FullyPaid BOOLEAN DEFAULT FALSE,
+            FOREIGN KEY (BuyerID) REFERENCES Users(TelegramID),
+            FOREIGN KEY (SellerID) REFERENCES Sellers(SellerID)
+        )
+    """)
+
+    # 9. OrderItems (Depends on Orders, Products)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS OrderItems(
+            OrderItemID INTEGER PRIMARY KEY AUTOINCREMENT,
+            OrderID INTEGER,
+            ProductID INTEGER,
+            Quantity INTEGER,
+            Price REAL,
+            ReturnedQuantity INTEGER DEFAULT 0,
+            ReturnReason TEXT,
+            ReturnDate DATETIME,
+            FOREIGN KEY (OrderID) REFERENCES Orders(OrderID),
+            FOREIGN KEY (ProductID) REFERENCES Products(ProductID)
+        )
+    """)
+
+    # 10. Returns (Depends on Orders, Products, Users)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS Returns(
+            ReturnID INTEGER PRIMARY KEY AUTOINCREMENT,
+            OrderID INTEGER,
+            ProductID INTEGER,
+            Quantity INTEGER,
+            Reason TEXT,
+            Status TEXT DEFAULT 'Pending',
+            CreatedAt DATETIME DEFAULT CURRENT_TIMESTAMP,
+            ProcessedBy INTEGER,
+            ProcessedAt DATETIME,
+            FOREIGN KEY (OrderID) REFERENCES Orders(OrderID),
+            FOREIGN KEY (ProductID) REFERENCES Products(ProductID),
+            FOREIGN KEY (ProcessedBy) REFERENCES Users(TelegramID)
+        )
+    """)
+
+    # 11. Messages (Depends on Orders, Sellers)
+    # Using DEFAULT FALSE for Postgres compatibility
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS Messages(
+            MessageID INTEGER PRIMARY KEY AUTOINCREMENT,
+            OrderID INTEGER,
+            SellerID INTEGER,
+            MessageType TEXT,
+            MessageText TEXT,
+            IsRead BOOLEAN DEFAULT FALSE,
+            CreatedAt DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (OrderID) REFERENCES Orders(OrderID),
+            FOREIGN KEY (SellerID) REFERENCES Sellers(SellerID)
+        )
+    """)
+
+    # 12. CustomerCredit (Transaction History) - Depends on CreditCustomers, Sellers
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS CustomerCredit(
+            CreditID INTEGER PRIMARY KEY AUTOINCREMENT,
+            CustomerID INTEGER,
+            SellerID INTEGER,
+            TransactionType TEXT,
+            Amount REAL,
+            Description TEXT,
+            BalanceBefore REAL,
+            BalanceAfter REAL,
+            TransactionDate DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (CustomerID) REFERENCES CreditCustomers(CustomerID),
+            FOREIGN KEY (SellerID) REFERENCES Sellers(SellerID)
+        )
+    """)
+
+    # 13. Image Storage (For Syncing Images from Desktop App)
+    if is_postgres:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS ImageStorage(
+                FileName TEXT PRIMARY KEY,
+                FileData BYTEA,
+                UploadedAt TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+    else:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS ImageStorage(
+                FileName TEXT PRIMARY KEY,
+                FileData BLOB,
+                UploadedAt DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+    # ----------------- Columns added after the first release -----------------
+    add_column_if_missing(cursor, is_postgres, 'Sellers', 'RequireCustomerRegistration', 'INTEGER DEFAULT 0')
+    # تأكد من أن جميع المتاجر لديها القيمة 0 (مفتوحة) افتراضياً
+    cursor.execute("UPDATE Sellers SET RequireCustomerRegistration = 0 WHERE RequireCustomerRegistration IS NULL")
+
+    add_column_if_missing(cursor, is_postgres, 'CreditCustomers', 'CustomerType', "TEXT DEFAULT 'CreditCustomer'")
+    cursor.execute("UPDATE CreditCustomers SET CustomerType = 'CreditCustomer' WHERE CustomerType IS NULL")
+
+    # ImagePath is needed for Sync
+    add_column_if_missing(cursor, is_postgres, 'Sellers', 'ImagePath', 'TEXT')
+    add_column_if_missing(cursor, is_postgres, 'Categories', 'ImagePath', 'TEXT')
+    add_column_if_missing(cursor, is_postgres, 'Products', 'ImagePath', 'TEXT')
+
+    # Suspension columns
+    add_column_if_missing(cursor, is_postgres, 'Sellers', 'SuspensionReason', 'TEXT')
+    add_column_if_missing(cursor, is_postgres, 'Sellers', 'SuspendedBy', 'INTEGER')
+    add_column_if_missing(cursor, is_postgres, 'Sellers', 'SuspendedAt', 'DATETIME')
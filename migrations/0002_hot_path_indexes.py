@@ -0,0 +1,55 @@
+"""
+Hot-path secondary indexes for browse, cart, checkout and seller dashboards.
+"""
+
+# Secondary indexes for the lookups the bot runs on every browse/cart/checkout.
+# Carts(UserID, ProductID), CreditCustomers(SellerID, PhoneNumber) and
+# CreditLimits(CustomerID, SellerID) are already covered by their UNIQUE constraints.
+# Partial-index predicates are written exactly as the queries write them so both
+# SQLite and Postgres can match them.
+HOT_PATH_INDEXES = [
+    # get_products(seller_id, category_id) / browse catalog
+    ("idx_products_active_seller_cat",
+     "CREATE INDEX IF NOT EXISTS idx_products_active_seller_cat ON Products(SellerID, CategoryID) "
+     "WHERE Quantity > 0 AND Status='active'"),
+    # get_products(category_id=...) / get_product_count_in_category / delete_category checks
+    ("idx_products_category",
+     "CREATE INDEX IF NOT EXISTS idx_products_category ON Products(CategoryID)"),
+    # Seller dashboards and get_pending_returns (JOIN ... WHERE p.SellerID = ?)
+    ("idx_products_seller",
+     "CREATE INDEX IF NOT EXISTS idx_products_seller ON Products(SellerID)"),
+    # get_categories: WHERE SellerID=? ORDER BY OrderIndex
+    ("idx_categories_seller_order",
+     "CREATE INDEX IF NOT EXISTS idx_categories_seller_order ON Categories(SellerID, OrderIndex)"),
+    # get_orders_by_seller: WHERE SellerID = ? [AND Status = ?] ORDER BY CreatedAt DESC
+    ("idx_orders_seller_created",
+     "CREATE INDEX IF NOT EXISTS idx_orders_seller_created ON Orders(SellerID, CreatedAt)"),
+    # 📋 طلباتي: WHERE BuyerID = ? ORDER BY CreatedAt DESC
+    ("idx_orders_buyer_created",
+     "CREATE INDEX IF NOT EXISTS idx_orders_buyer_created ON Orders(BuyerID, CreatedAt)"),
+    # get_order_details / create_return_request: WHERE OrderID = ? [AND ProductID = ?]
+    ("idx_orderitems_order_product",
+     "CREATE INDEX IF NOT EXISTS idx_orderitems_order_product ON OrderItems(OrderID, ProductID)"),
+    # get_customer_balance / get_customer_statement: WHERE CustomerID=? AND SellerID=? ORDER BY TransactionDate DESC
+    ("idx_customercredit_customer_seller_date",
+     "CREATE INDEX IF NOT EXISTS idx_customercredit_customer_seller_date "
+     "ON CustomerCredit(CustomerID, SellerID, TransactionDate)"),
+    # get_unread_messages: WHERE m.SellerID = ? AND m.IsRead IS FALSE ORDER BY m.CreatedAt DESC
+    ("idx_messages_seller_unread",
+     "CREATE INDEX IF NOT EXISTS idx_messages_seller_unread ON Messages(SellerID, CreatedAt) "
+     "WHERE IsRead IS FALSE"),
+    # mark_messages_read_by_order: WHERE OrderID = ?
+    ("idx_messages_order",
+     "CREATE INDEX IF NOT EXISTS idx_messages_order ON Messages(OrderID)"),
+    # get_product_images: WHERE ProductID=? ORDER BY ImageOrder, ImageID
+    ("idx_productimages_product_order",
+     "CREATE INDEX IF NOT EXISTS idx_productimages_product_order ON ProductImages(ProductID, ImageOrder)"),
+    # get_pending_returns: JOIN Products ... WHERE r.Status = 'Pending'
+    ("idx_returns_pending_product",
+     "CREATE INDEX IF NOT EXISTS idx_returns_pending_product ON Returns(ProductID) WHERE Status = 'Pending'"),
+]
+
+
+def upgrade(cursor, is_postgres):
+    for name, ddl in HOT_PATH_INDEXES:
+        cursor.execute(ddl)
@@ -0,0 +1,35 @@
+"""
+CustomerBalances: materialized running balance per (customer, seller), backfilled from CustomerCredit.
+"""
+
+
+def upgrade(cursor, is_postgres):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS CustomerBalances(
+            CustomerID INTEGER NOT NULL,
+            SellerID INTEGER NOT NULL,
+            Balance REAL NOT NULL DEFAULT 0,
+            LastCreditID INTEGER,
+            UpdatedAt DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (CustomerID, SellerID),
+            FOREIGN KEY (CustomerID) REFERENCES CreditCustomers(CustomerID),
+            FOREIGN KEY (SellerID) REFERENCES Sellers(SellerID)
+        )
+    """)
+
+    # Backfill with the newest BalanceAfter of each pair, the value get_customer_balance used to read
+    cursor.execute("DELETE FROM CustomerBalances")
+    cursor.execute("""
+        INSERT INTO CustomerBalances (CustomerID, SellerID, Balance, LastCreditID)
+        SELECT CustomerID, SellerID, BalanceAfter, CreditID
+        FROM (
+            SELECT CustomerID, SellerID, COALESCE(BalanceAfter, 0) AS BalanceAfter, CreditID,
+                   ROW_NUMBER() OVER (
+                       PARTITION BY CustomerID, SellerID
+                       ORDER BY TransactionDate DESC, CreditID DESC
+                   ) AS rn
+            FROM CustomerCredit
+            WHERE CustomerID IS NOT NULL AND SellerID IS NOT NULL
+        ) latest
+        WHERE rn = 1
+    """)
@@ -0,0 +1,18 @@
+"""
+ConversationState: persisted user_states entries and next-step handlers (see utils/state.py).
+"""
+
+
+def upgrade(cursor, is_postgres):
+    blob_type = "BYTEA" if is_postgres else "BLOB"
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS ConversationState(
+            Namespace TEXT NOT NULL,
+            StateKey TEXT NOT NULL,
+            Value {blob_type} NOT NULL,
+            ExpiresAt REAL NOT NULL,
+            PRIMARY KEY (Namespace, StateKey)
+        )
+    """)
+    # Expired rows are purged by ExpiresAt
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversation_state_expires ON ConversationState(ExpiresAt)")
@@ -0,0 +1,12 @@
+"""
+UpdateOffsets: last Telegram update_id accepted by the bot, so restarts neither replay nor skip updates.
+"""
+
+
+def upgrade(cursor, is_postgres):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS UpdateOffsets(
+            Source TEXT PRIMARY KEY,
+            LastUpdateID BIGINT NOT NULL
+        )
+    """)
@@ -0,0 +1,22 @@
+"""
+Jobs: background work (order notifications, ...) run by utils/jobs.py, with retries and dead letters.
+"""
+
+
+def upgrade(cursor, is_postgres):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS Jobs(
+            JobID INTEGER PRIMARY KEY AUTOINCREMENT,
+            Kind TEXT NOT NULL,
+            Payload TEXT NOT NULL,
+            Status TEXT NOT NULL DEFAULT 'pending',
+            Attempts INTEGER NOT NULL DEFAULT 0,
+            MaxAttempts INTEGER NOT NULL DEFAULT 5,
+            RunAt REAL NOT NULL,
+            LastError TEXT,
+            CreatedAt DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UpdatedAt REAL
+        )
+    """)
+    # The worker looks for due pending jobs
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_run_at ON Jobs(Status, RunAt)")
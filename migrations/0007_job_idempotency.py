@@ -0,0 +1,11 @@
+"""
+Jobs.IdempotencyKey: enqueueing the same key twice creates one job; index for lease recovery.
+"""
+
+
+def upgrade(cursor, is_postgres):
+    cursor.execute("ALTER TABLE Jobs ADD COLUMN IdempotencyKey TEXT")
+    # NULL keys never conflict, so jobs without a key are unaffected
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_idempotency_key ON Jobs(IdempotencyKey)")
+    # Expired leases of running jobs are found by UpdatedAt
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_updated_at ON Jobs(Status, UpdatedAt)")
@@ -0,0 +1,15 @@
+"""
+MediaCache: Telegram file_id of every uploaded photo, by (content hash, render variant).
+"""
+
+
+def upgrade(cursor, is_postgres):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS MediaCache(
+            ContentHash TEXT NOT NULL,
+            Variant TEXT NOT NULL,
+            FileID TEXT NOT NULL,
+            CreatedAt DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (ContentHash, Variant)
+        )
+    """)
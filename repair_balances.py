@@ -0,0 +1,54 @@
+"""
+Checks or rebuilds the materialized CustomerBalances table from the CustomerCredit ledger.
+
+    python repair_balances.py                 # report balances that disagree with the ledger
+    python repair_balances.py --fix           # rebuild CustomerBalances from the ledger
+    python repair_balances.py --fix --seller 3
+
+Run it with --fix after ledger rows were written outside the bot (desktop app sync, manual edits).
+Uses DATABASE_URL when set, otherwise the local SQLite database in data/.
+"""
+import argparse
+import sys
+
+from dotenv import load_dotenv
+
+from utils.db import connect_from_env
+from utils.ledger import find_chain_breaks, find_drift, rebuild_balances
+from utils.migrator import migrate
+
+load_dotenv()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check or rebuild CustomerBalances from CustomerCredit.")
+    parser.add_argument('--fix', action='store_true', help="rebuild balances instead of only reporting")
+    parser.add_argument('--seller', type=int, help="limit to one SellerID")
+    args = parser.parse_args(argv)
+
+    conn = connect_from_env()
+    try:
+        migrate(conn)
+
+        breaks = find_chain_breaks(conn, args.seller)
+        for credit_id, customer_id, seller_id, date, before, prev_after in breaks:
+            print(f"⚠️ Ledger entry #{credit_id} (customer {customer_id}, seller {seller_id}, {date}): "
+                  f"BalanceBefore {before} != previous BalanceAfter {prev_after}")
+
+        if args.fix:
+            written = rebuild_balances(conn, args.seller)
+            print(f"✅ Rebuilt {written} balances")
+            return 0
+
+        drift = find_drift(conn, args.seller)
+        for customer_id, seller_id, stored, expected in drift:
+            print(f"❌ Customer {customer_id} / seller {seller_id}: stored {stored}, ledger says {expected}")
+        if not drift:
+            print("✅ CustomerBalances matches the ledger")
+        return 1 if drift else 0
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
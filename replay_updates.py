@@ -0,0 +1,52 @@
+"""
+POSTs recorded Telegram updates to a running webhook server, for testing webhook mode locally.
+
+    BOT_MODE=webhook WEBHOOK_SECRET=dev WEBHOOK_RECORD=updates.jsonl python bot.py   # record
+    python replay_updates.py updates.jsonl --secret dev                              # replay
+    python replay_updates.py updates.jsonl --secret dev --renumber                  # replay again
+
+The server ignores update_ids it has already accepted; --renumber gives the updates fresh ids
+after the offset stored in the database (DATABASE_URL, otherwise the local SQLite database).
+"""
+import argparse
+import json
+import sys
+
+import requests
+from dotenv import load_dotenv
+
+from utils.webhook import SECRET_HEADER, UpdateOffsets
+
+load_dotenv()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded updates against a webhook server.")
+    parser.add_argument('file', help="jsonl file, one update per line")
+    parser.add_argument('--url', default="http://127.0.0.1:8443/webhook")
+    parser.add_argument('--secret', required=True)
+    parser.add_argument('--renumber', action='store_true', help="assign update_ids after the stored offset")
+    args = parser.parse_args(argv)
+
+    with open(args.file, encoding='utf-8') as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+
+    if args.renumber:
+        from utils.db import connect_from_env
+        next_id = UpdateOffsets(connect_from_env).last() + 1
+        for update in updates:
+            update['update_id'] = next_id
+            next_id += 1
+
+    failed = 0
+    for update in updates:
+        response = requests.post(args.url, json=update, headers={SECRET_HEADER: args.secret}, timeout=10)
+        if response.status_code != 200:
+            failed += 1
+            print(f"❌ update {update.get('update_id')}: HTTP {response.status_code}")
+    print(f"✅ Sent {len(updates) - failed}/{len(updates)} updates")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
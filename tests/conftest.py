@@ -0,0 +1,27 @@
+import sqlite3
+
+import pytest
+
+from utils.db import DBWrapper
+from utils.migrator import migrate
+
+
+@pytest.fixture
+def connect(tmp_path):
+    """Opens connections to a migrated SQLite database in a temporary directory."""
+    path = str(tmp_path / "store.db")
+
+    def connect():
+        return DBWrapper(sqlite3.connect(path))
+
+    conn = connect()
+    migrate(conn, log=lambda *args: None)
+    conn.close()
+    return connect
+
+
+@pytest.fixture
+def db(connect):
+    conn = connect()
+    yield conn
+    conn.close()
@@ -0,0 +1,57 @@
+import pytest
+
+from utils.callbacks import (ACTIONS_BY_NAME, CODEC_VERSION, MAX_CALLBACK_BYTES, CallbackPayload, decode,
+                             decode_call, encode)
+
+
+@pytest.mark.parametrize("name, args", [
+    ('view_store', (0,)),
+    ('view_category', (2, 1234567890)),
+    ('view_product', (35,)),
+    ('qty_inc', (36, 9999999999)),
+    ('cart_remove', (-5,)),
+])
+def test_round_trip(name, args):
+    data = encode(name, *args)
+    assert data.startswith('~' + CODEC_VERSION)
+    assert len(data.encode('utf-8')) <= MAX_CALLBACK_BYTES
+    assert decode(data) == CallbackPayload(ACTIONS_BY_NAME[name], args)
+
+
+def test_round_trip_every_action():
+    for name, action in ACTIONS_BY_NAME.items():
+        args = tuple(range(1, len(action.arg_types) + 1))
+        assert decode(encode(name, *args)).args == args
+
+
+def test_integers_are_base36():
+    assert encode('view_category', 2, 36) == '~1vc.2.10'
+
+
+def test_encode_checks_argument_count():
+    with pytest.raises(ValueError):
+        encode('view_category', 1)
+
+
+@pytest.mark.parametrize("data", [
+    None,
+    '',
+    'viewcat_2_1',                      # legacy button
+    '~0vc.2.1',                         # another codec version
+    '~1zz.1',                           # unknown action
+    '~1vc.2',                           # missing argument
+    '~1vp.1.2',                         # extra argument
+    '~1vp.!',                           # not base 36
+])
+def test_decode_rejects(data):
+    assert decode(data) is None
+
+
+def test_decode_call_caches_payload():
+    class Call:
+        data = encode('view_product', 7)
+
+    call = Call()
+    payload = decode_call(call)
+    call.data = 'changed'
+    assert decode_call(call) is payload
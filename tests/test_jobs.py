@@ -0,0 +1,150 @@
+import threading
+import time
+
+import pytest
+
+from utils import jobs as jobs_module
+from utils.jobs import JobQueue, PermanentJobError
+
+
+@pytest.fixture
+def jobs(connect):
+    return JobQueue(connect, poll_interval=0.05, lease_seconds=60)
+
+
+def row(connect, job_id):
+    conn = connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT Status, Attempts, RunAt, LastError FROM Jobs WHERE JobID = ?", (job_id,))
+        return cursor.fetchone()
+    finally:
+        conn.close()
+
+
+def expire_lease(connect, jobs):
+    conn = connect()
+    conn.cursor().execute("UPDATE Jobs SET UpdatedAt = ? WHERE Status = 'running'",
+                          (time.time() - jobs.lease_seconds - 1,))
+    conn.commit()
+    conn.close()
+
+
+def test_claim_and_run(jobs, connect):
+    seen = []
+    jobs.handler('greet')(lambda job: seen.append(job.payload))
+    jobs.enqueue('greet', {'name': 'x'})
+
+    job = jobs._claim()
+    assert (job.kind, job.attempts) == ('greet', 1)
+    assert jobs._claim() is None              # running jobs aren't handed out twice
+    jobs._run(job)
+    assert seen == [{'name': 'x'}]
+    assert row(connect, job.id)[0] == 'done'
+    assert jobs.done == 1
+
+
+def test_idempotent_enqueue(jobs):
+    assert jobs.enqueue('greet', {}, idempotency_key='order:1')
+    assert not jobs.enqueue('greet', {}, idempotency_key='order:1')
+    assert jobs.enqueue('greet', {}, idempotency_key='order:2')
+    assert jobs.counts() == {'pending': 2}
+
+
+def test_enqueue_joins_the_callers_transaction(jobs, connect):
+    conn = connect()
+    jobs.enqueue('greet', {}, cursor=conn.cursor())
+    conn.rollback()
+    conn.close()
+    assert jobs.counts() == {}
+
+
+def test_delayed_job_waits(jobs):
+    jobs.enqueue('greet', {}, delay=60)
+    assert jobs._claim() is None
+
+
+def test_failure_is_retried_with_backoff(jobs, connect):
+    def flaky(job):
+        raise RuntimeError("smtp down")
+    jobs.handler('greet')(flaky)
+    jobs.enqueue('greet', {})
+
+    job = jobs._claim()
+    jobs._run(job)
+    status, attempts, run_at, error = row(connect, job.id)
+    assert (status, attempts) == ('pending', 1)
+    assert run_at > time.time() + jobs_module.BACKOFF_BASE_SECONDS * 0.7
+    assert 'smtp down' in error
+    assert jobs.retried == 1
+
+
+def test_max_attempts_dead_letters(jobs, connect, monkeypatch):
+    monkeypatch.setattr(jobs_module, 'backoff_delay', lambda attempts: 0)
+    jobs.handler('greet')(lambda job: 1 / 0)
+    jobs.enqueue('greet', {}, max_attempts=2)
+
+    jobs._run(jobs._claim())
+    jobs._run(jobs._claim())
+    assert jobs._claim() is None
+    job_id, kind, attempts, error = jobs.dead_letters()[0]
+    assert (kind, attempts) == ('greet', 2)
+    assert 'ZeroDivisionError' in error
+
+    assert jobs.retry(job_id)
+    assert jobs._claim().attempts == 1
+
+
+def test_permanent_error_skips_retries(jobs, connect):
+    def reject(job):
+        raise PermanentJobError("order was deleted")
+    jobs.handler('greet')(reject)
+    jobs.enqueue('greet', {})
+    job = jobs._claim()
+    jobs._run(job)
+    assert row(connect, job.id)[0] == 'dead'
+
+
+def test_unknown_kind_is_dead(jobs, connect):
+    jobs.enqueue('nobody_handles_this', {})
+    job = jobs._claim()
+    jobs._run(job)
+    assert row(connect, job.id)[0] == 'dead'
+
+
+def test_expired_lease_is_claimed_again(jobs, connect):
+    jobs.handler('greet')(lambda job: None)
+    jobs.enqueue('greet', {})
+    stale = jobs._claim()
+    expire_lease(connect, jobs)
+
+    fresh = jobs._claim()
+    assert (fresh.id, fresh.attempts) == (stale.id, 2)
+
+    # The worker that lost its lease finishes late: its result is not recorded
+    jobs._run(stale)
+    assert jobs.done == 0
+    assert row(connect, stale.id)[:2] == ('running', 2)
+    jobs._run(fresh)
+    assert row(connect, fresh.id)[0] == 'done'
+
+
+def test_expired_last_attempt_is_reaped_not_reclaimed(jobs, connect):
+    jobs.enqueue('greet', {}, max_attempts=1)
+    job = jobs._claim()
+    expire_lease(connect, jobs)
+
+    assert jobs._claim() is None
+    jobs._reap_if_due()
+    status, attempts, _, error = row(connect, job.id)
+    assert (status, attempts) == ('dead', 1)
+    assert 'lease expired' in error
+    assert jobs.dead == 1
+
+
+def test_worker_thread_runs_enqueued_job(jobs):
+    ran = threading.Event()
+    jobs.handler('greet')(lambda job: ran.set())
+    jobs.start(workers=2)
+    jobs.enqueue('greet', {})
+    assert ran.wait(5)
@@ -0,0 +1,142 @@
+import pytest
+
+import repair_balances
+from utils.ledger import (CreditLimitExceeded, find_chain_breaks, find_drift, post_entry, read_balance,
+                          rebuild_balances)
+
+CUSTOMER, SELLER = 7, 3
+
+
+def set_limit(db, max_amount, used=0, active=True):
+    db.cursor().execute("""
+        INSERT INTO CreditLimits (CustomerID, SellerID, MaxCreditAmount, CurrentUsedAmount, IsActive)
+        VALUES (?, ?, ?, ?, ?)
+    """, (CUSTOMER, SELLER, max_amount, used, active))
+    db.commit()
+
+
+def used_amount(db):
+    cursor = db.cursor()
+    cursor.execute("SELECT CurrentUsedAmount FROM CreditLimits WHERE CustomerID=? AND SellerID=?",
+                   (CUSTOMER, SELLER))
+    return cursor.fetchone()[0]
+
+
+def ledger_count(db):
+    cursor = db.cursor()
+    cursor.execute("SELECT COUNT(*) FROM CustomerCredit")
+    return cursor.fetchone()[0]
+
+
+def test_post_entry_upserts_balance(db):
+    first = post_entry(db, CUSTOMER, SELLER, 'purchase', 100)
+    db.commit()
+    assert (first.balance_before, first.balance_after) == (0, 100)
+    assert read_balance(db.cursor(), CUSTOMER, SELLER) == 100
+
+    second = post_entry(db, CUSTOMER, SELLER, 'payment', 30)
+    db.commit()
+    assert (second.balance_before, second.balance_after) == (100, 70)
+    assert read_balance(db.cursor(), CUSTOMER, SELLER) == 70
+
+    cursor = db.cursor()
+    cursor.execute("SELECT COUNT(*), MAX(LastCreditID) FROM CustomerBalances")
+    assert cursor.fetchone() == (1, second.credit_id)
+
+
+def test_post_entry_seeds_balance_from_existing_ledger(db):
+    # A ledger row synced in from outside, with no materialized balance yet
+    db.cursor().execute("""
+        INSERT INTO CustomerCredit (CustomerID, SellerID, TransactionType, Amount, BalanceBefore, BalanceAfter)
+        VALUES (?, ?, 'purchase', 40, 0, 40)
+    """, (CUSTOMER, SELLER))
+    db.commit()
+
+    entry = post_entry(db, CUSTOMER, SELLER, 'purchase', 10)
+    db.commit()
+    assert (entry.balance_before, entry.balance_after) == (40, 50)
+
+
+def test_refund_reverses_purchase(db):
+    set_limit(db, 500)
+    post_entry(db, CUSTOMER, SELLER, 'purchase', 120)
+    entry = post_entry(db, CUSTOMER, SELLER, 'refund', 120)
+    db.commit()
+    assert entry.balance_after == 0
+    assert used_amount(db) == 0
+
+
+def test_credit_limit_rejects_purchase_without_writing(db):
+    set_limit(db, 100, used=80)
+
+    with pytest.raises(CreditLimitExceeded) as excinfo:
+        post_entry(db, CUSTOMER, SELLER, 'purchase', 30, enforce_limit=True)
+    db.rollback()
+
+    assert excinfo.value.remaining == 20
+    assert ledger_count(db) == 0
+    assert used_amount(db) == 80
+    assert read_balance(db.cursor(), CUSTOMER, SELLER) is None
+
+
+def test_credit_limit_only_enforced_when_asked(db):
+    set_limit(db, 100, used=80)
+    entry = post_entry(db, CUSTOMER, SELLER, 'purchase', 30)
+    db.commit()
+    assert entry.used_amount == 110
+
+
+def test_inactive_limit_is_not_enforced(db):
+    set_limit(db, 100, used=80, active=False)
+    post_entry(db, CUSTOMER, SELLER, 'purchase', 30, enforce_limit=True)
+    db.commit()
+    assert ledger_count(db) == 1
+
+
+def test_find_drift_and_rebuild(db):
+    post_entry(db, CUSTOMER, SELLER, 'purchase', 100)
+    post_entry(db, CUSTOMER + 1, SELLER, 'purchase', 5)
+    db.commit()
+    assert find_drift(db) == []
+
+    db.cursor().execute("UPDATE CustomerBalances SET Balance = 1 WHERE CustomerID=?", (CUSTOMER,))
+    db.cursor().execute("DELETE FROM CustomerBalances WHERE CustomerID=?", (CUSTOMER + 1,))
+    db.commit()
+    assert sorted(find_drift(db)) == [(CUSTOMER, SELLER, 1, 100), (CUSTOMER + 1, SELLER, None, 5)]
+    assert find_drift(db, seller_id=SELLER + 1) == []
+
+    assert rebuild_balances(db) == 2
+    assert find_drift(db) == []
+    assert read_balance(db.cursor(), CUSTOMER, SELLER) == 100
+
+
+def test_find_chain_breaks(db):
+    post_entry(db, CUSTOMER, SELLER, 'purchase', 100)
+    db.commit()
+    assert find_chain_breaks(db) == []
+
+    # A manual edit that doesn't continue from the previous BalanceAfter
+    cursor = db.cursor()
+    cursor.execute("""
+        INSERT INTO CustomerCredit (CustomerID, SellerID, TransactionType, Amount, BalanceBefore, BalanceAfter)
+        VALUES (?, ?, 'purchase', 10, 50, 60)
+    """, (CUSTOMER, SELLER))
+    broken_id = cursor.lastrowid
+    db.commit()
+
+    breaks = find_chain_breaks(db)
+    assert [(row[0], row[4], row[5]) for row in breaks] == [(broken_id, 50, 100)]
+    assert find_chain_breaks(db, seller_id=SELLER + 1) == []
+
+
+def test_repair_balances_reports_then_fixes(db, connect, monkeypatch, capsys):
+    monkeypatch.setattr(repair_balances, 'connect_from_env', connect)
+    post_entry(db, CUSTOMER, SELLER, 'purchase', 100)
+    db.cursor().execute("UPDATE CustomerBalances SET Balance = 1")
+    db.commit()
+
+    assert repair_balances.main([]) == 1
+    assert "stored 1" in capsys.readouterr().out
+    assert repair_balances.main(['--fix']) == 0
+    assert repair_balances.main([]) == 0
+    assert read_balance(db.cursor(), CUSTOMER, SELLER) == 100
@@ -0,0 +1,68 @@
+import multiprocessing
+import time
+
+import pytest
+
+from utils import outbound
+
+URL = 'https://api.telegram.org/bot123:abc/sendMessage'
+
+
+class Response:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self._body = body
+
+    def json(self):
+        return self._body
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """Sends succeed, except a text of 'flood' which gets one 429."""
+    log = []
+    flooded = set()
+
+    def http(self, method, url, kwargs):
+        params = kwargs['params']
+        if params['text'] == 'flood' and params['chat_id'] not in flooded:
+            flooded.add(params['chat_id'])
+            return Response(429, {'ok': False, 'parameters': {'retry_after': 0.5}})
+        log.append((time.monotonic(), params['chat_id']))
+        return Response(200, {'ok': True})
+
+    monkeypatch.setattr(outbound.OutboundLimiter, '_http', http)
+    return log
+
+
+def send(limiter, chat_id, text='hi'):
+    return limiter('post', URL, params={'chat_id': chat_id, 'text': text})
+
+
+def test_private_chat_429_pauses_every_process(sent):
+    pause = multiprocessing.RawValue('d', 0.0)
+    limiter = outbound.OutboundLimiter(shared_pause=pause)
+    other_process = outbound.OutboundLimiter(shared_pause=pause)
+
+    started = time.monotonic()
+    assert send(limiter, 1, 'flood').status_code == 200
+    assert pause.value > started
+    send(other_process, 2)
+    assert sent[-1][0] - started >= 0.5
+
+
+def test_group_429_pauses_only_that_group(sent):
+    limiter = outbound.OutboundLimiter()
+    send(limiter, -100, 'flood')
+    started = time.monotonic()
+    send(limiter, 5)
+    assert time.monotonic() - started < 0.3
+    assert limiter.global_bucket.blocked_until < time.monotonic()
+
+
+def test_result_wait_is_bounded(sent):
+    limiter = outbound.OutboundLimiter(chat_rate=0.1, chat_burst=1, result_timeout=0.2)
+    send(limiter, 1)
+    with pytest.raises(outbound.TimeoutError):
+        send(limiter, 1)
+    assert limiter.stats()['queued'] == 0
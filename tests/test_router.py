@@ -0,0 +1,141 @@
+import pytest
+import telebot
+from telebot import types
+
+from utils.callbacks import callback_action, encode
+from utils.router import Router, RoutedTeleBot, analyze_filter
+
+TOKEN = '123:abc'
+USER = 5
+user_states = {}
+
+
+def register(bot, log):
+    """The same handlers, in the same order, on a routed and a plain bot."""
+    def record(name):
+        def handler(update):
+            log.append(name)
+        handler.__name__ = name
+        return handler
+
+    bot.message_handler(commands=['start'])(record('start'))
+    bot.message_handler(func=lambda m: m.text == "🛒 Cart")(record('cart_button'))
+    bot.message_handler(func=lambda m: m.text in ["Help", "مساعدة"])(record('help'))
+    bot.message_handler(func=lambda m: user_states.get(m.from_user.id, {}).get("step") == "awaiting_name")(
+        record('awaiting_name'))
+    bot.message_handler(func=lambda m: user_states.get(m.from_user.id, {}).get("step") == "awaiting_phone"
+                        and m.text.isdigit())(record('awaiting_phone'))
+    bot.message_handler(func=lambda m: m.text.startswith("#"))(record('hashtag'))
+    bot.message_handler(func=lambda m: m.text == "late" and False)(record('never'))
+    bot.message_handler(func=lambda m: True)(record('fallback_text'))
+    bot.message_handler(func=lambda m: True, content_types=['photo'])(record('photo'))
+
+    bot.callback_query_handler(func=lambda c: c.data == "cart")(record('cb_cart'))
+    callback_action(bot, 'view_product')(lambda call, product_id: log.append(f'cb_product:{product_id}'))
+    bot.callback_query_handler(func=lambda c: c.data.startswith("view_"))(record('cb_view'))
+    bot.callback_query_handler(func=lambda c: c.data.startswith(("qty_", "q_")))(record('cb_qty'))
+    bot.callback_query_handler(func=lambda c: c.data.startswith("view_p"))(record('cb_view_p'))
+    bot.callback_query_handler(func=lambda c: user_states.get(c.from_user.id, {}).get("step") == "confirm"
+                               and c.data in ("yes", "no"))(record('cb_confirm'))
+    bot.callback_query_handler(func=lambda c: True)(record('cb_fallback'))
+
+
+def sender():
+    return {'id': USER, 'is_bot': False, 'first_name': 'a'}
+
+
+def message(update_id, text=None, photo=False):
+    body = {'message_id': update_id, 'date': 0, 'chat': {'id': USER, 'type': 'private'}, 'from': sender()}
+    if photo:
+        body['photo'] = [{'file_id': 'f', 'file_unique_id': 'u', 'width': 1, 'height': 1}]
+    else:
+        body['text'] = text
+    return types.Update.de_json({'update_id': update_id, 'message': body})
+
+
+def callback(update_id, data):
+    return types.Update.de_json({'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'from': sender(), 'chat_instance': 'c', 'data': data,
+        'message': {'message_id': 1, 'date': 0, 'chat': {'id': USER, 'type': 'private'}, 'text': 'x'}}})
+
+
+UPDATES = [
+    (None, lambda i: message(i, '/start')),
+    (None, lambda i: message(i, '🛒 Cart')),
+    (None, lambda i: message(i, 'Help')),
+    (None, lambda i: message(i, 'مساعدة')),
+    (None, lambda i: message(i, '#sale')),
+    (None, lambda i: message(i, 'hello')),
+    (None, lambda i: message(i, 'late')),
+    (None, lambda i: message(i, photo=True)),
+    ('awaiting_name', lambda i: message(i, 'Ali')),
+    ('awaiting_name', lambda i: message(i, '🛒 Cart')),
+    ('awaiting_phone', lambda i: message(i, '0790')),
+    ('awaiting_phone', lambda i: message(i, 'not a number')),
+    (None, lambda i: callback(i, 'cart')),
+    (None, lambda i: callback(i, 'view_1')),
+    (None, lambda i: callback(i, 'view_product')),
+    (None, lambda i: callback(i, 'qty_3')),
+    (None, lambda i: callback(i, 'q_1')),
+    (None, lambda i: callback(i, encode('view_product', 7))),
+    (None, lambda i: callback(i, 'yes')),
+    ('confirm', lambda i: callback(i, 'yes')),
+    (None, lambda i: callback(i, 'other')),
+]
+
+
+@pytest.fixture
+def bots():
+    routed_log, plain_log = [], []
+    router = Router(step_of=lambda telegram_id: user_states.get(telegram_id, {}).get('step'))
+    routed = RoutedTeleBot(TOKEN, threaded=False, router=router)
+    plain = telebot.TeleBot(TOKEN, threaded=False)
+    register(routed, routed_log)
+    register(plain, plain_log)
+    yield (routed, routed_log), (plain, plain_log)
+    user_states.clear()
+
+
+@pytest.mark.parametrize("step, make_update", UPDATES)
+def test_routed_bot_matches_legacy_dispatch(bots, step, make_update):
+    (routed, routed_log), (plain, plain_log) = bots
+    if step:
+        user_states[USER] = {'step': step}
+    routed.process_new_updates([make_update(1)])
+    plain.process_new_updates([make_update(1)])
+    assert routed_log == plain_log
+    assert len(routed_log) == 1
+
+
+def test_router_skips_handlers_that_cannot_match(bots):
+    (routed, _), _ = bots
+    routed.process_new_updates([message(1, 'Help')])
+    stats = routed.router.stats()
+    assert stats['kinds']['text'] == 3
+    assert stats['avg_candidates'] < 5
+    assert ('message', 'help', 'text', 1) in stats['routes']
+
+
+def test_handlers_registered_later_are_indexed(bots):
+    (routed, routed_log), _ = bots
+    routed.process_new_updates([message(1, 'hello')])
+    routed.message_handler(func=lambda m: m.text == "new")(lambda m: routed_log.append('new'))
+    routed.process_new_updates([message(2, 'new')])
+    # fallback_text was registered first, so it still wins, as it would without the index
+    assert routed_log == ['fallback_text', 'fallback_text']
+
+
+@pytest.mark.parametrize("func, expected", [
+    (lambda m: m.text == "a", ('text', ('a',))),
+    (lambda m: "a" == m.text, ('text', ('a',))),
+    (lambda m: m.text in ("a", "b"), ('text', ('a', 'b'))),
+    (lambda c: c.data == "x" and c.from_user.id > 0, ('data', ('x',))),
+    (lambda c: c.data.startswith(("p_", "q_")), ('prefix', ('p_', 'q_'))),
+    (lambda m: user_states[m.from_user.id]["step"] == "s", ('step', ('s',))),
+    (lambda m: m.text.startswith("x") and user_states.get(m.from_user.id, {}).get("step") == "s", ('step', ('s',))),
+    (lambda m: m.text == "a" or m.text == "b", None),
+    (lambda m: m.text != "a", None),
+    (lambda m, extra=1: True, None),
+])
+def test_analyze_filter(func, expected):
+    assert analyze_filter(func) == expected
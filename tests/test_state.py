@@ -0,0 +1,201 @@
+import threading
+
+import pytest
+from telebot import Handler
+
+from utils import state as state_module
+from utils.state import (PURGE_INTERVAL_SECONDS, SQLStateBackend, StateHandlerBackend, StateStore,
+                         flush_stores)
+
+TTL = 100
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(state_module, 'time', clock)
+    return clock
+
+
+class CountingBackend(SQLStateBackend):
+    def __init__(self, connect):
+        super().__init__(connect)
+        self.saves = 0
+
+    def save(self, namespace, key, blob, expires_at):
+        self.saves += 1
+        super().save(namespace, key, blob, expires_at)
+
+
+@pytest.fixture
+def backend(connect):
+    return CountingBackend(connect)
+
+
+def sql_store(backend, **kwargs):
+    """A store on the shared table; a second one stands for the bot after a restart."""
+    return StateStore('user_states', backend, ttl=TTL, **kwargs)
+
+
+def rows(connect):
+    conn = connect()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT StateKey FROM ConversationState ORDER BY StateKey")
+        return [row[0] for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+
+def next_step(message, order_id):
+    pass
+
+
+def test_dict_interface(clock):
+    store = StateStore('t', ttl=TTL)
+    store[1] = {'step': 'a'}
+    assert 1 in store and 2 not in store
+    assert store[1]['step'] == 'a'
+    assert store.get(2, 'missing') == 'missing'
+    assert store.setdefault(2, {}) == {}
+    assert len(store) == 2
+    assert store.pop(2) == {}
+    assert store.pop(2, None) is None
+    del store[1]
+    with pytest.raises(KeyError):
+        store[1]
+    with pytest.raises(KeyError):
+        del store[1]
+    assert len(store) == 0
+
+
+def test_sliding_ttl(clock):
+    store = StateStore('t', ttl=TTL)
+    store[1] = 'kept'
+    store[2] = 'idle'
+    for _ in range(3):
+        clock.now += TTL * 0.6
+        assert store.get(1) == 'kept'
+    assert 2 not in store
+
+
+def test_lru_drops_least_recently_used(clock):
+    store = StateStore('t', ttl=TTL, max_entries=2)
+    store[1] = 'a'
+    store[2] = 'b'
+    store.get(1)
+    store[3] = 'c'
+    assert store.get(1) == 'a' and store.get(3) == 'c'
+    assert 2 not in store
+
+
+def test_in_place_changes_survive_a_restart(clock, backend):
+    store = sql_store(backend)
+    store[5] = {'step': 'awaiting_name'}
+    store[5]['step'] = 'awaiting_phone'
+    store.flush()
+
+    assert sql_store(backend)[5] == {'step': 'awaiting_phone'}
+
+
+def test_unchanged_entries_are_not_rewritten(clock, backend):
+    store = sql_store(backend)
+    store[5] = {'step': 'a'}
+    store.flush()
+    store.get(5)
+    store.flush()
+    assert backend.saves == 1
+
+    # The sliding expiry is pushed once it has moved a quarter of the TTL
+    clock.now += TTL / 2
+    store.get(5)
+    store.flush()
+    assert backend.saves == 2
+
+
+def test_evicted_entries_are_written_back(clock, backend):
+    store = sql_store(backend, max_entries=1)
+    store[1] = 'a'
+    store[2] = 'b'
+    assert backend.saves == 1
+    assert store.get(1) == 'a'
+
+
+def test_delete_is_persisted(clock, backend, connect):
+    store = sql_store(backend)
+    store[5] = 'x'
+    store.flush()
+    del store[5]
+    store.flush()
+    assert rows(connect) == []
+    assert 5 not in sql_store(backend)
+
+
+def test_expired_rows_are_ignored_then_purged(clock, backend, connect):
+    store = sql_store(backend)
+    store[5] = 'x'
+    store.flush()
+    clock.now += TTL + 1
+    assert 5 not in sql_store(backend)
+
+    clock.now += PURGE_INTERVAL_SECONDS
+    store.flush()
+    assert rows(connect) == []
+
+
+def test_unpicklable_value_stays_in_memory(clock, backend, connect):
+    store = sql_store(backend)
+    store[5] = threading.Lock()
+    store.flush()
+    assert rows(connect) == []
+    assert 5 in store
+
+
+def test_slow_load_does_not_block_other_keys(clock, connect):
+    loading = threading.Event()
+    release = threading.Event()
+
+    class SlowBackend(SQLStateBackend):
+        def load(self, namespace, key):
+            if key == 'slow':
+                loading.set()
+                release.wait(5)
+            return super().load(namespace, key)
+
+    store = StateStore('t', SlowBackend(connect), ttl=TTL)
+    store['hot'] = 1
+    reader = threading.Thread(target=store.get, args=('slow',))
+    reader.start()
+    assert loading.wait(5)
+    assert store.get('hot') == 1              # answered while 'slow' is still loading
+    release.set()
+    reader.join()
+
+
+def test_next_step_handlers_survive_a_restart(clock, backend):
+    handlers = StateHandlerBackend(sql_store(backend))
+    handlers.register_handler(5, Handler(next_step, 42))
+
+    restored = StateHandlerBackend(sql_store(backend)).get_handlers(5)
+    assert [(h.callback.__name__, h.args) for h in restored] == [('next_step', (42,))]
+
+
+def test_unpicklable_next_step_handler_is_rejected(clock, backend):
+    handlers = StateHandlerBackend(sql_store(backend))
+    with pytest.raises(ValueError, match="can't be saved"):
+        handlers.register_handler(5, Handler(lambda message: None))
+
+
+def test_flush_stores_flushes_every_store(clock, backend):
+    store = sql_store(backend)
+    store[5] = 'x'
+    flush_stores()
+    assert sql_store(backend)[5] == 'x'
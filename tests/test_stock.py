@@ -0,0 +1,57 @@
+from utils.stock import StockShortage, release_stock, reserve_stock
+
+
+def add_product(db, name, quantity):
+    cursor = db.cursor()
+    cursor.execute("INSERT INTO Products (SellerID, Name, Price, Quantity) VALUES (1, ?, 10, ?)", (name, quantity))
+    db.commit()
+    return cursor.lastrowid
+
+
+def quantity(db, product_id):
+    cursor = db.cursor()
+    cursor.execute("SELECT Quantity FROM Products WHERE ProductID=?", (product_id,))
+    return cursor.fetchone()[0]
+
+
+def test_reserve_decrements_every_item(db):
+    tea = add_product(db, "Tea", 5)
+    rice = add_product(db, "Rice", 2)
+
+    assert reserve_stock(db, [(tea, 3), (rice, 2)]) == []
+    db.commit()
+    assert (quantity(db, tea), quantity(db, rice)) == (2, 0)
+
+
+def test_reserve_merges_repeated_products(db):
+    tea = add_product(db, "Tea", 5)
+    assert reserve_stock(db, [(tea, 2), (tea, 3)]) == []
+    db.commit()
+    assert quantity(db, tea) == 0
+
+
+def test_reserve_reports_shortages(db):
+    tea = add_product(db, "Tea", 5)
+    rice = add_product(db, "Rice", 1)
+    missing = 999
+
+    shortages = reserve_stock(db, [(tea, 2), (rice, 1), (rice, 1), (missing, 1)])
+    assert shortages == [StockShortage(rice, "Rice", 2, 1), StockShortage(missing, None, 1, 0)]
+
+    # The caller rolls back, undoing the items that did fit
+    db.rollback()
+    assert (quantity(db, tea), quantity(db, rice)) == (5, 1)
+
+
+def test_reserve_nothing(db):
+    assert reserve_stock(db, []) == []
+
+
+def test_release_puts_stock_back(db):
+    tea = add_product(db, "Tea", 5)
+    reserve_stock(db, [(tea, 4)])
+    db.commit()
+
+    release_stock(db, [(tea, 1), (tea, 3)])
+    db.commit()
+    assert quantity(db, tea) == 5
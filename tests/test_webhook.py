@@ -0,0 +1,151 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from utils.webhook import SECRET_HEADER, UpdateOffsets, WebhookServer
+
+SECRET = 'secret'
+
+
+@pytest.fixture
+def offsets(connect):
+    return UpdateOffsets(connect)
+
+
+@pytest.fixture
+def make_server(offsets):
+    servers = []
+
+    def make_server(handle=lambda update: None):
+        server = WebhookServer(handle, SECRET, host='127.0.0.1', port=0, offsets=offsets)
+        servers.append(server)
+        return server
+
+    yield make_server
+    for server in servers:
+        server.httpd.server_close()
+
+
+def deliver(server, update_id):
+    """What do_POST does for a successfully handled update."""
+    assert server.first_delivery(update_id)
+    return server.advance(update_id)
+
+
+def test_duplicates_are_dropped(make_server):
+    server = make_server()
+    assert deliver(server, 1)
+    assert not server.first_delivery(1)
+    assert server.recorded(1)
+
+
+def test_offset_is_a_low_watermark(offsets, make_server):
+    server = make_server()
+    assert deliver(server, 10)
+    assert server.first_delivery(11)          # still running
+    assert deliver(server, 12)
+    assert deliver(server, 13)
+    assert offsets.last() == 10
+    assert not server.recorded(11)
+
+    assert server.advance(11)
+    assert offsets.last() == 13
+
+
+def test_restart_redelivers_updates_that_were_in_flight(offsets, make_server):
+    server = make_server()
+    assert deliver(server, 10)
+    assert server.first_delivery(11)
+    assert deliver(server, 12)
+    # Crash while 11 is still running
+
+    restarted = make_server()
+    assert not restarted.first_delivery(10)
+    assert restarted.first_delivery(11)
+    assert restarted.first_delivery(12)       # handled again rather than lost
+
+
+def test_failed_update_holds_the_offset_until_redelivered(offsets, make_server):
+    server = make_server()
+    assert server.first_delivery(5)
+    server.forget(5)                          # handle raised, Telegram will retry
+    assert deliver(server, 6)
+    assert offsets.last() == 0
+
+    assert deliver(server, 5)
+    assert offsets.last() == 6
+
+
+def test_failed_offset_write_is_retried_on_redelivery(offsets, make_server):
+    server = make_server()
+    real_advance = offsets.advance
+    offsets.advance = lambda update_id: (_ for _ in ()).throw(RuntimeError("db down"))
+    assert not deliver(server, 3)
+    assert not server.recorded(3)
+
+    offsets.advance = real_advance
+    assert server.recorded(3)
+    assert offsets.last() == 3
+
+
+def test_offset_never_goes_backwards(offsets):
+    offsets.advance(50)
+    offsets.advance(40)
+    assert offsets.last() == 50
+
+
+class TestHTTP:
+    @pytest.fixture
+    def served(self, make_server):
+        handled = []
+        failures = {'left': 0}
+
+        def handle(update):
+            if failures['left']:
+                failures['left'] -= 1
+                raise RuntimeError("handler failed")
+            handled.append(update['update_id'])
+
+        server = make_server(handle)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield server, handled, failures
+        server.httpd.shutdown()
+
+    @staticmethod
+    def post(server, update, secret=SECRET, path='/webhook'):
+        port = server.httpd.server_address[1]
+        request = urllib.request.Request(f'http://127.0.0.1:{port}{path}', data=json.dumps(update).encode(),
+                                         headers={SECRET_HEADER: secret, 'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def test_wrong_secret_is_rejected(self, served):
+        server, handled, _ = served
+        assert self.post(server, {'update_id': 1}, secret='nope') == 403
+        assert handled == []
+
+    def test_bad_payload(self, served):
+        server, _, _ = served
+        assert self.post(server, {'no_id': 1}) == 400
+
+    def test_handled_once(self, served):
+        server, handled, _ = served
+        assert self.post(server, {'update_id': 1}) == 200
+        assert self.post(server, {'update_id': 1}) == 200
+        assert handled == [1]
+        assert server.duplicates == 1
+
+    def test_failed_handle_is_retried(self, served):
+        server, handled, failures = served
+        failures['left'] = 1
+        assert self.post(server, {'update_id': 7}) == 500
+        assert self.post(server, {'update_id': 7}) == 200
+        assert handled == [7]
+        assert server.offsets.last() == 7
@@ -0,0 +1,75 @@
+import os
+import threading
+import time
+
+import pytest
+
+from utils.workers import PartitionedDispatcher, partition_for
+
+
+def handle(update, done):
+    action = update.get('action')
+    if action == 'fail':
+        raise RuntimeError("bad update")
+    if action == 'die':
+        os._exit(3)
+    if action == 'later':
+        threading.Timer(0.3, done).start()
+        return
+    done()
+
+
+def message(update_id, chat_id, action=None):
+    return {'update_id': update_id, 'action': action, 'message': {'chat': {'id': chat_id}}}
+
+
+@pytest.fixture
+def dispatcher():
+    dispatcher = PartitionedDispatcher(handle, 2)
+    dispatcher.start()
+    yield dispatcher
+    dispatcher.stop(timeout=5)
+
+
+def test_partition_follows_chat():
+    assert partition_for(message(1, 10), 4) == partition_for(message(2, 10), 4) == 2
+    assert partition_for({'callback_query': {'from': {'id': 7}}}, 4) == 3
+    assert partition_for({'update_id': 9}, 4) == 1
+
+
+def test_dispatch_waits_for_the_worker(dispatcher):
+    started = time.monotonic()
+    dispatcher.dispatch(message(1, 10, 'later'), wait=5)
+    assert time.monotonic() - started >= 0.3
+    assert sum(dispatcher.dispatched) == 1
+
+
+def test_dispatch_raises_when_handling_failed(dispatcher):
+    with pytest.raises(RuntimeError, match="bad update"):
+        dispatcher.dispatch(message(1, 10, 'fail'), wait=5)
+
+
+def test_dead_worker_is_reported_and_restarted(dispatcher):
+    with pytest.raises(RuntimeError, match="exited"):
+        dispatcher.dispatch(message(1, 10, 'die'), wait=5)
+    dispatcher.dispatch(message(2, 10), wait=5)
+    assert dispatcher.restarts == 1
+
+
+def test_dispatch_without_wait_only_queues(dispatcher):
+    started = time.monotonic()
+    dispatcher.dispatch(message(1, 11, 'later'))
+    assert time.monotonic() - started < 0.3
+
+
+def test_concurrent_dispatch_restarts_a_dead_worker_once(dispatcher):
+    with pytest.raises(RuntimeError):
+        dispatcher.dispatch(message(1, 10, 'die'), wait=5)
+    threads = [threading.Thread(target=dispatcher.dispatch, args=(message(100 + i, 10),), kwargs={'wait': 10})
+               for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert dispatcher.restarts == 1
+    assert sum(dispatcher.dispatched) == 9
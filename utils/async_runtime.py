@@ -0,0 +1,303 @@
+"""
+Opt-in asyncio runtime (BOT_RUNTIME=async).
+
+HybridAsyncTeleBot is an AsyncTeleBot that owns only the handlers already ported to async.
+An update that none of them match is handed to the synchronous TeleBot unchanged, so its
+150+ existing handlers, middlewares and the per-chat scheduler keep working. Handlers move
+over one at a time.
+Handlers registered on the hybrid bot may be coroutines (preferred) or plain functions; plain
+functions are run on the blocking executor so they never stall the event loop.
+
+AsyncDatabase is the async counterpart of utils/db.py: the same SQLite-style SQL
+(? placeholders, compiled once by utils.sql_dialect) over aiosqlite or asyncpg, behind a
+DBWrapper/CursorWrapper-shaped API whose methods are awaited:
+
+    conn = await adb.connection()
+    try:
+        cursor = conn.cursor()
+        await cursor.execute("SELECT UserType FROM Users WHERE TelegramID = ?", (uid,))
+        row = await cursor.fetchone()
+    finally:
+        await conn.close()
+
+Blocking or CPU-bound work (Pillow renders, sync helpers) goes through run_blocking().
+
+AsyncTeleBot talks to Telegram through aiohttp, not telebot's apihelper, so the sync
+OutboundLimiter would not see its sends; route_through_limiter() hands the async bot's
+message-producing calls to the same limiter, so both runtimes share one set of limits.
+
+Requires aiohttp (AsyncTeleBot) plus aiosqlite or asyncpg (requirements-async.txt); none of
+them is needed in the default synchronous runtime, which never imports this module.
+"""
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from inspect import iscoroutinefunction
+
+from telebot import asyncio_helper, types
+from telebot.async_telebot import AsyncTeleBot
+
+from utils.sql_dialect import compile_query, to_positional
+
+try:
+    import aiosqlite
+except ImportError:
+    aiosqlite = None
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+BLOCKING_THREADS = int(os.environ.get('ASYNC_BLOCKING_THREADS', '8'))
+_blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_THREADS, thread_name_prefix='blocking')
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Runs a blocking call on the shared executor and awaits its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_blocking_executor, functools.partial(func, *args, **kwargs))
+
+
+def to_async(func):
+    """Coroutine wrapper for a sync handler; wraps() keeps the signature telebot inspects."""
+    if iscoroutinefunction(func):
+        return func
+
+    @functools.wraps(func)
+    async def run(*args, **kwargs):
+        return await run_blocking(func, *args, **kwargs)
+    return run
+
+
+# ===================== Outbound limits =====================
+_direct_process_request = asyncio_helper._process_request
+
+
+def route_through_limiter(limiter):
+    """
+    Sends the async bot's limited calls (see OutboundLimiter.is_limited) through `limiter` on
+    the blocking executor; everything else (getUpdates, answerCallbackQuery, ...) stays on aiohttp.
+    """
+    async def process_request(token, url, method='get', params=None, files=None, **kwargs):
+        if not limiter.is_limited(url, params):
+            return await _direct_process_request(token, url, method, params, files, **kwargs)
+        timeout = kwargs.get('request_timeout') or (params.pop('timeout', None) if params else None) \
+            or asyncio_helper.REQUEST_TIMEOUT
+        for key, value in dict(files or {}).items():
+            if isinstance(value, types.InputFile):
+                files[key] = value.file
+        response = await run_blocking(limiter, method, asyncio_helper.API_URL.format(token, url),
+                                      params=params, files=files, timeout=timeout)
+        try:
+            result_json = response.json()
+        except ValueError:
+            if response.status_code != 200:
+                raise asyncio_helper.ApiException(f"The server returned HTTP {response.status_code}", url, response)
+            raise asyncio_helper.ApiInvalidJSONException(url, response.text)
+        if not result_json['ok']:
+            raise asyncio_helper.ApiTelegramException(url, response, result_json)
+        return result_json['result']
+
+    asyncio_helper._process_request = process_request
+
+
+# ===================== Async database =====================
+class AsyncCursorWrapper:
+    def __init__(self, conn):
+        self._conn = conn
+        self._rows = []
+        self._sqlite_cursor = None
+        self.lastrowid = None
+        self.rowcount = -1
+
+    async def execute(self, query, params=None):
+        params = tuple(params) if params is not None else ()
+        if self._conn.is_postgres:
+            compiled = compile_query(query, True)
+            await self._conn.begin()
+            sql = to_positional(compiled.sql)
+            upper = sql.lstrip().upper()
+            # Both calls go through asyncpg's per-connection prepared statement cache
+            if upper.startswith(('SELECT', 'WITH')) or 'RETURNING' in upper:
+                self._rows = [tuple(row) for row in await self._conn.raw.fetch(sql, *params)]
+                self.rowcount = len(self._rows)
+            else:
+                self._rows = []
+                status = await self._conn.raw.execute(sql, *params) or ''
+                last = status.rsplit(' ', 1)[-1]
+                self.rowcount = int(last) if last.isdigit() else -1
+            if compiled.is_insert_returning and self._rows:
+                self.lastrowid = self._rows[0][0]
+        else:
+            compiled = compile_query(query, False)
+            cursor = await self._conn.raw.execute(compiled.sql, params)
+            self._rows = None
+            self._sqlite_cursor = cursor
+            self.lastrowid = cursor.lastrowid
+            self.rowcount = cursor.rowcount
+        return self
+
+    async def fetchone(self):
+        if self._sqlite_cursor is not None:
+            return await self._sqlite_cursor.fetchone()
+        return self._rows.pop(0) if self._rows else None
+
+    async def fetchall(self):
+        if self._sqlite_cursor is not None:
+            return await self._sqlite_cursor.fetchall()
+        rows, self._rows = self._rows, []
+        return rows
+
+
+class AsyncDBWrapper:
+    def __init__(self, raw, is_postgres, release):
+        self.raw = raw
+        self.is_postgres = is_postgres
+        self._release = release
+        self._transaction = None
+        self._closed = False
+
+    def cursor(self):
+        return AsyncCursorWrapper(self)
+
+    async def begin(self):
+        # Postgres: statements run in one transaction until commit/rollback, like psycopg2
+        if self.is_postgres and self._transaction is None:
+            self._transaction = self.raw.transaction()
+            await self._transaction.start()
+
+    async def commit(self):
+        if self.is_postgres:
+            if self._transaction is not None:
+                await self._transaction.commit()
+                self._transaction = None
+        else:
+            await self.raw.commit()
+
+    async def rollback(self):
+        if self.is_postgres:
+            if self._transaction is not None:
+                await self._transaction.rollback()
+                self._transaction = None
+        else:
+            await self.raw.rollback()
+
+    async def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        # Uncommitted work is discarded, as with a pooled sync connection
+        await self.rollback()
+        await self._release(self.raw)
+
+
+class AsyncDatabase:
+    """
+    Async connection source for either Postgres (asyncpg pool) or SQLite (aiosqlite).
+    SQLite connections are kept open and reused, up to pool_size at a time, like SQLitePool.
+    """
+
+    def __init__(self, database_url=None, sqlite_path=None, pool_size=10):
+        self.database_url = database_url
+        self.sqlite_path = sqlite_path
+        self.pool_size = pool_size
+        self.is_postgres = bool(database_url)
+        self._pool = None
+        self._sqlite_idle = None    # asyncio.LifoQueue of open aiosqlite connections
+        self._sqlite_open = 0
+
+    @classmethod
+    def from_env(cls, sqlite_path):
+        return cls(database_url=os.environ.get('DATABASE_URL'), sqlite_path=sqlite_path,
+                   pool_size=int(os.environ.get('ASYNC_DB_POOL_SIZE', '10')))
+
+    async def connection(self):
+        if self.is_postgres:
+            if asyncpg is None:
+                raise RuntimeError("asyncpg is required for the async runtime on Postgres")
+            if self._pool is None:
+                self._pool = await asyncpg.create_pool(self.database_url, min_size=1, max_size=self.pool_size)
+            raw = await self._pool.acquire()
+            return AsyncDBWrapper(raw, True, self._pool.release)
+
+        if aiosqlite is None:
+            raise RuntimeError("aiosqlite is required for the async runtime on SQLite")
+        if self._sqlite_idle is None:
+            self._sqlite_idle = asyncio.LifoQueue()
+        if self._sqlite_idle.empty() and self._sqlite_open < self.pool_size:
+            self._sqlite_open += 1
+            try:
+                raw = await aiosqlite.connect(self.sqlite_path, timeout=30)
+                await raw.execute("PRAGMA journal_mode=WAL")
+                await raw.execute("PRAGMA synchronous=NORMAL")
+            except Exception:
+                self._sqlite_open -= 1
+                raise
+        else:
+            raw = await self._sqlite_idle.get()
+        return AsyncDBWrapper(raw, False, self._release_sqlite)
+
+    async def _release_sqlite(self, raw):
+        self._sqlite_idle.put_nowait(raw)
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+        if self._sqlite_idle is not None:
+            while not self._sqlite_idle.empty():
+                await self._sqlite_idle.get_nowait().close()
+                self._sqlite_open -= 1
+
+
+# ===================== Hybrid bot =====================
+# Update fields the hybrid bot can handle itself; everything else always goes to the sync bot
+_ASYNC_UPDATE_TYPES = (('message', 'message_handlers'), ('callback_query', 'callback_query_handlers'))
+
+
+class HybridAsyncTeleBot(AsyncTeleBot):
+    def __init__(self, token, sync_bot, **kwargs):
+        super().__init__(token, **kwargs)
+        self.sync_bot = sync_bot
+        self.handled_async = 0
+        self.handed_to_sync = 0
+
+    def add_message_handler(self, handler_dict):
+        handler_dict['function'] = to_async(handler_dict['function'])
+        super().add_message_handler(handler_dict)
+
+    def add_callback_query_handler(self, handler_dict):
+        handler_dict['function'] = to_async(handler_dict['function'])
+        super().add_callback_query_handler(handler_dict)
+
+    async def _match(self, update):
+        """(update_type, payload, handler) for the first async handler that accepts the update, or None."""
+        for update_type, attribute in _ASYNC_UPDATE_TYPES:
+            payload = getattr(update, update_type, None)
+            if payload is None:
+                continue
+            for handler in getattr(self, attribute):
+                if await self._test_message_handler(handler, payload):
+                    return update_type, payload, handler
+        return None
+
+    async def process_new_updates(self, updates):
+        handed_over = []
+        tasks = []
+        for update in updates:
+            match = await self._match(update)
+            if match is None:
+                handed_over.append(update)
+                continue
+            update_type, payload, handler = match
+            middlewares = await self._get_middlewares(update_type)
+            tasks.append(self._run_middlewares_and_handlers(payload, [handler], middlewares, update_type))
+        self.handled_async += len(tasks)
+        if handed_over:
+            self.handed_to_sync += len(handed_over)
+            # Only enqueues on the sync bot's scheduler, but its next-step lookup may touch the DB
+            await run_blocking(self.sync_bot.process_new_updates, handed_over)
+        if tasks:
+            await asyncio.gather(*tasks)
@@ -0,0 +1,141 @@
+"""
+Compact callback_data codec.
+
+Legacy buttons carry ad-hoc strings such as "viewcat_{cat_id}_{seller_id}" that every handler
+re-splits and int()-parses, with overlapping prefixes. Buttons built with encode() instead carry
+
+    ~ <version> <action code> [. <arg> [. <arg> ...]]        e.g. "~1vc.2s.a1b2c3"
+
+where integer arguments are base-36 (a Telegram ID fits in 7 characters instead of 10), so the
+64-byte callback_data budget goes much further. The payload is decoded once per update
+(decode_call caches it on the CallbackQuery), the router finds the handler by action code, and
+handlers registered with callback_action() receive typed arguments:
+
+    @callback_action(bot, 'view_category')
+    def view_category(call, category_id, seller_id): ...
+
+Action codes are part of the wire format: buttons already sent to users keep their codes, so a
+code must never be reused for a different action or argument layout. Changing the layout of
+every action at once means bumping CODEC_VERSION; payloads from another version decode to None.
+"""
+from collections import namedtuple
+
+CALLBACK_PREFIX = '~'
+CODEC_VERSION = '1'
+ARG_SEPARATOR = '.'
+# Telegram rejects buttons whose callback_data is longer than this (in bytes)
+MAX_CALLBACK_BYTES = 64
+
+CallbackAction = namedtuple('CallbackAction', ['code', 'name', 'arg_types'])
+CallbackPayload = namedtuple('CallbackPayload', ['action', 'args'])
+
+# code -> (name, argument types)
+_ACTION_TABLE = {
+    'vs': ('view_store', (int,)),
+    'vc': ('view_category', (int, int)),
+    'vp': ('view_product', (int,)),
+    'qi': ('qty_inc', (int, int)),
+    'qd': ('qty_dec', (int, int)),
+    'ac': ('add_to_cart', (int, int)),
+    'ci': ('cart_inc', (int,)),
+    'cd': ('cart_dec', (int,)),
+    'cr': ('cart_remove', (int,)),
+}
+
+ACTIONS_BY_CODE = {code: CallbackAction(code, name, types) for code, (name, types) in _ACTION_TABLE.items()}
+ACTIONS_BY_NAME = {action.name: action for action in ACTIONS_BY_CODE.values()}
+
+_BASE36 = '0123456789abcdefghijklmnopqrstuvwxyz'
+_MISSING = object()
+
+
+def _int_to_base36(value):
+    if value < 0:
+        return '-' + _int_to_base36(-value)
+    digits = []
+    while True:
+        value, rem = divmod(value, 36)
+        digits.append(_BASE36[rem])
+        if not value:
+            return ''.join(reversed(digits))
+
+
+def _encode_arg(value, arg_type):
+    if arg_type is int:
+        return _int_to_base36(int(value))
+    text = str(value)
+    if ARG_SEPARATOR in text:
+        raise ValueError(f"callback argument {text!r} contains {ARG_SEPARATOR!r}")
+    return text
+
+
+def _decode_arg(text, arg_type):
+    if arg_type is int:
+        return int(text, 36)
+    return text
+
+
+def encode(name, *args):
+    """callback_data for action `name` with the given arguments."""
+    action = ACTIONS_BY_NAME[name]
+    if len(args) != len(action.arg_types):
+        raise ValueError(f"{name} takes {len(action.arg_types)} arguments, got {len(args)}")
+    parts = [CALLBACK_PREFIX + CODEC_VERSION + action.code]
+    parts.extend(_encode_arg(value, arg_type) for value, arg_type in zip(args, action.arg_types))
+    data = ARG_SEPARATOR.join(parts)
+    if len(data.encode('utf-8')) > MAX_CALLBACK_BYTES:
+        raise ValueError(f"callback_data for {name} is longer than {MAX_CALLBACK_BYTES} bytes")
+    return data
+
+
+def is_encoded(data):
+    return bool(data) and data.startswith(CALLBACK_PREFIX)
+
+
+def decode(data):
+    """CallbackPayload for codec data, or None for legacy, stale-version or malformed data."""
+    if not is_encoded(data) or data[1:2] != CODEC_VERSION:
+        return None
+    head, *raw_args = data[2:].split(ARG_SEPARATOR)
+    action = ACTIONS_BY_CODE.get(head)
+    if action is None or len(raw_args) != len(action.arg_types):
+        return None
+    try:
+        args = tuple(_decode_arg(text, arg_type) for text, arg_type in zip(raw_args, action.arg_types))
+    except ValueError:
+        return None
+    return CallbackPayload(action, args)
+
+
+def decode_call(call):
+    """decode(call.data), computed once per CallbackQuery."""
+    payload = getattr(call, '_callback_payload', _MISSING)
+    if payload is _MISSING:
+        payload = decode(call.data)
+        call._callback_payload = payload
+    return payload
+
+
+def action_filter(name):
+    """Handler filter matching codec payloads of one action; the router indexes it by code."""
+    action = ACTIONS_BY_NAME[name]
+
+    def matches(call):
+        payload = decode_call(call)
+        return payload is not None and payload.action is action
+
+    matches.callback_action = action.code
+    return matches
+
+
+def callback_action(bot, name):
+    """Registers handler(call, *args) for action `name`, called with the decoded, typed arguments."""
+    def decorator(handler):
+        def dispatch(call):
+            return handler(call, *decode_call(call).args)
+
+        # telebot inspects the registered function's signature, so it must stay (call)
+        dispatch.__name__ = handler.__name__
+        bot.callback_query_handler(func=action_filter(name))(dispatch)
+        return handler
+    return decorator
@@ -0,0 +1,62 @@
+"""
+Per-update identity context.
+
+While an update is being handled, lookups such as "who is this Telegram user" and "which store
+does this seller own" are answered once and memoized, so the filter lambdas and every helper
+the handler calls share one result instead of each querying the database again.
+Any code that writes Users or Sellers calls invalidate_context() so later reads in the same
+update see the change.
+"""
+import threading
+
+_context_local = threading.local()
+
+_MISSING = object()
+
+
+class UpdateContext:
+    def __init__(self, telegram_id=None):
+        # The Telegram user the update came from (None for updates without a sender)
+        self.telegram_id = telegram_id
+        self._values = {}
+        self.loads = 0
+
+    def get(self, kind, key, loader):
+        """Returns loader(key), calling it at most once per (kind, key) for this update."""
+        value = self._values.get((kind, key), _MISSING)
+        if value is _MISSING:
+            value = loader(key)
+            self._values[(kind, key)] = value
+            self.loads += 1
+        return value
+
+    def invalidate(self):
+        self._values.clear()
+
+
+def current_context():
+    return getattr(_context_local, 'context', None)
+
+
+def begin_context(telegram_id=None):
+    context = UpdateContext(telegram_id)
+    _context_local.context = context
+    return context
+
+
+def end_context():
+    _context_local.context = None
+
+
+def cached(kind, key, loader):
+    """loader(key) memoized in the current update's context; a plain call outside of one."""
+    context = current_context()
+    if context is None:
+        return loader(key)
+    return context.get(kind, key, loader)
+
+
+def invalidate_context():
+    context = current_context()
+    if context is not None:
+        context.invalidate()
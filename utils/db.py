@@ -0,0 +1,521 @@
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+from contextlib import contextmanager
+from collections import deque
+
+from utils.sql_dialect import compile_query, execute_sql
+
+try:
+    import psycopg2
+    from psycopg2 import extensions as pg_extensions
+except ImportError:
+    psycopg2 = None
+    pg_extensions = None
+
+
+# ===================== Database Wrapper =====================
+class DBWrapper:
+    def __init__(self, conn, is_postgres=False, release=None):
+        self.conn = conn
+        self.is_postgres = is_postgres
+        # When the connection comes from a pool, close() hands it back instead of closing it
+        self._release = release
+        self._closed = False
+
+    def cursor(self):
+        return CursorWrapper(self.conn.cursor(), self.is_postgres)
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._release:
+            self._release(self.conn)
+        else:
+            self.conn.close()
+
+class CursorWrapper:
+    def __init__(self, cursor, is_postgres=False):
+        self.cursor = cursor
+        self.is_postgres = is_postgres
+        self.lastrowid = None # Placeholder
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def execute(self, query, params=None):
+        # Each distinct statement is translated once and cached (see utils/sql_dialect.py)
+        compiled = compile_query(query, self.is_postgres)
+
+        try:
+            if self.is_postgres:
+                execute_sql(self.cursor, compiled, params)
+            elif params is None:
+                self.cursor.execute(compiled.sql)
+            else:
+                self.cursor.execute(compiled.sql, params)
+
+            # Try to capture lastrowid if supported
+            if not self.is_postgres:
+                self.lastrowid = self.cursor.lastrowid
+            else:
+                # Psycopg2: lastrowid is often OID, not PK.
+                # If RETURNING was used, we need to fetchone to get it.
+                if compiled.is_insert_returning:
+                    res = self.cursor.fetchone()
+                    if res:
+                        self.lastrowid = res[0]
+        except Exception as e:
+            raise e
+
+        return self
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def close(self):
+        self.cursor.close()
+
+
+def begin_write(conn):
+    """
+    SQLite: makes sure a write transaction is open, taking the database write lock up front.
+    Needed before read-then-write sequences and before statements sqlite3 would otherwise
+    autocommit (it only opens transactions implicitly for INSERT/UPDATE/DELETE/REPLACE, not WITH).
+    A connection already in a transaction has written, so it already holds the lock.
+    Postgres always runs inside a transaction; callers there use row locks instead.
+    """
+    if not conn.is_postgres and not conn.conn.in_transaction:
+        conn.conn.execute("BEGIN IMMEDIATE")
+
+
+# ===================== Connection Pools =====================
+class PoolTimeout(Exception):
+    pass
+
+
+class _PooledConnection:
+    """A raw connection plus the bookkeeping the pool needs to recycle it."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+
+class PostgresPool:
+    """
+    Thread-safe psycopg2 pool.
+    - Keeps up to `size` idle connections open between updates.
+    - Hands out up to `max_overflow` extra connections when every pooled one is busy
+      (nested helpers); those are closed on release instead of being kept.
+    - Connections idle for more than `health_check_after` seconds are pinged before reuse,
+      and connections older than `max_lifetime` seconds are replaced.
+    """
+
+    def __init__(self, database_url, size=4, max_overflow=4, max_lifetime=1800,
+                 health_check_after=30, acquire_timeout=30, connect_retries=3):
+        if psycopg2 is None:
+            raise RuntimeError("psycopg2 is required when DATABASE_URL is set")
+
+        result = urllib.parse.urlparse(database_url)
+        self.host = result.hostname
+        self._connect_kwargs = {
+            'database': result.path[1:],
+            'user': result.username,
+            'password': result.password,
+            'host': result.hostname,
+            'port': result.port,
+        }
+        self.size = size
+        self.max_overflow = max_overflow
+        self.max_lifetime = max_lifetime
+        self.health_check_after = health_check_after
+        self.acquire_timeout = acquire_timeout
+        self.connect_retries = connect_retries
+
+        self._idle = deque()
+        self._in_use = {}
+        self._total = 0
+        self._cond = threading.Condition()
+
+    def _connect(self):
+        last_error = None
+        for attempt in range(self.connect_retries):
+            try:
+                return _PooledConnection(psycopg2.connect(**self._connect_kwargs))
+            except psycopg2.OperationalError as e:
+                last_error = e
+                print(f"⚠️ Postgres connect failed (attempt {attempt + 1}/{self.connect_retries}): {e}")
+                time.sleep(0.5 * (2 ** attempt))
+        raise last_error
+
+    def _discard(self, pooled):
+        try:
+            pooled.raw.close()
+        except Exception:
+            pass
+
+    def _is_usable(self, pooled):
+        now = time.monotonic()
+        if pooled.raw.closed:
+            return False
+        if self.max_lifetime and now - pooled.created_at > self.max_lifetime:
+            return False
+        if self.health_check_after and now - pooled.last_used > self.health_check_after:
+            try:
+                cur = pooled.raw.cursor()
+                cur.execute("SELECT 1")
+                cur.close()
+                pooled.raw.rollback()
+            except Exception:
+                return False
+        return True
+
+    def acquire(self):
+        deadline = time.monotonic() + self.acquire_timeout
+        with self._cond:
+            while True:
+                if self._idle:
+                    pooled = self._idle.pop()
+                    break
+                if self._total < self.size + self.max_overflow:
+                    self._total += 1
+                    pooled = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(f"No database connection available after {self.acquire_timeout}s")
+                self._cond.wait(remaining)
+
+        try:
+            if pooled is not None and not self._is_usable(pooled):
+                self._discard(pooled)
+                pooled = None
+            if pooled is None:
+                pooled = self._connect()
+        except Exception:
+            with self._cond:
+                self._total -= 1
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self._in_use[id(pooled.raw)] = pooled
+        return pooled.raw
+
+    def release(self, raw):
+        with self._cond:
+            pooled = self._in_use.pop(id(raw), None)
+        if pooled is None:
+            return
+
+        keep = not raw.closed
+        if keep:
+            try:
+                status = raw.get_transaction_status()
+                if status == pg_extensions.TRANSACTION_STATUS_UNKNOWN:
+                    keep = False
+                elif status != pg_extensions.TRANSACTION_STATUS_IDLE:
+                    # Uncommitted work is discarded, exactly like closing the connection did
+                    raw.rollback()
+            except Exception:
+                keep = False
+
+        with self._cond:
+            if keep and len(self._idle) < self.size:
+                pooled.last_used = time.monotonic()
+                self._idle.append(pooled)
+            else:
+                self._total -= 1
+                self._discard(pooled)
+            self._cond.notify()
+
+    def connection(self):
+        return DBWrapper(self.acquire(), is_postgres=True, release=self.release)
+
+    def close_all(self):
+        with self._cond:
+            while self._idle:
+                self._discard(self._idle.pop())
+                self._total -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {'total': self._total, 'idle': len(self._idle), 'in_use': len(self._in_use)}
+
+
+class SQLitePool:
+    """
+    Persistent SQLite connections kept per thread.
+    The first connection a thread asks for stays open for the life of the thread;
+    nested helpers that need a second connection while the first is busy get their own.
+    """
+
+    def __init__(self, path, max_idle_per_thread=2, timeout=30):
+        self.path = path
+        self.max_idle_per_thread = max_idle_per_thread
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _idle(self):
+        idle = getattr(self._local, 'idle', None)
+        if idle is None:
+            idle = self._local.idle = []
+        return idle
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout, cached_statements=256)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        except sqlite3.DatabaseError as e:
+            print(f"⚠️ Could not enable WAL on {self.path}: {e}")
+        return conn
+
+    def acquire(self):
+        idle = self._idle()
+        if idle:
+            return idle.pop()
+        return self._connect()
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.ProgrammingError:
+            # Already closed by the caller
+            return
+        idle = self._idle()
+        if len(idle) < self.max_idle_per_thread:
+            idle.append(conn)
+        else:
+            conn.close()
+
+    def connection(self):
+        return DBWrapper(self.acquire(), is_postgres=False, release=self.release)
+
+    def close_all(self):
+        idle = self._idle()
+        while idle:
+            idle.pop().close()
+
+    def stats(self):
+        return {'idle_this_thread': len(self._idle())}
+
+
+DEFAULT_SQLITE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "store_local_new.db")
+
+
+def connect_from_env():
+    """
+    A single unpooled connection for scripts run outside the bot (migrate.py, repair tools).
+    Uses DATABASE_URL when set, the bot's local SQLite file otherwise.
+    """
+    database_url = os.environ.get('DATABASE_URL')
+    if database_url:
+        if psycopg2 is None:
+            raise RuntimeError("psycopg2 is required when DATABASE_URL is set")
+        return DBWrapper(psycopg2.connect(database_url), is_postgres=True)
+    os.makedirs(os.path.dirname(DEFAULT_SQLITE_PATH), exist_ok=True)
+    return DBWrapper(sqlite3.connect(DEFAULT_SQLITE_PATH, timeout=30), is_postgres=False)
+
+
+# ===================== Request-scoped Session =====================
+_session_local = threading.local()
+
+
+class SessionAborted(Exception):
+    """The update's transaction failed earlier and its work can no longer be committed."""
+
+
+class _SessionCursor(CursorWrapper):
+    def __init__(self, cursor, is_postgres, owner):
+        super().__init__(cursor, is_postgres)
+        self._owner = owner
+
+    def execute(self, query, params=None):
+        if not query.lstrip()[:6].upper() == 'SELECT':
+            self._owner._before_write()
+        return super().execute(query, params)
+
+
+class SessionDBWrapper(DBWrapper):
+    """
+    What helpers receive while a session is active.
+    Each borrow writes inside its own savepoint (opened lazily before its first write, when
+    earlier helpers' work is already in the transaction): commit() releases it and marks the
+    session dirty, rollback() and close() without commit undo only this helper's writes.
+    The transaction itself is committed once, at the end of the session.
+    """
+
+    def __init__(self, session):
+        super().__init__(session.db.conn, session.db.is_postgres)
+        self._session = session
+        self._savepoint = None
+        self._wrote = False     # writes since the last commit()
+
+    def cursor(self):
+        return _SessionCursor(self.conn.cursor(), self.is_postgres, self)
+
+    def _before_write(self):
+        if not self._wrote:
+            self._wrote = True
+            if self._session.in_transaction():
+                self._savepoint = self._session.savepoint()
+
+    def commit(self):
+        if self._session.aborted():
+            raise SessionAborted("commit() inside a failed transaction")
+        if self._savepoint is not None:
+            self._session.execute(f"RELEASE SAVEPOINT {self._savepoint}")
+            self._savepoint = None
+        self._wrote = False
+        self._session.dirty = True
+
+    def rollback(self):
+        if self._savepoint is not None:
+            # The savepoint stays open for this helper's next writes
+            self._session.execute(f"ROLLBACK TO SAVEPOINT {self._savepoint}")
+        elif self._wrote:
+            # This helper's writes opened the transaction, so everything in it is its own
+            self._session.db.rollback()
+        self._wrote = False
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        # Uncommitted writes are discarded, as closing a pooled connection does
+        self.rollback()
+        if self._savepoint is not None:
+            self._session.execute(f"RELEASE SAVEPOINT {self._savepoint}")
+            self._savepoint = None
+
+
+class DBSession:
+    """One connection and one transaction shared by every helper called during an update."""
+
+    def __init__(self, connect):
+        self._connect = connect
+        self.db = None
+        self.dirty = False
+        self._savepoints = 0
+
+    def borrow(self):
+        if self.db is None:
+            self.db = self._connect()
+        elif self.aborted():
+            # A helper swallowed a failed statement outside a savepoint; rolling back here
+            # would silently drop what earlier helpers committed
+            raise SessionAborted("DB session transaction was aborted by an earlier error")
+        return SessionDBWrapper(self)
+
+    def in_transaction(self):
+        if self.db.is_postgres:
+            return self.db.conn.get_transaction_status() != pg_extensions.TRANSACTION_STATUS_IDLE
+        return self.db.conn.in_transaction
+
+    def aborted(self):
+        return self.db.is_postgres and \
+            self.db.conn.get_transaction_status() == pg_extensions.TRANSACTION_STATUS_INERROR
+
+    def savepoint(self):
+        self._savepoints += 1
+        name = f"helper_{self._savepoints}"
+        self.execute(f"SAVEPOINT {name}")
+        return name
+
+    def execute(self, sql):
+        cursor = self.db.conn.cursor()
+        try:
+            cursor.execute(sql)
+        finally:
+            cursor.close()
+
+    def commit_now(self):
+        if self.db is None or not self.dirty:
+            return
+        if self.aborted():
+            raise SessionAborted("DB session transaction was aborted, its work was not committed")
+        self.db.commit()
+        self.dirty = False
+
+    def finish(self, commit=True):
+        if self.db is None:
+            return
+        try:
+            if commit and self.dirty:
+                if self.aborted():
+                    raise SessionAborted("DB session transaction was aborted, its work was not committed")
+                self.db.commit()
+            else:
+                self.db.rollback()
+        finally:
+            self.db.close()
+            self.db = None
+
+
+def current_session():
+    return getattr(_session_local, 'session', None)
+
+
+def commit_session():
+    """
+    Commits the update's transaction now rather than when the update ends, so its locks are
+    not held through slow work (uploads, network calls). Writes every helper has committed so
+    far; call it when no borrowed connection has uncommitted writes. No-op outside a session.
+    """
+    session = current_session()
+    if session is not None:
+        session.commit_now()
+
+
+def begin_session(connect):
+    """Starts a session on this thread. Nested calls reuse the outer session."""
+    session = current_session()
+    if session is not None:
+        session.depth += 1
+        return session
+    session = DBSession(connect)
+    session.depth = 1
+    _session_local.session = session
+    return session
+
+
+def end_session(commit=True):
+    session = current_session()
+    if session is None:
+        return
+    session.depth -= 1
+    if session.depth > 0:
+        return
+    _session_local.session = None
+    session.finish(commit=commit)
+
+
+@contextmanager
+def db_session(connect):
+    """Context-manager form of begin_session/end_session for code outside of handlers."""
+    begin_session(connect)
+    try:
+        yield current_session()
+    except Exception:
+        end_session(commit=False)
+        raise
+    end_session(commit=True)
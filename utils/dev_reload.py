@@ -0,0 +1,44 @@
+"""
+Development-only hot reload.
+
+watch_modules() starts a thread that reloads a module whenever its source file changes, so
+card templates can be tweaked without restarting the bot. Reloading throws away the module's
+in-memory caches (fonts, shaped text; receipt_generator keeps its render caches, and the render
+pool lives in utils/render_pool.py) and is not thread-safe against a render in progress, so the bot
+only starts it with DEV_HOT_RELOAD=1; production loads every module once.
+Callers must look functions up on the module (receipt_generator.generate_order_card), not
+keep references imported with `from ... import`, to see reloaded code.
+"""
+import importlib
+import os
+import threading
+import time
+
+
+def _mtime(module):
+    try:
+        return os.stat(module.__file__).st_mtime_ns
+    except OSError:
+        return None
+
+
+def watch_modules(modules, interval=1.0):
+    mtimes = {module.__name__: _mtime(module) for module in modules}
+
+    def run():
+        while True:
+            time.sleep(interval)
+            for module in modules:
+                mtime = _mtime(module)
+                if mtime is None or mtime == mtimes[module.__name__]:
+                    continue
+                mtimes[module.__name__] = mtime
+                try:
+                    importlib.reload(module)
+                    print(f"🔄 Reloaded {module.__name__}")
+                except Exception as e:
+                    print(f"⚠️ Reloading {module.__name__} failed: {e}")
+
+    thread = threading.Thread(target=run, name='DevReload', daemon=True)
+    thread.start()
+    return thread
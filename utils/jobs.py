@@ -0,0 +1,329 @@
+"""
+Background jobs.
+
+The standard way to move slow work off the update path (order notifications, receipt
+rendering, cloud image upload, image GC): the handler enqueues a job in the Jobs table and
+answers the user; a pool of worker threads runs it.
+
+    jobs = JobQueue(connect)
+
+    @jobs.handler('notify_seller')
+    def notify_seller_job(job):
+        ...job.payload['order_id']...
+
+    jobs.enqueue('notify_seller', {'order_id': 42}, cursor=cursor)
+    jobs.start(workers=2)
+
+* A job inserted with the handler's cursor (or, inside an update, through the update's
+  session connection) commits together with the data it's about and is durable from then on.
+* idempotency_key: a second enqueue with the same key is ignored while the first job is
+  still in the table (done jobs are purged after KEEP_DONE_SECONDS).
+* run_at / delay schedule a job for later.
+* Workers claim jobs with FOR UPDATE SKIP LOCKED on Postgres and inside a BEGIN IMMEDIATE
+  transaction on SQLite, so several threads and processes can share the table. A running job
+  whose worker disappeared is claimed again once its lease (lease_seconds) has expired, or
+  goes to the dead letters if that was its last attempt. A worker only records the outcome
+  of a job while it still holds the lease (the job's Attempts is the one it claimed).
+* A failing job is retried with exponential backoff; after MaxAttempts (or a
+  PermanentJobError) it stays in the table with Status 'dead' and its LastError until an
+  admin retries it.
+"""
+import json
+import random
+import threading
+import time
+import traceback
+from collections import namedtuple
+
+from utils.db import begin_write
+
+DEFAULT_MAX_ATTEMPTS = 5
+BACKOFF_BASE_SECONDS = 10
+BACKOFF_MAX_SECONDS = 3600
+KEEP_DONE_SECONDS = 7 * 24 * 3600
+PURGE_INTERVAL_SECONDS = 3600
+REAP_INTERVAL_SECONDS = 60
+
+Job = namedtuple('Job', ['id', 'kind', 'payload', 'attempts'])
+
+
+class PermanentJobError(Exception):
+    """Raised by a handler when retrying can't help; the job goes straight to the dead letters."""
+
+
+def backoff_delay(attempts):
+    """Seconds before the next attempt after `attempts` failed ones: 10s, 20s, 40s, ... (±20% jitter), capped."""
+    delay = BACKOFF_BASE_SECONDS * 2 ** min(attempts - 1, 20)
+    return min(delay * random.uniform(0.8, 1.2), BACKOFF_MAX_SECONDS)
+
+
+class JobQueue:
+    def __init__(self, connect, poll_interval=1.0, lease_seconds=300):
+        self.connect = connect
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self._handlers = {}
+        self._wake = threading.Event()
+        self._threads = []
+        self._purged_at = 0.0
+        self._reaped_at = 0.0
+        self._counter_lock = threading.Lock()
+        self.done = 0
+        self.retried = 0
+        self.dead = 0
+
+    def handler(self, kind):
+        def register(func):
+            self._handlers[kind] = func
+            return func
+        return register
+
+    def enqueue(self, kind, payload, cursor=None, max_attempts=DEFAULT_MAX_ATTEMPTS, run_at=None, delay=None,
+                idempotency_key=None):
+        """
+        Adds a job; returns False if idempotency_key is already taken. With cursor the job is
+        part of the caller's transaction (and runs once that commits); without, it goes
+        through connect() (the update's session inside a handler).
+        """
+        if run_at is None:
+            run_at = time.time() + (delay or 0)
+        params = (kind, json.dumps(payload), max_attempts, run_at, idempotency_key)
+        query = """
+            INSERT INTO Jobs (Kind, Payload, Status, Attempts, MaxAttempts, RunAt, IdempotencyKey)
+            VALUES (?, ?, 'pending', 0, ?, ?, ?)
+            ON CONFLICT (IdempotencyKey) DO NOTHING
+        """
+        if cursor is not None:
+            cursor.execute(query, params)
+            added = cursor.rowcount != 0
+        else:
+            conn = self.connect()
+            try:
+                cursor = conn.cursor()
+                cursor.execute(query, params)
+                added = cursor.rowcount != 0
+                conn.commit()
+            finally:
+                conn.close()
+        if added:
+            self._wake.set()
+        return added
+
+    # ---- workers ----
+    def start(self, workers=1):
+        self._threads = [t for t in self._threads if t.is_alive()]
+        for i in range(len(self._threads), workers):
+            thread = threading.Thread(target=self._loop, name=f"JobWorker{i + 1}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _loop(self):
+        while True:
+            try:
+                self._purge_if_due()
+                self._reap_if_due()
+                job = self._claim()
+            except Exception as e:
+                print(f"⚠️ Job queue error: {e}")
+                job = None
+            if job is None:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            self._run(job)
+
+    def _claim(self):
+        now = time.time()
+        params = (now, now, now - self.lease_seconds)
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            if conn.is_postgres:
+                cursor.execute("""
+                    UPDATE Jobs SET Status = 'running', Attempts = Attempts + 1, UpdatedAt = ?
+                    WHERE JobID = (
+                        SELECT JobID FROM Jobs
+                        WHERE (Status = 'pending' AND RunAt <= ?)
+                           OR (Status = 'running' AND UpdatedAt < ? AND Attempts < MaxAttempts)
+                        ORDER BY RunAt, JobID LIMIT 1
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING JobID, Kind, Payload, Attempts
+                """, params)
+                row = cursor.fetchone()
+            else:
+                # Holds SQLite's write lock from the SELECT to the UPDATE, so no other worker can claim the same row
+                begin_write(conn)
+                cursor.execute("""
+                    SELECT JobID, Kind, Payload, Attempts + 1 FROM Jobs
+                    WHERE (Status = 'pending' AND RunAt <= ?)
+                           OR (Status = 'running' AND UpdatedAt < ? AND Attempts < MaxAttempts)
+                    ORDER BY RunAt, JobID LIMIT 1
+                """, params[1:])
+                row = cursor.fetchone()
+                if row is not None:
+                    cursor.execute("""
+                        UPDATE Jobs SET Status = 'running', Attempts = Attempts + 1, UpdatedAt = ?
+                        WHERE JobID = ?
+                    """, (now, row[0]))
+            conn.commit()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        job_id, kind, payload, attempts = row
+        return Job(job_id, kind, json.loads(payload), attempts)
+
+    def _run(self, job):
+        func = self._handlers.get(job.kind)
+        try:
+            if func is None:
+                raise PermanentJobError(f"no handler for job kind '{job.kind}'")
+            func(job)
+        except PermanentJobError as e:
+            self._fail(job, e, retry=False)
+        except Exception as e:
+            traceback.print_exc()
+            self._fail(job, e, retry=True)
+        else:
+            done = self._execute("""
+                UPDATE Jobs SET Status = 'done', UpdatedAt = ?
+                WHERE JobID = ? AND Status = 'running' AND Attempts = ?
+            """, (time.time(), job.id, job.attempts))
+            if not done:
+                print(f"⚠️ Job {job.id} ({job.kind}) finished after its lease was taken over; result not recorded")
+                return
+            with self._counter_lock:
+                self.done += 1
+
+    def _fail(self, job, error, retry):
+        error = f"{type(error).__name__}: {error}"
+        now = time.time()
+        delay = backoff_delay(job.attempts)
+        if retry:
+            # Only goes back to pending while attempts remain
+            updated = self._execute("""
+                UPDATE Jobs SET Status = CASE WHEN Attempts < MaxAttempts THEN 'pending' ELSE 'dead' END,
+                                RunAt = ?, LastError = ?, UpdatedAt = ?
+                WHERE JobID = ? AND Status = 'running' AND Attempts = ?
+            """, (now + delay, error, now, job.id, job.attempts))
+        else:
+            updated = self._execute("""
+                UPDATE Jobs SET Status = 'dead', LastError = ?, UpdatedAt = ?
+                WHERE JobID = ? AND Status = 'running' AND Attempts = ?
+            """, (error, now, job.id, job.attempts))
+        if not updated:
+            print(f"⚠️ Job {job.id} ({job.kind}) failed after its lease was taken over: {error}")
+            return
+        status = self.status(job.id)
+        with self._counter_lock:
+            if status == 'dead':
+                self.dead += 1
+            else:
+                self.retried += 1
+        if status == 'dead':
+            print(f"☠️ Job {job.id} ({job.kind}) dead after {job.attempts} attempt(s): {error}")
+        else:
+            print(f"🔁 Job {job.id} ({job.kind}) failed, retrying in {delay:.0f}s: {error}")
+
+    def _reap_if_due(self):
+        """Dead-letters running jobs whose lease expired on their last attempt (e.g. the job kills its worker)."""
+        now = time.time()
+        if now - self._reaped_at < REAP_INTERVAL_SECONDS:
+            return
+        self._reaped_at = now
+        reaped = self._execute("""
+            UPDATE Jobs SET Status = 'dead', UpdatedAt = ?,
+                            LastError = 'lease expired on the last attempt (worker stopped while running it)'
+            WHERE Status = 'running' AND UpdatedAt < ? AND Attempts >= MaxAttempts
+        """, (now, now - self.lease_seconds))
+        if reaped:
+            with self._counter_lock:
+                self.dead += reaped
+            print(f"☠️ {reaped} job(s) dead after their last lease expired")
+
+    def _purge_if_due(self):
+        now = time.time()
+        if now - self._purged_at < PURGE_INTERVAL_SECONDS:
+            return
+        self._purged_at = now
+        self._execute("DELETE FROM Jobs WHERE Status = 'done' AND UpdatedAt < ?", (now - KEEP_DONE_SECONDS,))
+
+    def _execute(self, query, params=()):
+        """Runs one write in its own transaction; returns the number of rows it changed."""
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            changed = cursor.rowcount
+            conn.commit()
+        finally:
+            conn.close()
+        return changed
+
+    # ---- inspection / admin ----
+    def status(self, job_id):
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT Status FROM Jobs WHERE JobID = ?", (job_id,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+        finally:
+            conn.close()
+
+    def counts(self):
+        """Number of jobs per status."""
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT Status, COUNT(*) FROM Jobs GROUP BY Status")
+            return {status: count for status, count in cursor.fetchall()}
+        finally:
+            conn.close()
+
+    def depth(self):
+        """(kind, status, count, oldest RunAt) for every job not yet done."""
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT Kind, Status, COUNT(*), MIN(RunAt) FROM Jobs
+                WHERE Status != 'done'
+                GROUP BY Kind, Status
+                ORDER BY Kind, Status
+            """)
+            return cursor.fetchall()
+        finally:
+            conn.close()
+
+    def dead_letters(self, limit=10):
+        """(JobID, Kind, Attempts, LastError) of the most recent dead jobs."""
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT JobID, Kind, Attempts, LastError FROM Jobs
+                WHERE Status = 'dead'
+                ORDER BY UpdatedAt DESC LIMIT ?
+            """, (limit,))
+            return cursor.fetchall()
+        finally:
+            conn.close()
+
+    def retry(self, job_id):
+        """Puts a dead job back in the queue with a fresh set of attempts; False if it isn't dead."""
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE Jobs SET Status = 'pending', Attempts = 0, RunAt = ?, UpdatedAt = ?
+                WHERE JobID = ? AND Status = 'dead'
+            """, (time.time(), time.time(), job_id))
+            retried = cursor.rowcount == 1
+            conn.commit()
+        finally:
+            conn.close()
+        if retried:
+            self._wake.set()
+        return retried
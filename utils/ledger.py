@@ -0,0 +1,244 @@
+"""
+Customer credit ledger.
+
+CustomerCredit is the append-only history. CustomerBalances keeps the current balance of each
+(customer, seller) pair and is written in the same transaction as every ledger insert, so
+reading a balance is one primary-key lookup however long the history gets.
+
+post_entry() is the only write path: it serializes concurrent posts for the same customer,
+enforces CreditLimits and keeps CurrentUsedAmount in step with the balance.
+"""
+from collections import namedtuple
+
+from utils.db import begin_write
+
+
+class CreditLimitExceeded(Exception):
+    def __init__(self, max_limit, current_used, amount):
+        self.max_limit = max_limit
+        self.current_used = current_used
+        self.amount = amount
+        self.remaining = max_limit - current_used
+        super().__init__(f"Credit limit exceeded: {current_used} + {amount} > {max_limit}")
+
+
+LedgerEntry = namedtuple('LedgerEntry', ['credit_id', 'balance_before', 'balance_after', 'used_amount'])
+
+# Latest BalanceAfter per (customer, seller); CreditID breaks ties between same-second entries
+_LATEST_BALANCES_SQL = """
+    SELECT CustomerID, SellerID, BalanceAfter, CreditID
+    FROM (
+        SELECT CustomerID, SellerID, COALESCE(BalanceAfter, 0) AS BalanceAfter, CreditID,
+               ROW_NUMBER() OVER (
+                   PARTITION BY CustomerID, SellerID
+                   ORDER BY TransactionDate DESC, CreditID DESC
+               ) AS rn
+        FROM CustomerCredit
+        WHERE CustomerID IS NOT NULL AND SellerID IS NOT NULL {seller_filter}
+    ) latest
+    WHERE rn = 1
+"""
+
+# Entries whose BalanceBefore does not continue the previous entry's BalanceAfter
+_CHAIN_BREAKS_SQL = """
+    SELECT CreditID, CustomerID, SellerID, TransactionDate, BalanceBefore, PrevBalanceAfter
+    FROM (
+        SELECT CreditID, CustomerID, SellerID, TransactionDate, BalanceBefore,
+               LAG(BalanceAfter) OVER (
+                   PARTITION BY CustomerID, SellerID
+                   ORDER BY TransactionDate, CreditID
+               ) AS PrevBalanceAfter
+        FROM CustomerCredit
+        WHERE CustomerID IS NOT NULL AND SellerID IS NOT NULL {seller_filter}
+    ) chain
+    WHERE PrevBalanceAfter IS NOT NULL AND ABS(BalanceBefore - PrevBalanceAfter) > 0.005
+    ORDER BY CustomerID, SellerID, TransactionDate, CreditID
+"""
+
+
+def read_balance(cursor, customer_id, seller_id):
+    """Current balance, or None when the pair has no materialized row."""
+    cursor.execute("SELECT Balance FROM CustomerBalances WHERE CustomerID=? AND SellerID=?",
+                   (customer_id, seller_id))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def read_ledger_balance(cursor, customer_id, seller_id):
+    """Balance taken from the newest ledger entry (the slow path CustomerBalances replaces)."""
+    cursor.execute("""
+        SELECT BalanceAfter
+        FROM CustomerCredit
+        WHERE CustomerID=? AND SellerID=?
+        ORDER BY TransactionDate DESC, CreditID DESC LIMIT 1
+    """, (customer_id, seller_id))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def store_balance(cursor, customer_id, seller_id, balance, credit_id=None):
+    """Upserts the materialized balance. Call it on the cursor that inserted the ledger entry."""
+    cursor.execute("""
+        INSERT INTO CustomerBalances (CustomerID, SellerID, Balance, LastCreditID, UpdatedAt)
+        VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT (CustomerID, SellerID) DO UPDATE SET
+            Balance = excluded.Balance,
+            LastCreditID = excluded.LastCreditID,
+            UpdatedAt = excluded.UpdatedAt
+    """, (customer_id, seller_id, balance, credit_id))
+
+
+def _lock_balance(cursor, is_postgres, customer_id, seller_id):
+    select = "SELECT Balance FROM CustomerBalances WHERE CustomerID=? AND SellerID=?"
+    if is_postgres:
+        select += " FOR UPDATE"
+    cursor.execute(select, (customer_id, seller_id))
+    row = cursor.fetchone()
+    if row:
+        return row[0]
+
+    # First entry for this pair (or rows synced in from outside): seed from the ledger.
+    # ON CONFLICT makes a concurrent seeder wait on our row instead of failing.
+    seed = read_ledger_balance(cursor, customer_id, seller_id) or 0
+    cursor.execute("""
+        INSERT INTO CustomerBalances (CustomerID, SellerID, Balance)
+        VALUES (?, ?, ?)
+        ON CONFLICT (CustomerID, SellerID) DO NOTHING
+    """, (customer_id, seller_id, seed))
+    cursor.execute(select, (customer_id, seller_id))
+    return cursor.fetchone()[0]
+
+
+def _lock_limit(cursor, is_postgres, customer_id, seller_id):
+    select = """
+        SELECT MaxCreditAmount, CurrentUsedAmount, IsActive
+        FROM CreditLimits WHERE CustomerID=? AND SellerID=?
+    """
+    if is_postgres:
+        select += " FOR UPDATE"
+    cursor.execute(select, (customer_id, seller_id))
+    return cursor.fetchone()
+
+
+def post_entry(conn, customer_id, seller_id, transaction_type, amount, description="", enforce_limit=False):
+    """
+    Appends one ledger entry and updates CustomerBalances and CreditLimits.CurrentUsedAmount,
+    all inside the caller's transaction; the caller commits (or rolls back) `conn`.
+
+    transaction_type: 'purchase' adds to the balance, 'payment' and 'refund' (a reversed purchase)
+    subtract, 'adjustment' sets it.
+    With enforce_limit, a purchase that would exceed an active CreditLimits row raises
+    CreditLimitExceeded before the ledger entry is written. The CustomerBalances row may already
+    have been seeded by then, so the caller rolls back on it like on any other error.
+    """
+    transaction_type = transaction_type.lower()
+    cursor = conn.cursor()
+    begin_write(conn)
+
+    # Lock order is always balance row, then limit row
+    balance_before = _lock_balance(cursor, conn.is_postgres, customer_id, seller_id) or 0
+    limit = _lock_limit(cursor, conn.is_postgres, customer_id, seller_id)
+
+    if transaction_type == 'purchase':
+        balance_after = balance_before + amount
+    elif transaction_type in ('payment', 'refund'):
+        balance_after = balance_before - amount
+    elif transaction_type == 'adjustment':
+        balance_after = amount
+    else:
+        balance_after = balance_before
+
+    used_amount = None
+    if limit:
+        max_limit, current_used, is_active = limit
+        current_used = current_used or 0
+        if is_active:
+            if enforce_limit and transaction_type == 'purchase' and current_used + amount > max_limit:
+                raise CreditLimitExceeded(max_limit, current_used, amount)
+            if transaction_type == 'purchase':
+                used_amount = current_used + amount
+            elif transaction_type in ('payment', 'refund'):
+                used_amount = max(current_used - amount, 0)
+            else:
+                used_amount = current_used
+            cursor.execute("""
+                UPDATE CreditLimits
+                SET CurrentUsedAmount=?, UpdatedAt=CURRENT_TIMESTAMP
+                WHERE CustomerID=? AND SellerID=?
+            """, (used_amount, customer_id, seller_id))
+    elif transaction_type in ('purchase', 'payment'):
+        # No limit configured yet: start tracking usage under the default limit
+        used_amount = amount if transaction_type == 'purchase' else 0
+        cursor.execute("""
+            INSERT INTO CreditLimits
+            (CustomerID, SellerID, MaxCreditAmount, CurrentUsedAmount, IsActive)
+            VALUES (?, ?, 1000000, ?, TRUE)
+            ON CONFLICT (CustomerID, SellerID) DO NOTHING
+        """, (customer_id, seller_id, used_amount))
+
+    query = """
+        INSERT INTO CustomerCredit
+        (CustomerID, SellerID, TransactionType, Amount, Description, BalanceBefore, BalanceAfter)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """
+    if conn.is_postgres:
+        query += " RETURNING CreditID"
+    cursor.execute(query, (customer_id, seller_id, transaction_type, amount, description,
+                           balance_before, balance_after))
+    credit_id = cursor.lastrowid
+    store_balance(cursor, customer_id, seller_id, balance_after, credit_id)
+
+    return LedgerEntry(credit_id, balance_before, balance_after, used_amount)
+
+
+def delete_balances(cursor, customer_id):
+    cursor.execute("DELETE FROM CustomerBalances WHERE CustomerID=?", (customer_id,))
+
+
+def _seller_filter(seller_id):
+    if seller_id is None:
+        return "", ()
+    return "AND SellerID = ?", (seller_id,)
+
+
+def rebuild_balances(conn, seller_id=None):
+    """
+    Recomputes CustomerBalances from CustomerCredit in one transaction.
+    Needed after ledger rows are written outside the bot (desktop app sync, manual fixes).
+    Returns the number of balances written.
+    """
+    seller_filter, params = _seller_filter(seller_id)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"DELETE FROM CustomerBalances WHERE 1=1 {seller_filter}", params)
+        cursor.execute(f"""
+            INSERT INTO CustomerBalances (CustomerID, SellerID, Balance, LastCreditID)
+            {_LATEST_BALANCES_SQL.format(seller_filter=seller_filter)}
+        """, params)
+        written = cursor.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return written
+
+
+def find_drift(conn, seller_id=None):
+    """(CustomerID, SellerID, stored, expected) for every balance that disagrees with the ledger."""
+    seller_filter, params = _seller_filter(seller_id)
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT l.CustomerID, l.SellerID, b.Balance, l.BalanceAfter
+        FROM ({_LATEST_BALANCES_SQL.format(seller_filter=seller_filter)}) l
+        LEFT JOIN CustomerBalances b ON b.CustomerID = l.CustomerID AND b.SellerID = l.SellerID
+        WHERE b.Balance IS NULL OR ABS(b.Balance - l.BalanceAfter) > 0.005
+    """, params)
+    return cursor.fetchall()
+
+
+def find_chain_breaks(conn, seller_id=None):
+    """Ledger entries whose BalanceBefore does not match the previous entry's BalanceAfter."""
+    seller_filter, params = _seller_filter(seller_id)
+    cursor = conn.cursor()
+    cursor.execute(_CHAIN_BREAKS_SQL.format(seller_filter=seller_filter), params)
+    return cursor.fetchall()
@@ -0,0 +1,160 @@
+"""
+Telegram file_id cache.
+
+Telegram gives every uploaded photo a file_id that the bot can reuse in any chat. MediaCache
+remembers it per (content hash, variant) in the MediaCache table, with an in-memory LRU in
+front, so a product photo or a rendered card is uploaded once and from then on sent by
+file_id: no upload, and the request takes milliseconds.
+
+    media.send_photo(bot, chat_id, img_path, caption=..., reply_markup=...)
+    media.send_photo(bot, chat_id, card_png, variant='product_card', caption=...)
+
+variant separates different renderings of the same source (the raw photo vs. a card).
+A file_id Telegram no longer accepts is forgotten and the photo is uploaded again.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from telebot.apihelper import ApiTelegramException
+
+MEMORY_ENTRIES = 10000
+# (path, mtime, size) -> hash, so a file on disk is read and hashed once
+HASHED_FILES = 4096
+
+
+class _LRU:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+def _is_stale_file_id(error):
+    description = str(getattr(error, 'description', '') or error).lower()
+    return error.error_code == 400 and ('file identifier' in description or 'file_id' in description)
+
+
+class MediaCache:
+    def __init__(self, connect, memory_entries=MEMORY_ENTRIES):
+        self.connect = connect
+        self._file_ids = _LRU(memory_entries)
+        self._file_hashes = _LRU(HASHED_FILES)
+        self.hits = 0
+        self.uploads = 0
+
+    # ---- hashing ----
+    def file_hash(self, path):
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        digest = self._file_hashes.get(key)
+        if digest is None:
+            sha = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 16), b''):
+                    sha.update(chunk)
+            digest = sha.hexdigest()
+            self._file_hashes.put(key, digest)
+        return digest
+
+    @staticmethod
+    def bytes_hash(data):
+        return hashlib.sha256(data).hexdigest()
+
+    # ---- table ----
+    def lookup(self, content_hash, variant):
+        file_id = self._file_ids.get((content_hash, variant))
+        if file_id is not None:
+            return file_id
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT FileID FROM MediaCache WHERE ContentHash = ? AND Variant = ?",
+                           (content_hash, variant))
+            row = cursor.fetchone()
+        finally:
+            conn.close()
+        if row:
+            self._file_ids.put((content_hash, variant), row[0])
+            return row[0]
+        return None
+
+    def remember(self, content_hash, variant, file_id):
+        self._file_ids.put((content_hash, variant), file_id)
+        conn = self.connect()
+        try:
+            conn.cursor().execute("""
+                INSERT INTO MediaCache (ContentHash, Variant, FileID) VALUES (?, ?, ?)
+                ON CONFLICT (ContentHash, Variant) DO UPDATE SET FileID = excluded.FileID
+            """, (content_hash, variant, file_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def forget(self, content_hash, variant):
+        self._file_ids.pop((content_hash, variant))
+        conn = self.connect()
+        try:
+            conn.cursor().execute("DELETE FROM MediaCache WHERE ContentHash = ? AND Variant = ?",
+                                  (content_hash, variant))
+            conn.commit()
+        finally:
+            conn.close()
+
+    # ---- sending ----
+    def send_photo(self, bot, chat_id, photo, variant='photo', **kwargs):
+        """
+        bot.send_photo by cached file_id when this content was uploaded before, otherwise
+        uploads it and records the file_id. photo is a file path or a file-like object
+        (e.g. the BytesIO of a rendered card).
+        """
+        if isinstance(photo, str):
+            content_hash = self.file_hash(photo)
+        else:
+            photo.seek(0)
+            content_hash = self.bytes_hash(photo.read())
+            photo.seek(0)
+
+        file_id = self.lookup(content_hash, variant)
+        if file_id is not None:
+            try:
+                message = bot.send_photo(chat_id, file_id, **kwargs)
+                self.hits += 1
+                return message
+            except ApiTelegramException as e:
+                if not _is_stale_file_id(e):
+                    raise
+                self.forget(content_hash, variant)
+
+        if isinstance(photo, str):
+            with open(photo, 'rb') as f:
+                message = bot.send_photo(chat_id, f, **kwargs)
+        else:
+            message = bot.send_photo(chat_id, photo, **kwargs)
+        self.uploads += 1
+        if message is not None and message.photo:
+            # The largest size; Telegram serves the smaller ones from the same file_id
+            self.remember(content_hash, variant, message.photo[-1].file_id)
+        return message
+
+    def stats(self):
+        return {'hits': self.hits, 'uploads': self.uploads}
@@ -0,0 +1,59 @@
+from telebot.handler_backends import BaseMiddleware
+
+from utils.context import begin_context, end_context
+from utils.db import begin_session, end_session
+from utils.state import flush_stores
+
+
+class DBSessionMiddleware(BaseMiddleware):
+    """
+    Opens a request-scoped DB session for every update.
+    Handlers, filter lambdas and every helper they call share one connection and one
+    transaction, which is committed once after the handler returns (rolled back if it raised).
+    """
+
+    def __init__(self, connect):
+        super().__init__()
+        self.update_types = ['message', 'callback_query']
+        self.connect = connect
+
+    def pre_process(self, message, data):
+        begin_session(self.connect)
+
+    def post_process(self, message, data, exception):
+        end_session(commit=exception is None)
+
+
+class UpdateContextMiddleware(BaseMiddleware):
+    """
+    Gives every update a fresh UpdateContext (see utils/context.py), so the sender's user row,
+    seller row and role are loaded at most once however many filters and helpers ask for them.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.update_types = ['message', 'callback_query']
+
+    def pre_process(self, message, data):
+        sender = getattr(message, 'from_user', None)
+        data['context'] = begin_context(sender.id if sender else None)
+
+    def post_process(self, message, data, exception):
+        end_context()
+
+
+class StateFlushMiddleware(BaseMiddleware):
+    """
+    Writes the conversation state entries the update read or changed back to their
+    StateStore backend once the handler is done (see utils/state.py).
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.update_types = ['message', 'callback_query']
+
+    def pre_process(self, message, data):
+        pass
+
+    def post_process(self, message, data, exception):
+        flush_stores()
@@ -0,0 +1,153 @@
+"""
+Versioned schema migrations.
+
+Migrations live in the top-level `migrations/` package as NNNN_name.py files, each exposing
+`upgrade(cursor, is_postgres)`. Applied versions are recorded in the schema_version table.
+At startup migrate() costs a single SELECT when the schema is already current.
+"""
+import importlib
+import os
+import re
+from collections import namedtuple
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "migrations")
+_FILE_RE = re.compile(r'^(\d{4})_([A-Za-z0-9_]+)\.py$')
+
+# Arbitrary constant so every bot instance contends for the same Postgres advisory lock
+_PG_LOCK_KEY = 724100501
+
+Migration = namedtuple('Migration', ['version', 'name', 'module'])
+
+
+def discover():
+    """Returns all migrations sorted by version."""
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = _FILE_RE.match(filename)
+        if not match:
+            continue
+        module = importlib.import_module(f"migrations.{filename[:-3]}")
+        migrations.append(Migration(int(match.group(1)), match.group(2), module))
+
+    versions = [m.version for m in migrations]
+    if len(versions) != len(set(versions)):
+        raise RuntimeError(f"Duplicate migration versions in {MIGRATIONS_DIR}")
+    return migrations
+
+
+def describe(migration):
+    doc = (migration.module.__doc__ or "").strip()
+    return doc.splitlines()[0] if doc else migration.name
+
+
+def current_version(conn):
+    """Highest applied version, or None if schema_version does not exist yet."""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT MAX(version) FROM schema_version")
+        row = cursor.fetchone()
+        return row[0] or 0
+    except Exception:
+        conn.rollback()
+        return None
+
+
+def pending(conn, migrations=None):
+    migrations = migrations if migrations is not None else discover()
+    version = current_version(conn) or 0
+    return [m for m in migrations if m.version > version]
+
+
+# ----------------- Schema helpers for migration files -----------------
+def column_exists(cursor, is_postgres, table, column):
+    if is_postgres:
+        cursor.execute("""
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = ? AND column_name = ?
+        """, (table.lower(), column.lower()))
+        return cursor.fetchone() is not None
+    cursor.execute(f"PRAGMA table_info({table})")
+    return any(row[1].lower() == column.lower() for row in cursor.fetchall())
+
+
+def add_column_if_missing(cursor, is_postgres, table, column, definition):
+    """Adds a column unless it is already there. Returns True when it was added."""
+    if column_exists(cursor, is_postgres, table, column):
+        return False
+    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    print(f"[OK] Migrated: Added {column} to {table}")
+    return True
+
+
+# ----------------- Engine -----------------
+def _ensure_version_table(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version(
+            version INTEGER PRIMARY KEY,
+            name TEXT,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def _read_version(cursor):
+    cursor.execute("SELECT MAX(version) FROM schema_version")
+    row = cursor.fetchone()
+    return row[0] or 0
+
+
+def migrate(conn, dry_run=False, log=print):
+    """
+    Applies pending migrations in order, one transaction each.
+    Returns the list of migrations that were (or, with dry_run, would be) applied.
+
+    Concurrent instances are serialized with a Postgres advisory lock, or with
+    BEGIN IMMEDIATE on SQLite, and the version is re-read under the lock before
+    each migration, so a migration never runs twice.
+    """
+    migrations = discover()
+    if not migrations:
+        return []
+    latest = migrations[-1].version
+
+    # Fast path: one query when nothing is pending
+    version = current_version(conn)
+    if version is not None and version >= latest:
+        return []
+
+    todo = [m for m in migrations if m.version > (version or 0)]
+    if dry_run:
+        return todo
+
+    cursor = conn.cursor()
+    applied = []
+    if conn.is_postgres:
+        cursor.execute("SELECT pg_advisory_lock(?)", (_PG_LOCK_KEY,))
+        conn.commit()
+    try:
+        for migration in todo:
+            if not conn.is_postgres:
+                cursor.execute("BEGIN IMMEDIATE")
+            try:
+                _ensure_version_table(cursor)
+                if _read_version(cursor) >= migration.version:
+                    # Another instance applied it while we waited for the lock
+                    conn.commit()
+                    continue
+                log(f"🔄 Applying migration {migration.version:04d}_{migration.name}: {describe(migration)}")
+                migration.module.upgrade(cursor, conn.is_postgres)
+                cursor.execute("INSERT INTO schema_version (version, name) VALUES (?, ?)",
+                               (migration.version, migration.name))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            applied.append(migration)
+    finally:
+        if conn.is_postgres:
+            cursor.execute("SELECT pg_advisory_unlock(?)", (_PG_LOCK_KEY,))
+            conn.commit()
+
+    if applied:
+        log(f"✅ Schema is now at version {applied[-1].version:04d}")
+    return applied
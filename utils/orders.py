@@ -0,0 +1,53 @@
+"""
+Order writer.
+
+An order is written with a fixed number of statements regardless of cart size: one INSERT for
+the Orders row and one multi-row INSERT for its OrderItems (stock is reserved separately by
+utils.stock.reserve_stock, also in one statement).
+"""
+
+# 4 parameters per row keeps each statement well under SQLite's host-parameter limit
+ORDER_ITEMS_PER_STATEMENT = 200
+
+
+def insert_order(cursor, is_postgres, buyer_id, seller_id, total, delivery_address=None, notes=None,
+                 payment_method='cash', fully_paid=False):
+    query = """
+        INSERT INTO Orders (BuyerID, SellerID, Total, DeliveryAddress, Notes, PaymentMethod, FullyPaid)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """
+    if is_postgres:
+        query += " RETURNING OrderID"
+    cursor.execute(query, (buyer_id, seller_id, total, delivery_address, notes, payment_method, fully_paid))
+    return cursor.lastrowid
+
+
+def insert_order_items(cursor, order_id, cart_items):
+    """Inserts (product_id, quantity, price) lines with multi-row VALUES."""
+    items = list(cart_items)
+    for start in range(0, len(items), ORDER_ITEMS_PER_STATEMENT):
+        chunk = items[start:start + ORDER_ITEMS_PER_STATEMENT]
+        params = []
+        for pid, qty, price in chunk:
+            params.extend((order_id, pid, qty, price))
+        rows = ", ".join(["(?, ?, ?, ?)"] * len(chunk))
+        cursor.execute(f"INSERT INTO OrderItems (OrderID, ProductID, Quantity, Price) VALUES {rows}", params)
+
+
+def find_buyer_credit_customer(cursor, buyer_id, seller_id):
+    """
+    (CustomerID, CustomerType) of the buyer's credit account at this store, or None.
+    Same matching as get_user + get_credit_customer (phone first, otherwise name), in one query.
+    """
+    cursor.execute("""
+        SELECT cc.CustomerID, cc.CustomerType
+        FROM Users u
+        JOIN CreditCustomers cc ON cc.SellerID = ? AND (
+            (COALESCE(u.PhoneNumber, '') <> '' AND cc.PhoneNumber = u.PhoneNumber)
+            OR (COALESCE(u.PhoneNumber, '') = '' AND COALESCE(u.FullName, '') <> ''
+                AND cc.FullName LIKE (? || u.FullName || ?))
+        )
+        WHERE u.TelegramID = ?
+        LIMIT 1
+    """, (seller_id, '%', '%', buyer_id))
+    return cursor.fetchone()
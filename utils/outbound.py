@@ -0,0 +1,319 @@
+"""
+Outbound Telegram rate limiter.
+
+Installed as telebot's apihelper.CUSTOM_REQUEST_SENDER, so every bot.send_* / edit_* call in
+every handler goes through it without changing the call sites. Message-producing methods
+(send*, edit*, copyMessage, forwardMessage) are scheduled; everything else (getUpdates,
+answerCallbackQuery, getFile, ...) is sent straight away.
+
+Scheduling:
+
+    * token buckets: global (~30/s), per private chat (1/s with a small burst), per group
+      (20/min); a request waits until every bucket it needs has a token,
+    * per chat FIFO with at most one request in flight per chat, so messages still arrive in
+      the order the handler sent them,
+    * between chats, the ready request with the best priority wins (PRIORITY_CRITICAL for
+      order notifications, PRIORITY_INTERACTIVE by default, PRIORITY_BULK for long listings),
+      so one seller paging through their inbox can't hold up everyone else,
+    * HTTP 429 pauses the chat for the retry_after Telegram asked for and retries the request;
+      a 429 on a private chat (where only the bot-wide limit applies) pauses every chat, and
+      with shared_pause every process sending with the same token,
+    * an edit of a message that already has an edit queued replaces it (only the last state
+      is sent; both callers get that result).
+
+Each process has its own limiter: when several processes send with one token, each must be
+given its share of the bot-wide rates.
+
+The calling thread blocks until its own request was sent, exactly as with a direct call (at
+most result_timeout seconds, so a stuck scheduler can't hang every handler).
+"""
+import heapq
+import itertools
+import threading
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from contextlib import contextmanager
+
+import requests
+
+PRIORITY_CRITICAL = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BULK = 2
+
+_LIMITED_PREFIXES = ('send', 'edit', 'copyMessage', 'forwardMessage')
+_COALESCED_METHODS = ('editMessageText', 'editMessageCaption', 'editMessageReplyMarkup', 'editMessageMedia')
+MAX_RETRIES_429 = 5
+
+_priority_local = threading.local()
+
+
+@contextmanager
+def outbound_priority(priority):
+    """Sends made inside the block (on this thread) are scheduled with the given priority."""
+    previous = getattr(_priority_local, 'priority', None)
+    _priority_local.priority = priority
+    try:
+        yield
+    finally:
+        _priority_local.priority = previous
+
+
+def current_priority():
+    priority = getattr(_priority_local, 'priority', None)
+    return PRIORITY_INTERACTIVE if priority is None else priority
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate            # tokens per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0    # set from 429 retry_after
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available (0 if one is available now)."""
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class _Request:
+    __slots__ = ('method', 'url', 'kwargs', 'api_method', 'chat_id', 'priority', 'seq', 'futures',
+                 'coalesce_key', 'attempts')
+
+    def __init__(self, method, url, kwargs, api_method, chat_id, priority, seq):
+        self.method = method
+        self.url = url
+        self.kwargs = kwargs
+        self.api_method = api_method
+        self.chat_id = chat_id
+        self.priority = priority
+        self.seq = seq
+        self.futures = [Future()]
+        self.attempts = 0
+        params = kwargs.get('params') or {}
+        self.coalesce_key = None
+        if api_method in _COALESCED_METHODS and params.get('message_id') is not None:
+            self.coalesce_key = (api_method, params.get('message_id'))
+
+
+def _chat_id(params):
+    chat_id = (params or {}).get('chat_id')
+    if chat_id is None:
+        return None
+    try:
+        return int(chat_id)
+    except (TypeError, ValueError):
+        return chat_id  # @channel usernames
+
+
+def _is_group(chat_id):
+    """Groups and channels (negative ids, @usernames) have a per-chat limit; private chats don't."""
+    return isinstance(chat_id, int) and chat_id < 0 or isinstance(chat_id, str)
+
+
+def _rewind_files(files):
+    for value in (files or {}).values():
+        obj = value[1] if isinstance(value, tuple) and len(value) > 1 else value
+        if hasattr(obj, 'seek'):
+            obj.seek(0)
+
+
+class OutboundLimiter:
+    def __init__(self, global_rate=30, chat_rate=1.0, chat_burst=3, group_per_minute=20, group_burst=3,
+                 senders=8, result_timeout=600, shared_pause=None):
+        """
+        shared_pause: a multiprocessing.RawValue('d') inherited by every worker process; holds
+        the time.monotonic() (system-wide on Linux) until which a bot-wide 429 pauses them all.
+        """
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.shared_pause = shared_pause
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_per_minute / 60.0
+        self.group_burst = group_burst
+        self.result_timeout = result_timeout
+        self._buckets = {}
+        self._queues = {}           # chat_id -> list of _Request in FIFO order
+        self._inflight = set()      # chats with a request being sent
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._senders = ThreadPoolExecutor(max_workers=senders, thread_name_prefix='outbound')
+        self._session_local = threading.local()
+        self.sent = 0
+        self.coalesced = 0
+        self.retried_429 = 0
+        self._thread = threading.Thread(target=self._schedule, name='OutboundScheduler', daemon=True)
+        self._thread.start()
+
+    # ---- telebot entry point ----
+    @staticmethod
+    def is_limited(api_method, params):
+        """True for the calls that are scheduled: message-producing methods aimed at a chat."""
+        return _chat_id(params) is not None and api_method.startswith(_LIMITED_PREFIXES)
+
+    def __call__(self, method, url, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        if not self.is_limited(api_method, kwargs.get('params')):
+            return self._http(method, url, kwargs)
+        chat_id = _chat_id(kwargs.get('params'))
+
+        with self._cond:
+            queue = self._queues.setdefault(chat_id, [])
+            last = queue[-1] if queue else None
+            request = _Request(method, url, kwargs, api_method, chat_id, current_priority(), next(self._seq))
+            if last is not None and request.coalesce_key is not None and last.coalesce_key == request.coalesce_key:
+                # Newer state of the same message: send only that, answer both callers with it
+                last.kwargs = kwargs
+                last.priority = min(last.priority, request.priority)
+                last.futures.append(request.futures[0])
+                self.coalesced += 1
+            else:
+                queue.append(request)
+            self._cond.notify()
+        future = request.futures[0]
+        try:
+            return future.result(timeout=self.result_timeout)
+        except TimeoutError:
+            with self._cond:
+                # Still waiting for its turn: drop it so it isn't sent after the caller gave up
+                if request.futures == [future] and request in self._queues.get(chat_id, ()):
+                    self._queues[chat_id].remove(request)
+            raise TimeoutError(f"{api_method} to {chat_id} not sent within {self.result_timeout}s")
+
+    # ---- scheduling ----
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.group_rate, self.group_burst) if _is_group(chat_id) \
+                else TokenBucket(self.chat_rate, self.chat_burst)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def _pick(self, now):
+        """(request, 0) for the best request that may go now, else (None, seconds to wait)."""
+        global_wait = self.global_bucket.wait_time(now)
+        if self.shared_pause is not None:
+            global_wait = max(global_wait, self.shared_pause.value - now)
+        ready = []
+        soonest = None
+        for chat_id, queue in self._queues.items():
+            if not queue or chat_id in self._inflight:
+                continue
+            head = queue[0]
+            wait = max(self._bucket(chat_id).wait_time(now), global_wait)
+            if wait == 0:
+                heapq.heappush(ready, (head.priority, head.seq, chat_id))
+            elif soonest is None or wait < soonest:
+                soonest = wait
+        if ready:
+            return self._queues[ready[0][2]][0], 0
+        return None, soonest
+
+    def _schedule(self):
+        while True:
+            try:
+                self._dispatch_next()
+            except Exception:
+                # The scheduler must outlive any one bad request, or every send would hang
+                traceback.print_exc()
+                time.sleep(0.1)
+
+    def _dispatch_next(self):
+        with self._cond:
+            request, wait = self._pick(time.monotonic())
+            if request is None:
+                self._cond.wait(wait)
+                return
+            now = time.monotonic()
+            self.global_bucket.take(now)
+            self._bucket(request.chat_id).take(now)
+            self._queues[request.chat_id].pop(0)
+            self._inflight.add(request.chat_id)
+        try:
+            self._senders.submit(self._send, request)
+        except Exception as e:
+            with self._cond:
+                self._inflight.discard(request.chat_id)
+            for future in request.futures:
+                future.set_exception(e)
+            raise
+
+    def _send(self, request):
+        try:
+            request.attempts += 1
+            _rewind_files(request.kwargs.get('files'))
+            response = self._http(request.method, request.url, request.kwargs)
+            retry_after = self._retry_after(response)
+            if retry_after is not None and request.attempts < MAX_RETRIES_429:
+                self.retried_429 += 1
+                with self._cond:
+                    blocked_until = time.monotonic() + retry_after
+                    self._bucket(request.chat_id).blocked_until = blocked_until
+                    if not _is_group(request.chat_id):
+                        # Private chats have no limit of their own to hit: the whole bot is throttled
+                        self.global_bucket.blocked_until = max(self.global_bucket.blocked_until, blocked_until)
+                        if self.shared_pause is not None:
+                            self.shared_pause.value = max(self.shared_pause.value, blocked_until)
+                    # Back to the front of its chat, ahead of anything queued after it
+                    self._queues.setdefault(request.chat_id, []).insert(0, request)
+                    self._inflight.discard(request.chat_id)
+                    self._cond.notify()
+                return
+            self.sent += 1
+            for future in request.futures:
+                future.set_result(response)
+        except Exception as e:
+            for future in request.futures:
+                future.set_exception(e)
+        with self._cond:
+            self._inflight.discard(request.chat_id)
+            if not self._queues.get(request.chat_id):
+                self._queues.pop(request.chat_id, None)
+            self._cond.notify()
+
+    @staticmethod
+    def _retry_after(response):
+        if response.status_code != 429:
+            return None
+        try:
+            return float(response.json().get('parameters', {}).get('retry_after', 1))
+        except ValueError:
+            return 1.0
+
+    def _http(self, method, url, kwargs):
+        session = getattr(self._session_local, 'session', None)
+        if session is None:
+            session = self._session_local.session = requests.Session()
+        return session.request(method, url, **kwargs)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'queued': sum(len(q) for q in self._queues.values()),
+                'chats': sum(1 for q in self._queues.values() if q),
+                'inflight': len(self._inflight),
+                'sent': self.sent,
+                'coalesced': self.coalesced,
+                'retried_429': self.retried_429,
+            }
+
+
+def install(apihelper, **limits):
+    """Routes all of telebot's HTTP requests through a new OutboundLimiter."""
+    limiter = OutboundLimiter(**limits)
+    apihelper.CUSTOM_REQUEST_SENDER = limiter
+    return limiter
@@ -2,9 +2,15 @@
 import io
 import datetime
 import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache, partial
 import requests
 from PIL import Image, ImageDraw, ImageFont
 
+from utils import render_pool
+from utils.render_cache import RenderCache, file_digest, make_key
+
 # Libraries for Arabic Text Support
 try:
     import arabic_reshaper
@@ -22,22 +28,54 @@ def get_font(path_options, size):
             continue
     return ImageFont.load_default()
 
+# ===================== Shaping & measurement caches =====================
+# Labels, store names and product names repeat on every card, so each string is shaped once
+# and measured once per font; both caches are per process (each render worker has its own)
+SHAPED_TEXT_CACHE = 4096
+TEXT_BBOX_CACHE = 8192
+
+_text_bboxes = OrderedDict()
+_text_bboxes_lock = threading.Lock()
+
+@lru_cache(maxsize=SHAPED_TEXT_CACHE)
+def _shape(text):
+    if arabic_reshaper and get_display:
+        return get_display(arabic_reshaper.reshape(text))
+    return text
+
 def process_text(text):
     """Reshapes and reorders Arabic text for correct display."""
     if not text:
         return ""
-    if arabic_reshaper and get_display:
-        reshaped_text = arabic_reshaper.reshape(str(text))
-        bidi_text = get_display(reshaped_text)
-        return bidi_text
-    return str(text)
+    return _shape(str(text))
+
+def _font_key(font):
+    path = getattr(font, 'path', None)
+    if path is None:
+        return id(font)  # bitmap default font, never freed
+    return (path, font.size, getattr(font, 'index', 0))
+
+def text_bbox(draw, text, font):
+    """draw.textbbox((0, 0), text, font=font) for already processed text, memoized per (text, font)."""
+    key = (text, _font_key(font), draw.fontmode)
+    with _text_bboxes_lock:
+        bbox = _text_bboxes.get(key)
+        if bbox is not None:
+            _text_bboxes.move_to_end(key)
+            return bbox
+    bbox = draw.textbbox((0, 0), text, font=font)
+    with _text_bboxes_lock:
+        _text_bboxes[key] = bbox
+        while len(_text_bboxes) > TEXT_BBOX_CACHE:
+            _text_bboxes.popitem(last=False)
+    return bbox
 
 def draw_text_rtl(draw, text, y, font, fill, right_margin, canvas_width=600):
     """Draws text aligned to the right."""
     processed = process_text(text)
     
     try:
-        bbox = draw.textbbox((0, 0), processed, font=font)
+        bbox = text_bbox(draw, processed, font)
         text_width = bbox[2] - bbox[0]
     except:
         text_width = draw.textlength(processed, font=font)
@@ -50,7 +88,7 @@ def draw_pill(draw, x, y, text, font, bg_color, text_color):
     """Draws a rounded pill with text."""
     processed = process_text(text)
     try:
-        bbox = draw.textbbox((0, 0), processed, font=font)
+        bbox = text_bbox(draw, processed, font)
         w = bbox[2] - bbox[0] + 30
         h = bbox[3] - bbox[1] + 16
     except:
@@ -109,7 +147,115 @@ def get_cached_font(font_type, size):
     CACHED_FONTS[key] = font
     return font
 
+# Every (font, size) the card templates use; loaded once at import so no render pays for it
+CARD_FONTS = (
+    ('bold', 55), ('bold', 50), ('bold', 45), ('bold', 40), ('bold', 30),
+    ('normal', 36), ('normal', 32),
+    ('small', 30), ('small', 26),
+)
+
+def preload_fonts():
+    for font_type, size in CARD_FONTS:
+        get_cached_font(font_type, size)
+
+preload_fonts()
+
+def find_image_file(path_str):
+    if not path_str or not isinstance(path_str, str): return None
+    clean = path_str.split('?')[0].replace('\\', '/')
+    if 'http' in clean: return None
+    basename = os.path.basename(clean)
+    base_dirs = [
+        os.getcwd(),
+        os.path.join(os.getcwd(), "data", "Images"),
+        "C:/Users/Hp/Desktop/TelegramStoreBot/data/Images"
+    ]
+    for d in base_dirs:
+        if os.path.exists(d):
+             fp = os.path.join(d, basename)
+             if os.path.exists(fp): return fp
+    return None
+
+# ===================== Render caches =====================
+# Bump when a card layout changes, so renders of the old layout are never served
+PRODUCT_CARD_TEMPLATE_VERSION = 1
+ORDER_CARD_TEMPLATE_VERSION = 20
+
+# Rendered cards on disk (RENDER_CACHE_MB=0 disables it and renders every time)
+RENDER_CACHE_DIR = os.environ.get('RENDER_CACHE_DIR',
+                                  os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "render_cache"))
+RENDER_CACHE_MB = int(os.environ.get('RENDER_CACHE_MB', '200'))
+
+def _open_cache(name, max_bytes):
+    if max_bytes <= 0:
+        return None
+    try:
+        return RenderCache(os.path.join(RENDER_CACHE_DIR, name), max_bytes)
+    except OSError as e:
+        print(f"Warning: {name} render cache disabled ({e})")
+        return None
+
+# Order receipts are smaller in number and change less often, so they get a quarter of the space
+# A dev hot reload re-runs this module: keep the caches (and their index) it already opened
+if 'product_card_cache' not in globals():
+    product_card_cache = _open_cache("products", RENDER_CACHE_MB * 1024 * 1024 * 3 // 4)
+    order_card_cache = _open_cache("orders", RENDER_CACHE_MB * 1024 * 1024 // 4)
+
+def cached_render(cache, group, key_func, render_func, *args):
+    """render_func(*args) as a PNG BytesIO, through cache under key_func(*args) when a cache is configured."""
+    if cache is None:
+        return render_func(*args)
+    try:
+        key = key_func(*args)
+        data = cache.get(group, key)
+    except Exception as e:
+        print(f"Render Cache Error: {e}")
+        return render_func(*args)
+    if data is not None:
+        return io.BytesIO(data)
+    bio = render_func(*args)
+    if bio is not None:
+        try:
+            cache.put(group, key, bio.getvalue())
+        except OSError as e:
+            print(f"Render Cache Error: {e}")
+    return bio
+
+def render_card(kind, *args):
+    """RENDERERS[kind](*args), on the installed render pool if any; None if the pool is over its deadline."""
+    pool = render_pool.current()
+    if pool is None or pool.broken:
+        return RENDERERS[kind](*args)
+    try:
+        return pool.render(kind, *args)
+    except Exception as e:
+        print(f"Render Pool Error: {e}")
+        return RENDERERS[kind](*args)
+
+def order_item_image(item):
+    """Image path of an OrderItems row as passed to generate_order_card (index 13, else 10)."""
+    if len(item) > 13 and isinstance(item[13], str) and len(item[13]) > 4: return item[13]
+    if len(item) > 10 and isinstance(item[10], str) and len(item[10]) > 4: return item[10]
+    return None
+
+def order_card_key(order_details, items, buyer_name, buyer_phone, store_name):
+    """
+    The order's revision: a hash of the order row, its items (and their photos), buyer and store.
+    Any change to what the receipt shows gives a new key.
+    """
+    thumbnails = []
+    for item in items or ():
+        image_file = find_image_file(order_item_image(item))
+        thumbnails.append(file_digest(image_file) if image_file else None)
+    return make_key(ORDER_CARD_TEMPLATE_VERSION, tuple(order_details), [tuple(item) for item in items or ()],
+                    thumbnails, buyer_name, buyer_phone, store_name)
+
 def generate_order_card(order_details, items, buyer_name, buyer_phone, store_name):
+    """Receipt PNG (BytesIO) for an order, served from order_card_cache per (order_id, revision)."""
+    return cached_render(order_card_cache, f"o{order_details[0]}", order_card_key, partial(render_card, 'order'),
+                         order_details, items, buyer_name, buyer_phone, store_name)
+
+def render_order_card(order_details, items, buyer_name, buyer_phone, store_name):
     """
     Generate a visual receipt card for the order.
     Rev 20: White Body, Navy Text, Blue Header/Footer
@@ -214,25 +360,7 @@ def generate_order_card(order_details, items, buyer_name, buyer_phone, store_nam
             img_y = current_y
             
             thumb_img = None
-            def find_image_file(path_str):
-                if not path_str or not isinstance(path_str, str): return None
-                clean = path_str.split('?')[0].replace('\\', '/')
-                if 'http' in clean: return None
-                basename = os.path.basename(clean)
-                base_dirs = [
-                    os.getcwd(),
-                    os.path.join(os.getcwd(), "data", "Images"),
-                    "C:/Users/Hp/Desktop/TelegramStoreBot/data/Images"
-                ]
-                for d in base_dirs:
-                    if os.path.exists(d):
-                        fp = os.path.join(d, basename)
-                        if os.path.exists(fp): return fp
-                return None
-
-            image_path = None
-            if len(item) > 13 and isinstance(item[13], str) and len(item[13]) > 4: image_path = item[13]
-            elif len(item) > 10 and isinstance(item[10], str) and len(item[10]) > 4: image_path = item[10]
+            image_path = order_item_image(item)
             
             final_path = find_image_file(image_path)
             if final_path:
@@ -287,7 +415,19 @@ def generate_order_card(order_details, items, buyer_name, buyer_phone, store_nam
         traceback.print_exc()
         return None
 
+def product_card_key(product, store_name):
+    """Hash of everything the card shows (quantity isn't drawn, so stock changes keep the render)."""
+    pid, name, desc, price, wholesale_price, qty, img_path = product
+    image_file = find_image_file(img_path)
+    return make_key(PRODUCT_CARD_TEMPLATE_VERSION, pid, name, desc, price, wholesale_price,
+                    file_digest(image_file) if image_file else None, store_name)
+
 def generate_product_card(product, store_name):
+    """Product card PNG (BytesIO), served from product_card_cache when the same card was rendered before."""
+    return cached_render(product_card_cache, f"p{product[0]}", product_card_key, partial(render_card, 'product'),
+                         product, store_name)
+
+def render_product_card(product, store_name):
     """
     Generate a 600px wide product card.
     Top 50% = Image (Contained).
@@ -325,23 +465,6 @@ def generate_product_card(product, store_name):
         
         product_img = None
         
-        # Helper to find image
-        def find_image_file(path_str):
-            if not path_str or not isinstance(path_str, str): return None
-            clean = path_str.split('?')[0].replace('\\', '/')
-            if 'http' in clean: return None
-            basename = os.path.basename(clean)
-            base_dirs = [
-                os.getcwd(),
-                os.path.join(os.getcwd(), "data", "Images"),
-                "C:/Users/Hp/Desktop/TelegramStoreBot/data/Images"
-            ]
-            for d in base_dirs:
-                if os.path.exists(d):
-                     fp = os.path.join(d, basename)
-                     if os.path.exists(fp): return fp
-            return None
-
         final_path = find_image_file(img_path)
         if final_path:
              try: product_img = Image.open(final_path).convert('RGBA')
@@ -424,3 +547,5 @@ def generate_product_card(product, store_name):
         import traceback
         traceback.print_exc()
         return None
+
+RENDERERS = {'order': render_order_card, 'product': render_product_card}
@@ -0,0 +1,147 @@
+"""
+Disk cache for rendered cards.
+
+Entries are content-addressed: the key is a hash of everything the render depends on
+(see receipt_generator.product_card_key), so a changed product, photo, store name or
+template gets a new key and a stale card can never be served. Files are named
+<group>-<key>.png, where group is the product (or order) the card belongs to, so
+invalidate(group) can free a product's old renders as soon as it changes.
+
+The directory is bounded to max_bytes; the least recently used files (by mtime, which a hit
+refreshes) are evicted first. Several processes may share one directory: a file evicted by
+another process is simply a miss.
+"""
+import hashlib
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+_file_digests = OrderedDict()
+_file_digests_lock = threading.Lock()
+FILE_DIGESTS = 4096
+
+
+def file_digest(path):
+    """sha256 of a file's content, memoized by (path, mtime, size); None if it doesn't exist."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    with _file_digests_lock:
+        digest = _file_digests.get(key)
+        if digest is not None:
+            _file_digests.move_to_end(key)
+            return digest
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+    with _file_digests_lock:
+        _file_digests[key] = digest
+        while len(_file_digests) > FILE_DIGESTS:
+            _file_digests.popitem(last=False)
+    return digest
+
+
+def make_key(*parts):
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()[:32]
+
+
+class RenderCache:
+    def __init__(self, directory, max_bytes=200 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # file name -> size, least recently used first
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith('.png'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._entries[name] = size
+            self._bytes += size
+
+    @staticmethod
+    def _name(group, key):
+        return f"{group}-{key}.png"
+
+    def get(self, group, key):
+        name = self._name(group, key)
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+                size = self._entries.pop(name, None)
+                if size is not None:
+                    self._bytes -= size
+            return None
+        with self._lock:
+            self.hits += 1
+            if name in self._entries:
+                self._entries.move_to_end(name)
+            else:
+                # Written by another process
+                self._entries[name] = len(data)
+                self._bytes += len(data)
+        return data
+
+    def put(self, group, key, data):
+        name = self._name(group, key)
+        path = os.path.join(self.directory, name)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            old = self._entries.pop(name, None)
+            if old is not None:
+                self._bytes -= old
+            self._entries[name] = len(data)
+            self._bytes += len(data)
+            evict = []
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                victim, size = self._entries.popitem(last=False)
+                self._bytes -= size
+                evict.append(victim)
+        self._remove(evict)
+
+    def invalidate(self, group):
+        """Drops every cached render of a group (e.g. all renders of one product)."""
+        prefix = f"{group}-"
+        with self._lock:
+            names = [name for name in self._entries if name.startswith(prefix)]
+            for name in names:
+                self._bytes -= self._entries.pop(name)
+        # Also files other processes wrote that this one hasn't seen
+        try:
+            names += [e.name for e in os.scandir(self.directory) if e.name.startswith(prefix) and e.name not in names]
+        except OSError:
+            pass
+        self._remove(names)
+
+    def _remove(self, names):
+        for name in names:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses}
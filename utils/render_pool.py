@@ -0,0 +1,108 @@
+"""
+Process-pool card renderer.
+
+Pillow rendering is CPU-bound and holds the GIL for most of a card, so rendering on the
+handler threads stalls every other chat. RenderPool runs receipt_generator's renderers in
+worker processes instead: callers pass the DB rows, the worker draws the card and sends back
+the PNG bytes.
+
+* Workers are forked and warmed (fonts loaded) when the pool is created, so the pool must be
+  created before the process starts any threads: the bot does it at startup (never on import),
+  before starting its update threads, or first thing in each forked bot worker process.
+* max_inflight bounds queued + running renders; a render that can't get a slot, or doesn't
+  finish within its deadline, returns None and the caller sends its text caption instead.
+* Where fork isn't available (Windows) there is no pool and cards render on the calling thread.
+* The process's pool is registered with install() and looked up with current(). It lives here,
+  not in receipt_generator, so reloading that module (DEV_HOT_RELOAD) keeps using it.
+"""
+import atexit
+import io
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+
+_current = None
+
+
+def install(pool):
+    """Makes pool (or None: render on the calling thread) the one receipt_generator renders on."""
+    global _current
+    _current = pool
+
+
+def current():
+    return _current
+
+
+def _init_worker():
+    from utils import receipt_generator
+    # A worker renders itself; it never hands work to another pool
+    install(None)
+    receipt_generator.preload_fonts()
+
+
+def _warm():
+    return True
+
+
+def _render_in_worker(kind, args):
+    from utils import receipt_generator
+    bio = receipt_generator.RENDERERS[kind](*args)
+    return bio.getvalue() if bio is not None else None
+
+
+class RenderPool:
+    def __init__(self, workers, max_inflight=None, deadline=5.0):
+        self.workers = workers
+        self.max_inflight = max_inflight or workers * 4
+        self.deadline = deadline
+        self._slots = threading.BoundedSemaphore(self.max_inflight)
+        self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+                                             initializer=_init_worker)
+        self.broken = False
+        self.rendered = 0
+        self.timeouts = 0
+        self.rejected = 0
+        # Launches every worker now, while the process is still single-threaded
+        for future in [self._executor.submit(_warm) for _ in range(workers)]:
+            future.result()
+        atexit.register(self.shutdown)
+
+    @staticmethod
+    def available():
+        return 'fork' in multiprocessing.get_all_start_methods()
+
+    def render(self, kind, *args):
+        """PNG BytesIO from receipt_generator.RENDERERS[kind](*args), or None if over budget."""
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.deadline):
+            self.rejected += 1
+            return None
+        try:
+            future = self._executor.submit(_render_in_worker, kind, args)
+        except BrokenProcessPool:
+            self._slots.release()
+            self.broken = True
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        try:
+            data = future.result(timeout=max(self.deadline - (time.monotonic() - started), 0))
+        except TimeoutError:
+            # The render keeps its slot until the worker is done with it
+            self.timeouts += 1
+            return None
+        except BrokenProcessPool:
+            self.broken = True
+            raise
+        self.rendered += 1
+        return io.BytesIO(data) if data is not None else None
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {'workers': self.workers, 'max_inflight': self.max_inflight, 'rendered': self.rendered,
+                'timeouts': self.timeouts, 'rejected': self.rejected, 'broken': self.broken}
@@ -0,0 +1,404 @@
+"""
+Indexed update dispatch.
+
+pyTelegramBotAPI tests every registered handler's filters, in order, for every update. With
+150+ handlers that is 150+ lambda calls per message, some of which hit the database.
+
+RoutedTeleBot narrows each update to the handlers that can possibly match before telebot tests
+them. The index is derived from each handler's `func=` lambda: a top-level `and` conjunct of
+one of these shapes is a necessary condition and becomes the handler's key:
+
+    message.text == "..."  /  in [...]           exact text
+    call.data == "..."  /  in [...]              exact callback data
+    call.data.startswith("..." | ("...", ...))   callback prefix (trie)
+    user_states[<sender>.from_user.id]["step"] == "..." / in [...]   conversation step (also .get("step"))
+    commands=[...]                               command name
+    utils.callbacks.action_filter(...)           codec action code (payload decoded once)
+
+Everything else is "dynamic" and is always a candidate. Candidates are still run through
+telebot's normal filter test, in registration order, so the first-match semantics are
+unchanged; the index only skips handlers that could not have matched.
+"""
+import ast
+import threading
+from collections import defaultdict
+from functools import wraps
+
+import telebot
+from telebot import util
+
+from utils.callbacks import decode_call
+
+INDEXED_UPDATE_TYPES = ('message', 'callback_query')
+
+
+# ----------------- Lambda analysis -----------------
+_module_lambdas = {}
+_module_lambdas_lock = threading.Lock()
+
+
+def _lambdas_by_line(filename):
+    with _module_lambdas_lock:
+        cached = _module_lambdas.get(filename)
+        if cached is not None:
+            return cached
+        by_line = defaultdict(list)
+        try:
+            with open(filename, encoding='utf-8') as f:
+                tree = ast.parse(f.read(), filename)
+            for node in ast.walk(tree):
+                if isinstance(node, ast.Lambda):
+                    by_line[node.lineno].append(node)
+        except (OSError, SyntaxError, ValueError):
+            pass
+        _module_lambdas[filename] = by_line
+        return by_line
+
+
+def _lambda_node(func):
+    """The ast.Lambda a function object was compiled from, or None when it can't be pinned down."""
+    code = getattr(func, '__code__', None)
+    if code is None or code.co_name != '<lambda>':
+        return None
+    nodes = _lambdas_by_line(code.co_filename).get(code.co_firstlineno, [])
+    if len(nodes) == 1:
+        return nodes[0]
+    # Several lambdas on one line: pick the one whose span contains the compiled body
+    for line, _end_line, col, _end_col in code.co_positions():
+        if line is None or col is None:
+            continue
+        containing = [
+            n for n in nodes
+            if (n.lineno, n.col_offset) <= (line, col) <= (n.end_lineno, n.end_col_offset)
+        ]
+        if len(containing) == 1:
+            return containing[0]
+    return None
+
+
+def _conjuncts(node):
+    if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+        out = []
+        for value in node.values:
+            out.extend(_conjuncts(value))
+        return out
+    return [node]
+
+
+def _is_attr(node, param, attr):
+    return (isinstance(node, ast.Attribute) and node.attr == attr
+            and isinstance(node.value, ast.Name) and node.value.id == param)
+
+
+def _is_sender_id(node, param):
+    # <param>.from_user.id
+    return (isinstance(node, ast.Attribute) and node.attr == 'id'
+            and _is_attr(node.value, param, 'from_user'))
+
+
+def _str_constant(node):
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    return None
+
+
+def _equality(node):
+    """(expr, "constant") for `expr == "constant"` in either order, else None."""
+    if not (isinstance(node, ast.Compare) and len(node.ops) == 1 and isinstance(node.ops[0], ast.Eq)):
+        return None
+    left, right = node.left, node.comparators[0]
+    if _str_constant(right) is not None:
+        return left, right.value
+    if _str_constant(left) is not None:
+        return right, left.value
+    return None
+
+
+def _is_user_state(node, param, state_name):
+    # user_states[<param>.from_user.id]  or  user_states.get(<param>.from_user.id, ...)
+    if isinstance(node, ast.Subscript):
+        return (isinstance(node.value, ast.Name) and node.value.id == state_name
+                and _is_sender_id(node.slice, param))
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == 'get':
+        owner = node.func.value
+        return (isinstance(owner, ast.Name) and owner.id == state_name
+                and node.args and _is_sender_id(node.args[0], param))
+    return False
+
+
+def _is_step_of_state(node, param, state_name):
+    # <state>["step"]  or  <state>.get("step")
+    if isinstance(node, ast.Subscript):
+        return _str_constant(node.slice) == 'step' and _is_user_state(node.value, param, state_name)
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == 'get':
+        return (node.args and _str_constant(node.args[0]) == 'step'
+                and _is_user_state(node.func.value, param, state_name))
+    return False
+
+
+def _membership(node):
+    """(expr, ("a", "b", ...)) for `expr in ["a", "b", ...]` (list, tuple or set literal), else None."""
+    if not (isinstance(node, ast.Compare) and len(node.ops) == 1 and isinstance(node.ops[0], ast.In)):
+        return None
+    container = node.comparators[0]
+    if isinstance(container, (ast.List, ast.Tuple, ast.Set)) and container.elts \
+            and all(_str_constant(e) is not None for e in container.elts):
+        return node.left, tuple(e.value for e in container.elts)
+    return None
+
+
+def _key_for_conjunct(node, param, state_name):
+    equality = _equality(node)
+    if equality:
+        expr, value = equality
+        values = (value,)
+    else:
+        equality = _membership(node)
+        if equality:
+            expr, values = equality
+    if equality:
+        if _is_attr(expr, param, 'text'):
+            return 'text', values
+        if _is_attr(expr, param, 'data'):
+            return 'data', values
+        if _is_step_of_state(expr, param, state_name):
+            return 'step', values
+        return None
+
+    if (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr == 'startswith'
+            and _is_attr(node.func.value, param, 'data') and len(node.args) == 1 and not node.keywords):
+        arg = node.args[0]
+        if _str_constant(arg) is not None:
+            return 'prefix', (arg.value,)
+        if isinstance(arg, ast.Tuple) and all(_str_constant(e) is not None for e in arg.elts):
+            return 'prefix', tuple(e.value for e in arg.elts)
+    return None
+
+
+# Most selective key wins when a lambda has several indexable conjuncts
+_KEY_PRIORITY = ('text', 'data', 'step', 'prefix')
+
+
+def analyze_filter(func, state_name='user_states'):
+    """(kind, values) describing a necessary condition of a handler filter, or None if it is dynamic."""
+    code = getattr(func, 'callback_action', None)
+    if code is not None:
+        return 'action', (code,)
+    node = _lambda_node(func)
+    if node is None or len(node.args.args) != 1:
+        return None
+    param = node.args.args[0].arg
+    keys = {}
+    for conjunct in _conjuncts(node.body):
+        key = _key_for_conjunct(conjunct, param, state_name)
+        if key and key[0] not in keys:
+            keys[key[0]] = key[1]
+    for kind in _KEY_PRIORITY:
+        if kind in keys:
+            return kind, keys[kind]
+    return None
+
+
+# ----------------- Index -----------------
+class Route:
+    __slots__ = ('seq', 'handler', 'kind', 'keys', 'name', 'hits')
+
+    def __init__(self, seq, handler, kind, keys):
+        self.seq = seq
+        self.handler = handler
+        self.kind = kind
+        self.keys = keys
+        self.name = getattr(handler['function'], '__name__', repr(handler['function']))
+        self.hits = 0
+
+
+class _PrefixTrie:
+    def __init__(self):
+        self.root = {}
+
+    def add(self, prefix, route):
+        node = self.root
+        for ch in prefix:
+            node = node.setdefault(ch, {})
+        node.setdefault(None, []).append(route)
+
+    def match(self, text):
+        node = self.root
+        found = list(node.get(None, ()))
+        for ch in text:
+            node = node.get(ch)
+            if node is None:
+                break
+            found.extend(node.get(None, ()))
+        return found
+
+
+class _HandlerIndex:
+    """Index over one telebot handler list (message_handlers or callback_query_handlers)."""
+
+    def __init__(self, handlers, state_name):
+        self.size = len(handlers)
+        self.routes = []
+        self.exact = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))   # content_type -> kind -> value -> routes
+        self.commands = defaultdict(lambda: defaultdict(list))
+        self.prefixes = defaultdict(_PrefixTrie)
+        self.dynamic = defaultdict(list)
+
+        for seq, handler in enumerate(handlers):
+            filters = handler['filters']
+            func = filters.get('func')
+            key = analyze_filter(func, state_name) if func else None
+            commands = filters.get('commands')
+            if key is None and commands:
+                key = ('command', tuple(commands))
+            kind, keys = key if key else ('dynamic', ())
+            route = Route(seq, handler, kind, keys)
+            self.routes.append(route)
+            _count_hits(route)
+
+            # Callback handlers have no content_types; they all live in bucket None
+            for content_type in filters.get('content_types') or (None,):
+                if kind == 'dynamic':
+                    self.dynamic[content_type].append(route)
+                elif kind == 'prefix':
+                    for prefix in keys:
+                        self.prefixes[content_type].add(prefix, route)
+                elif kind == 'command':
+                    for command in keys:
+                        self.commands[content_type][command].append(route)
+                else:
+                    for value in keys:
+                        self.exact[content_type][kind][value].append(route)
+
+    def candidates(self, update, update_type, step_of):
+        content_type = getattr(update, 'content_type', None) if update_type == 'message' else None
+        exact = self.exact.get(content_type, {})
+        found = list(self.dynamic.get(content_type, ()))
+
+        if update_type == 'message':
+            text = update.text
+            if text is not None:
+                found.extend(exact.get('text', {}).get(text, ()))
+                command = util.extract_command(text) if content_type == 'text' else None
+                if command is not None:
+                    found.extend(self.commands.get(content_type, {}).get(command, ()))
+        else:
+            data = update.data
+            if data is not None:
+                found.extend(exact.get('data', {}).get(data, ()))
+                payload = decode_call(update)
+                if payload is not None:
+                    found.extend(exact.get('action', {}).get(payload.action.code, ()))
+                trie = self.prefixes.get(content_type)
+                if trie is not None:
+                    found.extend(trie.match(data))
+
+        steps = exact.get('step')
+        if steps:
+            sender = getattr(update, 'from_user', None)
+            step = step_of(sender.id) if sender else None
+            if step is not None:
+                found.extend(steps.get(step, ()))
+
+        # Registration order decides, exactly as in telebot's linear scan
+        unique = {route.seq: route for route in found}
+        return [unique[seq].handler for seq in sorted(unique)]
+
+
+def _count_hits(route):
+    function = route.handler['function']
+    if getattr(function, '_route', None) is not None:
+        function._route = route
+        return
+
+    # wraps() keeps __wrapped__, so telebot's inspect.signature still sees the real parameters
+    @wraps(function)
+    def counted(*args, **kwargs):
+        counted._route.hits += 1
+        return function(*args, **kwargs)
+
+    counted._route = route
+    route.handler['function'] = counted
+
+
+class _Candidates:
+    """Handler list handed to telebot; resolved lazily on the worker thread, after middlewares ran."""
+
+    def __init__(self, router, handlers, update, update_type):
+        self._router = router
+        self._handlers = handlers
+        self._update = update
+        self._update_type = update_type
+
+    def __bool__(self):
+        return bool(self._handlers)
+
+    def __iter__(self):
+        return iter(self._router.candidates(self._handlers, self._update, self._update_type))
+
+
+class Router:
+    def __init__(self, step_of=None, state_name='user_states'):
+        """
+        step_of(telegram_id) returns the sender's current conversation step (or None);
+        state_name is the name the filter lambdas use for the conversation-state dict.
+        """
+        self.step_of = step_of or (lambda telegram_id: None)
+        self.state_name = state_name
+        self._indexes = {}
+        self._lock = threading.Lock()
+        self.updates = 0
+        self.evaluated = 0
+
+    def _index_for(self, handlers, update_type):
+        index = self._indexes.get(update_type)
+        # Rebuilt whenever handlers were registered after the last build
+        if index is None or index.size != len(handlers):
+            with self._lock:
+                index = self._indexes.get(update_type)
+                if index is None or index.size != len(handlers):
+                    index = _HandlerIndex(handlers, self.state_name)
+                    self._indexes[update_type] = index
+        return index
+
+    def candidates(self, handlers, update, update_type):
+        found = self._index_for(handlers, update_type).candidates(update, update_type, self.step_of)
+        self.updates += 1
+        self.evaluated += len(found)
+        return found
+
+    def stats(self):
+        """Per-route hit counters plus index shape, for the admin /routes command."""
+        routes = []
+        kinds = defaultdict(int)
+        for update_type, index in self._indexes.items():
+            for route in index.routes:
+                kinds[route.kind] += 1
+                routes.append((update_type, route.name, route.kind, route.hits))
+        routes.sort(key=lambda r: r[3], reverse=True)
+        return {
+            'updates': self.updates,
+            'avg_candidates': (self.evaluated / self.updates) if self.updates else 0,
+            'kinds': dict(kinds),
+            'routes': routes,
+        }
+
+
+class RoutedTeleBot(telebot.TeleBot):
+    """TeleBot whose message and callback handlers are dispatched through a Router."""
+
+    def __init__(self, *args, router=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.router = router or Router()
+
+    def _notify_command_handlers(self, handlers, new_messages, update_type):
+        if update_type not in INDEXED_UPDATE_TYPES or not handlers:
+            return super()._notify_command_handlers(handlers, new_messages, update_type)
+        middlewares = self._get_middlewares(update_type) if self.use_class_middlewares else None
+        for message in new_messages:
+            self._exec_task(
+                self._run_middlewares_and_handler,
+                message,
+                handlers=_Candidates(self.router, handlers, message, update_type),
+                middlewares=middlewares,
+                update_type=update_type)
@@ -0,0 +1,199 @@
+"""
+Per-chat ordered task scheduler.
+
+telebot's ThreadPool hands every update to whichever thread is free, so two quick taps by the
+same user (double "checkout_cart", two "increase_cart") can run at the same time and race on
+Carts and Orders. ChatOrderedPool is a drop-in replacement for bot.worker_pool: tasks of the
+same chat run one after another, in arrival order, while different chats run in parallel on
+num_threads threads. Tasks that don't belong to a chat run unordered.
+
+Each chat with pending work has a FIFO of tasks; the chat itself sits in the ready queue at
+most once, so a busy chat can never occupy more than one thread and chats are served
+round-robin.
+
+track_tasks() lets the code that submits updates wait until the tasks they produced have run
+(webhook mode acknowledges an update only once it was processed).
+"""
+import queue
+import threading
+import time
+import traceback
+from collections import deque
+from contextlib import contextmanager
+
+_STOP = object()
+_tracking = threading.local()
+
+
+class TaskTracker:
+    """Counts the tasks put on a ChatOrderedPool inside a track_tasks() block until they have run."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending = 0
+        self._callbacks = []
+
+    def added(self):
+        with self._cond:
+            self._pending += 1
+
+    def finished(self):
+        with self._cond:
+            self._pending -= 1
+            if self._pending:
+                return
+            self._cond.notify_all()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def when_done(self, callback):
+        """Calls callback() once every tracked task has run: now, or on the thread running the last one."""
+        with self._cond:
+            if self._pending:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def wait(self, timeout=None):
+        """True once every tracked task has run (whether or not it raised), False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._pending == 0, timeout)
+
+
+@contextmanager
+def track_tasks():
+    """Tasks put on any ChatOrderedPool by this thread inside the block are counted by the yielded tracker."""
+    previous = getattr(_tracking, 'tracker', None)
+    tracker = _tracking.tracker = TaskTracker()
+    try:
+        yield tracker
+    finally:
+        _tracking.tracker = previous
+
+
+def chat_key(update):
+    """Chat id a Message / CallbackQuery belongs to, or None."""
+    chat = getattr(update, 'chat', None)
+    if chat is not None:
+        return chat.id
+    message = getattr(update, 'message', None)
+    if message is not None and getattr(message, 'chat', None) is not None:
+        return message.chat.id
+    user = getattr(update, 'from_user', None)
+    return user.id if user is not None else None
+
+
+class ChatOrderedPool:
+    """Same interface telebot expects from worker_pool: put, raise_exceptions, clear_exceptions, close."""
+
+    def __init__(self, telebot, num_threads=4, key=chat_key):
+        self.telebot = telebot
+        self.num_threads = num_threads
+        self.key = key
+        self._ready = queue.Queue()
+        self._pending = {}       # chat key -> deque of tasks (present while the chat is queued or running)
+        self._lock = threading.Lock()
+        self.exception_event = threading.Event()
+        self.exception_info = None
+        self.processed = 0
+        self.max_wait = 0.0
+        self._workers = [
+            threading.Thread(target=self._run, name=f"ChatWorker{i + 1}", daemon=True)
+            for i in range(num_threads)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def put(self, func, *args, **kwargs):
+        tracker = getattr(_tracking, 'tracker', None)
+        if tracker is not None:
+            tracker.added()
+        task = (func, args, kwargs, time.monotonic(), tracker)
+        key = self.key(args[0]) if args else None
+        if key is None:
+            self._ready.put((None, task))
+            return
+        with self._lock:
+            tasks = self._pending.get(key)
+            if tasks is not None:
+                tasks.append(task)
+                return
+            self._pending[key] = deque([task])
+        self._ready.put((key, None))
+
+    def _run(self):
+        while True:
+            key, task = self._ready.get()
+            if key is _STOP:
+                return
+            if key is None:
+                self._execute(task)
+                continue
+            with self._lock:
+                task = self._pending[key].popleft()
+            self._execute(task)
+            with self._lock:
+                if self._pending[key]:
+                    # Back of the line, so one busy chat doesn't starve the others
+                    self._ready.put((key, None))
+                else:
+                    del self._pending[key]
+
+    def _execute(self, task):
+        func, args, kwargs, queued_at, tracker = task
+        self.max_wait = max(self.max_wait, time.monotonic() - queued_at)
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            traceback.print_exc()
+            self.on_exception(e)
+        finally:
+            self.processed += 1
+            if tracker is not None:
+                tracker.finished()
+
+    def on_exception(self, exc_info):
+        handled = False
+        if self.telebot.exception_handler is not None:
+            handled = self.telebot.exception_handler.handle(exc_info)
+        if not handled:
+            self.exception_info = exc_info
+            self.exception_event.set()
+
+    def raise_exceptions(self):
+        if self.exception_event.is_set():
+            raise self.exception_info
+
+    def clear_exceptions(self):
+        self.exception_event.clear()
+
+    def close(self):
+        for _ in self._workers:
+            self._ready.put((_STOP, None))
+        for worker in self._workers:
+            if worker is not threading.current_thread():
+                worker.join()
+
+    def stats(self):
+        with self._lock:
+            depths = [len(tasks) for tasks in self._pending.values()]
+        return {
+            'threads': self.num_threads,
+            'queued': sum(depths),
+            'chats': len(depths),
+            'max_chat_depth': max(depths, default=0),
+            'ready': self._ready.qsize(),
+            'processed': self.processed,
+            'max_wait': self.max_wait,
+        }
+
+
+def install(telebot, num_threads):
+    """Replaces telebot's default ThreadPool with a ChatOrderedPool."""
+    old = getattr(telebot, 'worker_pool', None)
+    telebot.worker_pool = ChatOrderedPool(telebot, num_threads=num_threads)
+    telebot.threaded = True
+    if old is not None:
+        old.close()
+    return telebot.worker_pool
@@ -0,0 +1,189 @@
+"""
+SQL dialect translation.
+bot.py writes every statement once in SQLite style (? placeholders, AUTOINCREMENT, DATETIME);
+compile_query() turns each distinct string into its Postgres form a single time and caches it.
+"""
+import os
+import threading
+import weakref
+from collections import namedtuple
+from functools import lru_cache
+
+CompiledQuery = namedtuple('CompiledQuery', ['sql', 'is_insert_returning', 'param_count', 'preparable'])
+
+_PREPARABLE_VERBS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+
+@lru_cache(maxsize=2048)
+def compile_query(query, is_postgres):
+    sql = query
+    if is_postgres:
+        # Replace ? with %s
+        sql = sql.replace('?', '%s')
+        # Handle AUTOINCREMENT replacement for Postgres compatibility
+        sql = sql.replace('INTEGER PRIMARY KEY AUTOINCREMENT', 'SERIAL PRIMARY KEY')
+        sql = sql.replace('DATETIME DEFAULT CURRENT_TIMESTAMP', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP')
+        sql = sql.replace('DATETIME', 'TIMESTAMP')
+
+    upper = sql.lstrip().upper()
+    is_insert_returning = upper.startswith("INSERT") and "RETURNING" in upper
+
+    param_count = sql.count('%s') if is_postgres else sql.count('?')
+    # Only plain DML/SELECT whose only % signs are placeholders can become server-side prepared
+    preparable = (
+        is_postgres
+        and param_count > 0
+        and upper.startswith(_PREPARABLE_VERBS)
+        and sql.count('%') == param_count
+        and '$' not in sql
+        and ';' not in sql.rstrip().rstrip(';')
+    )
+    return CompiledQuery(sql, is_insert_returning, param_count, preparable)
+
+
+def to_positional(sql):
+    """Rewrites %s placeholders as $1..$n for PREPARE."""
+    parts = sql.split('%s')
+    out = [parts[0]]
+    for i, part in enumerate(parts[1:], start=1):
+        out.append(f"${i}")
+        out.append(part)
+    return ''.join(out)
+
+
+# ===================== Server-side prepared statements (Postgres) =====================
+PREPARE_AFTER = int(os.environ.get('DB_PREPARE_AFTER', '5'))
+PREPARED_STATEMENTS_ENABLED = os.environ.get('DB_PREPARED_STATEMENTS', '1') != '0'
+
+
+class PreparedStatements:
+    """
+    Per-connection registry of statements prepared on the server.
+    A statement is prepared once it has run PREPARE_AFTER times on the same connection;
+    after that it is sent as EXECUTE name(...), skipping parse/plan on the server.
+    """
+
+    _by_connection = weakref.WeakKeyDictionary()
+    _lock = threading.Lock()
+    # Statements the server refused to prepare; never retried for any connection
+    _rejected = set()
+
+    def __init__(self):
+        self.hits = {}
+        self.names = {}
+        self.counter = 0
+
+    @classmethod
+    def for_connection(cls, conn):
+        with cls._lock:
+            registry = cls._by_connection.get(conn)
+            if registry is None:
+                registry = cls._by_connection[conn] = cls()
+            return registry
+
+    @classmethod
+    def reject(cls, sql):
+        with cls._lock:
+            cls._rejected.add(sql)
+
+    def lookup(self, compiled):
+        """Returns (name, needs_prepare) or (None, False) when the statement should run as-is."""
+        if not PREPARED_STATEMENTS_ENABLED or not compiled.preparable or compiled.sql in self._rejected:
+            return None, False
+        name = self.names.get(compiled.sql)
+        if name:
+            return name, False
+        hits = self.hits.get(compiled.sql, 0) + 1
+        self.hits[compiled.sql] = hits
+        if hits < PREPARE_AFTER:
+            return None, False
+        self.counter += 1
+        return f"bot_stmt_{self.counter}", True
+
+    def remember(self, compiled, name):
+        self.names[compiled.sql] = name
+        self.hits.pop(compiled.sql, None)
+
+    def forget(self, compiled):
+        self.names.pop(compiled.sql, None)
+        self.hits.pop(compiled.sql, None)
+
+
+# SQLSTATEs meaning the prepared form of a statement failed, not the statement itself
+_PREPARED_STALE = {'26000', '0A000'}                 # statement gone (DISCARD ALL, pooler), cached plan changed result type
+# Parameters no longer fit the types fixed at PREPARE. Not 22P02 (invalid_text_representation):
+# that is also what a bad value bound to a well-typed parameter raises, prepared or not
+_PREPARED_TYPE_MISMATCH = {'42804', '42P18'}
+
+
+def _drop_prepared(registry, compiled, error):
+    """Drops the prepared form of a statement after an error it caused; False for ordinary errors."""
+    code = getattr(error, 'pgcode', None)
+    if code in _PREPARED_STALE:
+        # Prepared again under a new name once it is hot
+        registry.forget(compiled)
+    elif code in _PREPARED_TYPE_MISMATCH:
+        registry.forget(compiled)
+        PreparedStatements.reject(compiled.sql)
+    else:
+        return False
+    return True
+
+
+def execute_sql(cursor, compiled, params):
+    """Runs a compiled statement on a raw cursor, using a prepared statement when it is hot."""
+    if params is None:
+        cursor.execute(compiled.sql)
+        return
+
+    if not compiled.preparable:
+        cursor.execute(compiled.sql, params)
+        return
+
+    registry = PreparedStatements.for_connection(cursor.connection)
+    name, needs_prepare = registry.lookup(compiled)
+    if name is None:
+        cursor.execute(compiled.sql, params)
+        return
+
+    execute_stmt = f"EXECUTE {name} ({', '.join(['%s'] * compiled.param_count)})"
+    if needs_prepare:
+        # First use: guard with a savepoint so a statement the server can't prepare
+        # falls back to a plain execute without aborting the caller's transaction.
+        # Savepoint bookkeeping runs on a side cursor so the EXECUTE result stays fetchable.
+        aux = cursor.connection.cursor()
+        aux.execute("SAVEPOINT bot_prepare")
+        try:
+            aux.execute(f"PREPARE {name} AS {to_positional(compiled.sql)}")
+        except Exception as e:
+            aux.execute("ROLLBACK TO SAVEPOINT bot_prepare")
+            aux.execute("RELEASE SAVEPOINT bot_prepare")
+            aux.close()
+            print(f"⚠️ Could not prepare statement, running it unprepared: {e}")
+            PreparedStatements.reject(compiled.sql)
+            cursor.execute(compiled.sql, params)
+            return
+        # PREPARE is not transactional: the statement exists from here on, even if rolled back
+        registry.remember(compiled, name)
+        try:
+            cursor.execute(execute_stmt, params)
+        except Exception as e:
+            if not _drop_prepared(registry, compiled, e):
+                # An ordinary error (unique violation, deadlock, ...): the statement stays prepared
+                # and the transaction is left failed, as the unprepared statement would leave it
+                aux.close()
+                raise
+            aux.execute("ROLLBACK TO SAVEPOINT bot_prepare")
+            aux.execute("RELEASE SAVEPOINT bot_prepare")
+            aux.close()
+            cursor.execute(compiled.sql, params)
+            return
+        aux.execute("RELEASE SAVEPOINT bot_prepare")
+        aux.close()
+        return
+
+    try:
+        cursor.execute(execute_stmt, params)
+    except Exception as e:
+        _drop_prepared(registry, compiled, e)
+        raise
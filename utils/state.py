@@ -0,0 +1,352 @@
+"""
+Conversation state store.
+
+user_states used to be a plain process-global dict: it grew forever (whole cart snapshots,
+verified phones) and was lost on every restart or redeploy, together with telebot's
+next-step handlers. StateStore keeps the same dict interface the handlers already use
+(`uid in user_states`, `user_states[uid]["step"]`, `del user_states[uid]`, ...) on top of
+
+    * an in-memory working set bounded by max_entries (least recently used entries are
+      written back and dropped first), and
+    * a sliding TTL: an entry nobody touched for ttl seconds is treated as gone (lazy expiry),
+      and expired rows are purged from the backend now and then.
+
+Backends: MemoryStateBackend (nothing outlives the process) and SQLStateBackend (the
+ConversationState table, on SQLite or Postgres through the usual DBWrapper).
+
+Handlers mutate the stored dicts in place, so the store can't see writes as they happen.
+Every key read or written is remembered instead, and flush_stores() pickles those entries
+at the end of the update and writes the ones whose bytes changed. StateFlushMiddleware does
+that for message and callback handlers, StateHandlerBackend for next-step handlers.
+"""
+import pickle
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from telebot import Handler
+from telebot.handler_backends import HandlerBackend
+
+DEFAULT_TTL_SECONDS = 24 * 3600
+DEFAULT_MAX_ENTRIES = 10000
+# Expired rows are deleted from the backend at most this often
+PURGE_INTERVAL_SECONDS = 600
+
+_ABSENT = object()
+
+_stores = weakref.WeakSet()
+
+
+# ----------------- Backends -----------------
+class MemoryStateBackend:
+    """Keeps nothing: the store's working set is all there is."""
+    persistent = False
+
+    def load(self, namespace, key):
+        return None
+
+    def save(self, namespace, key, blob, expires_at):
+        pass
+
+    def delete(self, namespace, key):
+        pass
+
+    def purge_expired(self, now):
+        pass
+
+
+class SQLStateBackend:
+    """Rows of ConversationState(Namespace, StateKey, Value, ExpiresAt), one per entry."""
+    persistent = True
+
+    def __init__(self, connect):
+        # connect() returns a DBWrapper whose close() hands the connection back to its pool
+        self.connect = connect
+
+    def load(self, namespace, key):
+        """(blob, expires_at) or None."""
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT Value, ExpiresAt FROM ConversationState WHERE Namespace = ? AND StateKey = ?",
+                           (namespace, str(key)))
+            row = cursor.fetchone()
+            return (bytes(row[0]), row[1]) if row else None
+        finally:
+            conn.close()
+
+    def save(self, namespace, key, blob, expires_at):
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO ConversationState (Namespace, StateKey, Value, ExpiresAt) VALUES (?, ?, ?, ?)
+                ON CONFLICT (Namespace, StateKey) DO UPDATE SET Value = excluded.Value, ExpiresAt = excluded.ExpiresAt
+            """, (namespace, str(key), blob, expires_at))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def delete(self, namespace, key):
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM ConversationState WHERE Namespace = ? AND StateKey = ?", (namespace, str(key)))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def purge_expired(self, now):
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM ConversationState WHERE ExpiresAt < ?", (now,))
+            conn.commit()
+        finally:
+            conn.close()
+
+
+# ----------------- Store -----------------
+class _Entry:
+    __slots__ = ('value', 'expires_at', 'saved_blob', 'saved_expires_at')
+
+    def __init__(self, value, expires_at, saved_blob=None, saved_expires_at=0):
+        self.value = value
+        self.expires_at = expires_at
+        # What the backend currently holds, so unchanged entries are not written again
+        self.saved_blob = saved_blob
+        self.saved_expires_at = saved_expires_at
+
+
+class StateStore:
+    """Dict-like conversation state for one namespace (e.g. 'user_states')."""
+
+    def __init__(self, namespace, backend=None, ttl=DEFAULT_TTL_SECONDS, max_entries=DEFAULT_MAX_ENTRIES):
+        self.namespace = namespace
+        self.backend = backend or MemoryStateBackend()
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # key -> _Entry, or _ABSENT when the backend is known not to have the key
+        self._entries = OrderedDict()
+        self._touched = set()
+        self._lock = threading.RLock()
+        self._last_purge = time.time()
+        _stores.add(self)
+
+    # ---- working set ----
+    def _preload(self, key):
+        """
+        Loads key from the backend into the working set if it isn't there yet. The backend
+        round trip runs without the store lock, so a miss doesn't hold up every other thread.
+        """
+        if not self.backend.persistent:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+        entry = self._read(key, time.time())
+        with self._lock:
+            # Another thread may have loaded or set the key meanwhile; its entry wins
+            if key not in self._entries:
+                self._entries[key] = entry
+                self._evict()
+
+    def _lookup(self, key):
+        """The live _Entry for key (loading it from the backend if _preload didn't), or None. Needs the lock."""
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is None:
+            # Not preloaded, or evicted since: rare, so loading under the lock is fine
+            entry = self._entries[key] = self._read(key, now)
+            self._evict()
+        if entry is _ABSENT:
+            self._entries.move_to_end(key)
+            return None
+        if entry.expires_at < now:
+            self._forget(key)
+            return None
+        self._entries.move_to_end(key)
+        entry.expires_at = now + self.ttl
+        self._touched.add(key)
+        return entry
+
+    def _read(self, key, now):
+        """The backend's entry for key, or _ABSENT."""
+        if self.backend.persistent:
+            row = self.backend.load(self.namespace, key)
+            if row is not None and row[1] >= now:
+                blob, expires_at = row
+                try:
+                    return _Entry(pickle.loads(blob), expires_at, blob, expires_at)
+                except Exception as e:
+                    print(f"⚠️ State {self.namespace}:{key} could not be restored: {e}")
+        return _ABSENT
+
+    def _forget(self, key):
+        self._entries[key] = _ABSENT
+        self._touched.add(key)
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            key, entry = next(iter(self._entries.items()))
+            if key in self._touched:
+                self._touched.discard(key)
+                try:
+                    self._write(key, entry)
+                except Exception as e:
+                    print(f"⚠️ State {self.namespace}:{key} was evicted without being saved: {e}")
+            del self._entries[key]
+
+    def _write(self, key, entry):
+        if not self.backend.persistent:
+            return
+        if entry is _ABSENT:
+            self.backend.delete(self.namespace, key)
+            return
+        blob = pickle.dumps(entry.value, protocol=pickle.HIGHEST_PROTOCOL)
+        # Sliding expiry is only pushed to the backend once it has moved noticeably
+        if blob == entry.saved_blob and entry.expires_at - entry.saved_expires_at < self.ttl / 4:
+            return
+        self.backend.save(self.namespace, key, blob, entry.expires_at)
+        entry.saved_blob = blob
+        entry.saved_expires_at = entry.expires_at
+
+    def flush(self):
+        """Writes back every entry read or written since the last flush."""
+        with self._lock:
+            touched, self._touched = self._touched, set()
+            for key in touched:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                try:
+                    self._write(key, entry)
+                except (pickle.PicklingError, TypeError, AttributeError) as e:
+                    # Not serializable: the entry still works, it just lives in this process only
+                    print(f"⚠️ State {self.namespace}:{key} can't be serialized: {e}")
+                except Exception as e:
+                    self._touched.add(key)
+                    print(f"⚠️ State {self.namespace}:{key} could not be saved, retrying on next flush: {e}")
+            now = time.time()
+            if now - self._last_purge >= PURGE_INTERVAL_SECONDS:
+                self._last_purge = now
+                self._purge(now)
+
+    def _purge(self, now):
+        for key in [k for k, e in self._entries.items() if e is not _ABSENT and e.expires_at < now]:
+            self._entries[key] = _ABSENT
+        try:
+            self.backend.purge_expired(now)
+        except Exception as e:
+            print(f"⚠️ Expired states could not be purged: {e}")
+
+    # ---- dict interface ----
+    def __getitem__(self, key):
+        self._preload(key)
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                raise KeyError(key)
+            return entry.value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries[key] = _Entry(value, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            self._touched.add(key)
+            self._evict()
+
+    def __delitem__(self, key):
+        self._preload(key)
+        with self._lock:
+            if self._lookup(key) is None:
+                raise KeyError(key)
+            self._forget(key)
+
+    def __contains__(self, key):
+        self._preload(key)
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def get(self, key, default=None):
+        self._preload(key)
+        with self._lock:
+            entry = self._lookup(key)
+            return default if entry is None else entry.value
+
+    def pop(self, key, *default):
+        self._preload(key)
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                if default:
+                    return default[0]
+                raise KeyError(key)
+            self._forget(key)
+            return entry.value
+
+    def setdefault(self, key, default=None):
+        self._preload(key)
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is not None:
+                return entry.value
+            self[key] = default
+            return default
+
+    def __len__(self):
+        """Live entries in the working set (entries only in the backend are not counted)."""
+        with self._lock:
+            now = time.time()
+            return sum(1 for e in self._entries.values() if e is not _ABSENT and e.expires_at >= now)
+
+
+def flush_stores():
+    for store in list(_stores):
+        store.flush()
+
+
+# ----------------- Next-step handlers -----------------
+class StateHandlerBackend(HandlerBackend):
+    """telebot next-step handler backend kept in a StateStore, so pending steps survive restarts."""
+
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+
+    def register_handler(self, handler_group_id, handler):
+        if self.store.backend.persistent:
+            try:
+                pickle.dumps(handler, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                # Would only be logged at flush and silently lost on restart
+                name = getattr(handler['callback'], '__qualname__', handler['callback'])
+                raise ValueError(f"Next-step handler {name} can't be saved; register a module-level "
+                                 f"function with picklable arguments instead of a lambda or closure ({e})") from e
+        handlers = self.store.get(handler_group_id) or []
+        handlers.append(handler)
+        self.store[handler_group_id] = handlers
+        self.store.flush()
+
+    def clear_handlers(self, handler_group_id):
+        self.store.pop(handler_group_id, None)
+        self.store.flush()
+
+    def get_handlers(self, handler_group_id):
+        handlers = self.store.pop(handler_group_id, None)
+        if handlers is None:
+            return None
+        self.store.flush()
+        # Next-step handlers run without middlewares, so their state writes are flushed here
+        return [Handler(_flushing(h['callback']), *h['args'], **h['kwargs']) for h in handlers]
+
+
+def _flushing(callback):
+    def run(*args, **kwargs):
+        try:
+            return callback(*args, **kwargs)
+        finally:
+            flush_stores()
+    run.__name__ = getattr(callback, '__name__', 'next_step_handler')
+    return run
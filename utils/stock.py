@@ -0,0 +1,86 @@
+"""
+Stock reservation.
+
+Quantities are only ever changed with a conditional, set-based decrement
+(Quantity = Quantity - n WHERE Quantity >= n), so concurrent checkouts can never push a
+product below zero: the second buyer's row simply doesn't match.
+"""
+from collections import OrderedDict, namedtuple
+
+from utils.db import begin_write
+
+StockShortage = namedtuple('StockShortage', ['product_id', 'name', 'requested', 'available'])
+
+
+def _merge(items):
+    """Sums quantities per product, keeping first-seen order (a product may appear twice in a cart)."""
+    merged = OrderedDict()
+    for product_id, quantity in items:
+        merged[product_id] = merged.get(product_id, 0) + quantity
+    return merged
+
+
+def _values_rows(count):
+    # Explicit casts so Postgres can type the VALUES list; SQLite accepts them as no-ops
+    return ", ".join(["(CAST(? AS INTEGER), CAST(? AS INTEGER))"] * count)
+
+
+def reserve_stock(conn, items):
+    """
+    Decrements stock for every (product_id, quantity) in one statement, inside the caller's
+    transaction. Returns a list of StockShortage for the items that could not be reserved
+    (empty on success). When it is not empty the caller must roll back, since the items that
+    did fit have already been decremented.
+    """
+    merged = _merge(items)
+    if not merged:
+        return []
+
+    params = []
+    for product_id, quantity in merged.items():
+        params.extend((product_id, quantity))
+
+    cursor = conn.cursor()
+    begin_write(conn)
+    cursor.execute(f"""
+        WITH wanted(ProductID, Qty) AS (VALUES {_values_rows(len(merged))})
+        UPDATE Products
+        SET Quantity = Products.Quantity - wanted.Qty
+        FROM wanted
+        WHERE Products.ProductID = wanted.ProductID AND Products.Quantity >= wanted.Qty
+        RETURNING Products.ProductID
+    """, params)
+    reserved = {row[0] for row in cursor.fetchall()}
+
+    missing = [pid for pid in merged if pid not in reserved]
+    if not missing:
+        return []
+
+    placeholders = ", ".join(["?"] * len(missing))
+    cursor.execute(f"SELECT ProductID, Name, Quantity FROM Products WHERE ProductID IN ({placeholders})",
+                   missing)
+    found = {row[0]: row for row in cursor.fetchall()}
+    shortages = []
+    for pid in missing:
+        row = found.get(pid)
+        shortages.append(StockShortage(pid, row[1] if row else None, merged[pid], row[2] if row else 0))
+    return shortages
+
+
+def release_stock(conn, items):
+    """Puts reserved quantities back (undoes a committed reserve_stock), inside the caller's transaction."""
+    merged = _merge(items)
+    if not merged:
+        return
+    params = []
+    for product_id, quantity in merged.items():
+        params.extend((product_id, quantity))
+    cursor = conn.cursor()
+    begin_write(conn)
+    cursor.execute(f"""
+        WITH released(ProductID, Qty) AS (VALUES {_values_rows(len(merged))})
+        UPDATE Products
+        SET Quantity = Products.Quantity + released.Qty
+        FROM released
+        WHERE Products.ProductID = released.ProductID
+    """, params)
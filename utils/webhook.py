@@ -0,0 +1,224 @@
+"""
+Webhook ingestion.
+
+An alternative to long polling: Telegram POSTs every update to a small threaded HTTP server.
+The server
+
+    * rejects requests without the secret token given to setWebhook
+      (X-Telegram-Bot-Api-Secret-Token),
+    * drops update_ids it has already accepted (Telegram retries, or anything at or below the
+      offset recorded by a previous run),
+    * calls handle(update) first and answers 200 only after it returned and the offset was
+      recorded in UpdateOffsets. A handle that raises, or an offset that can't be recorded,
+      gets a 500, so Telegram delivers the update again: delivery is at-least-once for as
+      long as handle() does not return before the update is processed (the bot's single
+      process handle waits for the handler, and with BOT_WORKERS > 1 it waits for the
+      worker's acknowledgement, see utils/workers.py).
+
+Telegram delivers up to max_connections updates in parallel, so they finish out of order. The
+recorded offset is a low watermark, not the highest update_id handled: the highest handled
+id below every update that is still in flight (or failed and awaits redelivery). After a
+restart everything at or below it is dropped as a duplicate, and everything above it is
+handled again, so a crash never loses an update that was accepted but not yet handled.
+
+Recorded updates (WEBHOOK_RECORD) can be POSTed back to a local server with replay_updates.py.
+"""
+import hmac
+import json
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# Telegram may deliver several updates in parallel, so duplicates are detected by id, not by order
+RECENT_UPDATE_IDS = 10000
+
+
+class UpdateOffsets:
+    """Last accepted update_id per source, in the UpdateOffsets table."""
+
+    def __init__(self, connect, source='telegram'):
+        self.connect = connect
+        self.source = source
+
+    def last(self):
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT LastUpdateID FROM UpdateOffsets WHERE Source = ?", (self.source,))
+            row = cursor.fetchone()
+            return row[0] if row else 0
+        finally:
+            conn.close()
+
+    def advance(self, update_id):
+        """Raises the recorded offset to update_id (never lowers it)."""
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO UpdateOffsets (Source, LastUpdateID) VALUES (?, ?)
+                ON CONFLICT (Source) DO UPDATE SET LastUpdateID = excluded.LastUpdateID
+                WHERE UpdateOffsets.LastUpdateID < excluded.LastUpdateID
+            """, (self.source, update_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+
+class WebhookServer:
+    def __init__(self, handle, secret_token, path='/webhook', host='0.0.0.0', port=8443,
+                 offsets=None, record_path=None):
+        """
+        handle(update_dict) runs before the response is sent; the update is acknowledged once
+        it returns, so it should return when the update was processed (or durably handed off).
+        """
+        self.handle = handle
+        self.secret_token = secret_token
+        self.path = path
+        self.offsets = offsets
+        self.record_path = record_path
+        self._record_lock = threading.Lock()
+        # Everything up to the previous run's offset was already handled
+        self._floor = offsets.last() if offsets is not None else 0
+        self._recent = set()
+        self._recent_order = deque()
+        self._seen_lock = threading.Lock()
+        self._pending = set()      # accepted but not handled yet, including failed ones
+        self._handled = set()      # handled update_ids above the watermark
+        self._mark = self._floor
+        self._stored = self._floor   # offset last written to UpdateOffsets
+        self.received = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.httpd = ThreadingHTTPServer((host, port), self._request_handler())
+        self.httpd.daemon_threads = True
+
+    def _request_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                # Health check for the hosting platform
+                self._reply(200 if self.path == '/healthz' else 404)
+
+            def do_POST(self):
+                if self.path != server.path:
+                    self._reply(404)
+                    return
+                token = self.headers.get(SECRET_HEADER, '')
+                if not server.secret_token or not hmac.compare_digest(token, server.secret_token):
+                    server.rejected += 1
+                    self._reply(403)
+                    return
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    update = json.loads(self.rfile.read(length))
+                    update_id = int(update['update_id'])
+                except (ValueError, KeyError, TypeError):
+                    self._reply(400)
+                    return
+
+                if not server.first_delivery(update_id):
+                    # Already handled (or still running); a retry after a failed advance records the offset again
+                    server.duplicates += 1
+                    self._reply(200 if server.recorded(update_id) else 500)
+                    return
+                try:
+                    server.record(update)
+                    server.handle(update)
+                except Exception as e:
+                    print(f"⚠️ Webhook update {update_id} not handled, asking Telegram to retry: {e}")
+                    server.forget(update_id)
+                    self._reply(500)
+                    return
+                server.received += 1
+                self._reply(200 if server.advance(update_id) else 500)
+
+            def _reply(self, status):
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                self.wfile.flush()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def first_delivery(self, update_id):
+        with self._seen_lock:
+            if update_id <= self._floor or update_id in self._recent:
+                return False
+            self._recent.add(update_id)
+            self._recent_order.append(update_id)
+            if len(self._recent_order) > RECENT_UPDATE_IDS:
+                self._recent.discard(self._recent_order.popleft())
+            self._pending.add(update_id)
+            return True
+
+    def forget(self, update_id):
+        """
+        Lets a redelivery of an update that was not handled through again. It stays pending,
+        so the offset can't move past it before the redelivery was handled.
+        """
+        with self._seen_lock:
+            self._recent.discard(update_id)
+
+    def watermark(self):
+        """Highest handled update_id with nothing pending below it."""
+        with self._seen_lock:
+            return self._mark
+
+    def advance(self, update_id):
+        """Marks update_id handled and records the new watermark; False if recording failed."""
+        with self._seen_lock:
+            self._pending.discard(update_id)
+            if update_id > self._mark:
+                self._handled.add(update_id)
+            below = min(self._pending) if self._pending else None
+            done = [i for i in self._handled if below is None or i < below]
+            if done:
+                self._mark = max(done)
+                self._handled.difference_update(done)
+        return self._store()
+
+    def recorded(self, update_id):
+        """
+        True once a delivered update_id needs no redelivery: it was handled and the watermark
+        is stored (written now if an earlier advance failed). False while it is still running.
+        """
+        with self._seen_lock:
+            if update_id in self._pending:
+                return False
+        return self._store()
+
+    def _store(self):
+        if self.offsets is None:
+            return True
+        mark = self.watermark()
+        with self._seen_lock:
+            if mark <= self._stored:
+                return True
+        try:
+            self.offsets.advance(mark)
+        except Exception as e:
+            print(f"⚠️ Could not record webhook offset {mark}: {e}")
+            return False
+        with self._seen_lock:
+            self._stored = max(self._stored, mark)
+        return True
+
+    def record(self, update):
+        if not self.record_path:
+            return
+        with self._record_lock:
+            with open(self.record_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(update, ensure_ascii=False) + '\n')
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,232 @@
+"""
+Partitioned worker processes.
+
+One receiver process fetches updates (long polling here, the webhook server can use the same
+dispatcher) and fans them out to N worker processes. Each update goes to worker
+chat_id % N, so every update from a chat is handled by the same process, in the order
+Telegram delivered it, and that chat's conversation state (utils/state.py) stays in that
+worker's working set. Workers share everything else through the database.
+
+Workers are forked from the receiver after the bot module is loaded, so handlers, the router
+and the middlewares are already set up. The receiver must not have started any threads by
+then (a lock held by a thread at fork time stays locked forever in the child), so telebot's
+worker pool, the outbound limiter, job workers and render processes are all created by the
+on_start hook in each child, together with anything else that must not be shared across a
+fork (DB connections). Once running, the receiver has threads (the webhook server's, the
+acknowledgement collector), so a worker that died is replaced with a spawned process, which
+imports the bot module afresh instead of inheriting the receiver's memory.
+
+handle(update, done) runs in the worker and calls done() (or done(error)) once the update was
+processed, possibly later on another thread. dispatch(update, wait=seconds) blocks until then,
+so the webhook server acknowledges an update only after a worker handled it (at-least-once).
+Long polling dispatches without waiting: an update counts as received (and its update_id as
+confirmed to Telegram and recorded in UpdateOffsets) once it is in a worker's queue, so
+updates still queued in a worker that crashes are lost (at-most-once); the dispatcher only
+restarts the worker.
+"""
+import multiprocessing
+import queue
+import threading
+import time
+import zlib
+
+from telebot import apihelper
+
+# Update fields that carry the chat the update belongs to, in lookup order
+_CHAT_PATHS = (
+    ('message', 'chat', 'id'),
+    ('edited_message', 'chat', 'id'),
+    ('channel_post', 'chat', 'id'),
+    ('edited_channel_post', 'chat', 'id'),
+    ('callback_query', 'message', 'chat', 'id'),
+    ('callback_query', 'from', 'id'),
+    ('my_chat_member', 'chat', 'id'),
+    ('chat_member', 'chat', 'id'),
+    ('chat_join_request', 'chat', 'id'),
+    ('inline_query', 'from', 'id'),
+    ('chosen_inline_result', 'from', 'id'),
+    ('pre_checkout_query', 'from', 'id'),
+    ('shipping_query', 'from', 'id'),
+)
+
+
+def partition_key(update):
+    """The chat (or, failing that, user) a raw update dict belongs to; update_id for anything else."""
+    for path in _CHAT_PATHS:
+        node = update
+        for field in path:
+            node = node.get(field) if isinstance(node, dict) else None
+            if node is None:
+                break
+        if node is not None:
+            return node
+    return update.get('update_id', 0)
+
+
+def partition_for(update, partitions):
+    key = partition_key(update)
+    if not isinstance(key, int):
+        key = zlib.crc32(str(key).encode('utf-8'))
+    return key % partitions
+
+
+def _ignore(error=None):
+    pass
+
+
+def _acknowledger(acks, update_id):
+    def done(error=None):
+        acks.put((update_id, None if error is None else str(error)))
+    return done
+
+
+def _worker_main(index, updates, acks, handle, on_start):
+    if on_start is not None:
+        on_start(index)
+    while True:
+        item = updates.get()
+        if item is None:
+            break
+        update, wants_ack = item
+        done = _acknowledger(acks, update.get('update_id')) if wants_ack else _ignore
+        try:
+            handle(update, done)
+        except Exception as e:
+            print(f"⚠️ Worker {index}: update {update.get('update_id')} failed: {e}")
+            done(e)
+
+
+class PartitionedDispatcher:
+    """Fans raw update dicts out to worker processes by chat_id."""
+
+    def __init__(self, handle, workers, on_start=None, queue_size=1000):
+        """
+        handle(update_dict, done) runs in the worker; on_start(index) runs once in each new worker.
+        queue_size bounds each worker's backlog: dispatch() blocks while a worker is that far behind.
+        """
+        # fork keeps the loaded bot module; spawn is used for replacements started once the
+        # receiver has threads, and everywhere fork doesn't exist
+        methods = multiprocessing.get_all_start_methods()
+        self._restart_mp = multiprocessing.get_context('spawn')
+        self._mp = multiprocessing.get_context('fork') if 'fork' in methods else self._restart_mp
+        self.handle = handle
+        self.on_start = on_start
+        self.workers = workers
+        # Spawn-context queues, so both forked and spawned workers can use them
+        self._queues = [self._restart_mp.Queue(queue_size) for _ in range(workers)]
+        self._acks = self._restart_mp.Queue()
+        # One per worker: dispatch runs on many webhook threads at once
+        self._locks = [threading.Lock() for _ in range(workers)]
+        self._waiters = {}          # update_id -> [Event, error] for dispatch(wait=...)
+        self._waiters_lock = threading.Lock()
+        self._processes = [None] * workers
+        self.dispatched = [0] * workers
+        self.restarts = 0
+
+    def _start(self, index, context=None):
+        process = (context or self._mp).Process(
+            target=_worker_main,
+            args=(index, self._queues[index], self._acks, self.handle, self.on_start),
+            name=f"bot-worker-{index}",
+            daemon=True)
+        process.start()
+        self._processes[index] = process
+
+    def start(self):
+        for index in range(self.workers):
+            self._start(index)
+        # Only after the workers were forked
+        threading.Thread(target=self._collect_acks, name="worker-acks", daemon=True).start()
+
+    def _collect_acks(self):
+        while True:
+            update_id, error = self._acks.get()
+            with self._waiters_lock:
+                waiter = self._waiters.pop(update_id, None)
+            if waiter is not None:
+                waiter[1] = error
+                waiter[0].set()
+
+    def dispatch(self, update, wait=None):
+        """
+        Queues update on its chat's worker. With wait, blocks until the worker processed it
+        (at most wait seconds; an update still queued after that is left to run) and raises if
+        handling failed or the worker died first.
+        """
+        index = partition_for(update, self.workers)
+        update_id = update.get('update_id')
+        waiter = None
+        if wait is not None:
+            waiter = [threading.Event(), None]
+            with self._waiters_lock:
+                self._waiters[update_id] = waiter
+        # Serialized per worker: a chat's updates are queued in the order they got here, and a
+        # dead worker is replaced once
+        with self._locks[index]:
+            process = self._processes[index]
+            if process is None or not process.is_alive():
+                if process is not None:
+                    print(f"⚠️ Worker {index} exited (code {process.exitcode}), restarting")
+                    self.restarts += 1
+                self._start(index, self._restart_mp)
+            self._queues[index].put((update, waiter is not None))
+            self.dispatched[index] += 1
+        if waiter is not None:
+            self._wait(waiter, index, update_id, wait)
+
+    def _wait(self, waiter, index, update_id, timeout):
+        deadline = time.monotonic() + timeout
+        while not waiter[0].wait(min(1.0, max(deadline - time.monotonic(), 0))):
+            died = not self._processes[index].is_alive()
+            if died or time.monotonic() >= deadline:
+                with self._waiters_lock:
+                    self._waiters.pop(update_id, None)
+                if died:
+                    raise RuntimeError(f"worker {index} exited before handling update {update_id}")
+                print(f"⚠️ Update {update_id} still queued on worker {index} after {timeout:.0f}s, acknowledging it")
+                return
+        if waiter[1] is not None:
+            raise RuntimeError(f"update {update_id} failed on worker {index}: {waiter[1]}")
+
+    def stop(self, timeout=10):
+        for q in self._queues:
+            try:
+                q.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+        for process in self._processes:
+            if process is not None:
+                process.join(timeout)
+
+    def stats(self):
+        depths = []
+        for q in self._queues:
+            try:
+                depths.append(q.qsize())
+            except NotImplementedError:  # macOS
+                depths.append(None)
+        return {'workers': self.workers, 'dispatched': list(self.dispatched),
+                'queue_depths': depths, 'restarts': self.restarts}
+
+
+def poll_into(dispatcher, token, allowed_updates=None, timeout=60, long_polling_timeout=60, offsets=None):
+    """
+    Long-polls getUpdates forever and hands every raw update to the dispatcher.
+    With offsets (utils.webhook.UpdateOffsets) it resumes after the last recorded update_id.
+    An update is confirmed (next getUpdates offset, UpdateOffsets) as soon as it is dispatched,
+    before a worker has processed it: at-most-once, see the module docstring.
+    """
+    last = offsets.last() if offsets is not None else 0
+    offset = last + 1 if last else None
+    while True:
+        try:
+            updates = apihelper.get_updates(token, offset, None, timeout, allowed_updates, long_polling_timeout)
+        except Exception as e:
+            print(f"⚠️ Polling Error (Retrying in 5s): {e}")
+            time.sleep(5)
+            continue
+        for update in updates:
+            dispatcher.dispatch(update)
+            offset = update['update_id'] + 1
+        if updates and offsets is not None:
+            offsets.advance(offset - 1)